@@ -0,0 +1,860 @@
+#-----------------------------------------------------------------------------
+
+import base64
+from collections import OrderedDict, deque
+import hashlib
+import json
+import Queue
+import select
+import subprocess
+import threading
+import time
+
+from codejail import jail_code
+
+from capa.safe_exec.safe_exec import CODE_PROLOG, LAZY_IMPORTS
+
+# The program a CheckFunctionWorker runs. It reads one JSON request per line
+# on stdin and writes one JSON reply per line on stdout.
+#
+# The worker itself never runs problem code. Each request's code runs in a
+# child process forked from it, so that what the code changes (module
+# attributes, sys.path, files) goes away with the child. The child is
+# confined as codejail confines a run: it can't start processes, may write
+# files of FILE_SIZE bytes at most, may use MEMORY bytes of address space and
+# CPU_TIME seconds of CPU (past that the kernel kills it), and runs in a
+# codejail-* directory holding its extra files, with a tmp directory for
+# TMPDIR. It gets a process group of its own, which the worker kills if it
+# runs over WALL_TIME seconds. The modules named after the limits are
+# imported once by the worker, so that children start with them loaded.
+# Whatever the code prints is thrown away.
+#
+# A "call" request calls a check function. Its problem script is run once
+# per (location, version, seed), with the prolog safe_exec puts in front of
+# it, in a child that is kept for up to NAMESPACE_CALLS later calls to that
+# namespace, and may use CPU_TIME seconds of CPU for each of them. The
+# script's random generator is put back to its state after the script ran
+# before each call, as if the script had just been run again.
+#
+# A "batch" request calls a check function once per (expect, ans, kwargs) in
+# its list of calls, and replies with a [return value, error message] pair
+# for each of them.
+#
+# An "exec" request runs code in a fresh namespace, like safe_exec, and
+# replies with the globals that survive a JSON round trip.
+#
+# An "exec_layered" request does the same for a LayeredContext: it only
+# brings the hash of the base layer, which the worker keeps once it has been
+# sent, and the overlay. The reply only has the globals that differ from the
+# base.
+WORKER_SOURCE = r'''
+import base64
+from collections import OrderedDict
+import json
+import math
+import os
+import resource
+import select
+import shutil
+import signal
+import sys
+import tempfile
+
+MAX_NAMESPACES = int(sys.argv[1])
+NAMESPACE_CALLS = int(sys.argv[2])
+CPU_TIME = float(sys.argv[3])
+WALL_TIME = float(sys.argv[4])
+MEMORY = int(sys.argv[5])
+FILE_SIZE = int(sys.argv[6])
+namespaces = OrderedDict()
+bases = OrderedDict()
+
+
+class Child(object):
+    """
+    A confined child process that runs serve(requests, replies, request,
+    *args) for the request that started it, with the pipes to send it
+    request lines and read its replies. The child may use cpu_budget seconds
+    of CPU in all.
+    """
+
+    def __init__(self, serve, request, cpu_budget, *args):
+        # Laid out as codejail lays out a run, so that the sandbox's
+        # AppArmor profile lets the code at its files.
+        self.directory = tempfile.mkdtemp(prefix='codejail-')
+        os.chmod(self.directory, 0o775)
+        os.mkdir(os.path.join(self.directory, 'tmp'))
+        os.chmod(os.path.join(self.directory, 'tmp'), 0o777)
+        for name, content in request['extra_files']:
+            with open(os.path.join(self.directory, name), 'wb') as extra_file:
+                extra_file.write(base64.b64decode(content))
+        request_read, request_write = os.pipe()
+        reply_read, reply_write = os.pipe()
+        self.calls = 0
+        self.pid = os.fork()
+        if self.pid == 0:
+            # The child never returns to the worker's loop.
+            try:
+                os.setpgid(0, 0)
+                for child in namespaces.values():
+                    child.close()
+                os.close(request_write)
+                os.close(reply_read)
+                devnull = os.open(os.devnull, os.O_RDWR)
+                os.dup2(devnull, 0)
+                os.dup2(devnull, 1)
+                signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+                os.chdir(self.directory)
+                os.environ['TMPDIR'] = 'tmp'
+                tempfile.tempdir = None
+                sys.path.extend(os.path.join(self.directory, path) for path in request['python_path'])
+                confine(cpu_budget)
+                serve(os.fdopen(request_read, 'r'), os.fdopen(reply_write, 'w'), request, *args)
+            finally:
+                os._exit(0)
+        try:
+            os.setpgid(self.pid, self.pid)
+        except OSError:
+            # The child got there first.
+            pass
+        os.close(request_read)
+        os.close(reply_write)
+        self.requests = os.fdopen(request_write, 'w')
+        self.replies = os.fdopen(reply_read, 'r')
+
+    def send(self, request):
+        try:
+            self.requests.write(json.dumps(request) + '\n')
+            self.requests.flush()
+        except (IOError, OSError):
+            pass
+
+    def reply(self):
+        if WALL_TIME and not select.select([self.replies], [], [], WALL_TIME)[0]:
+            self.kill()
+            return {'error': 'The problem code ran out of time', 'gone': True}
+        line = self.replies.readline()
+        if not line:
+            return {'error': 'The problem code ran out of time or crashed', 'gone': True}
+        return json.loads(line)
+
+    def kill(self):
+        try:
+            os.killpg(self.pid, signal.SIGKILL)
+        except OSError:
+            pass
+
+    def close(self):
+        self.requests.close()
+        self.replies.close()
+
+    def stop(self):
+        self.close()
+        self.kill()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+def confine(cpu_budget):
+    # As codejail's set_process_limits does for each run
+    resource.setrlimit(resource.RLIMIT_NPROC, (0, 0))
+    resource.setrlimit(resource.RLIMIT_FSIZE, (FILE_SIZE, FILE_SIZE))
+    if MEMORY:
+        resource.setrlimit(resource.RLIMIT_AS, (MEMORY, MEMORY))
+    if CPU_TIME:
+        cpu = int(math.ceil(cpu_budget))
+        resource.setrlimit(resource.RLIMIT_CPU, (cpu, cpu + 1))
+
+
+def limit_cpu():
+    # For each request of a child that serves many of them
+    if CPU_TIME:
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        hard = resource.getrlimit(resource.RLIMIT_CPU)[1]
+        soft = int(usage.ru_utime + usage.ru_stime + CPU_TIME) + 1
+        if hard != resource.RLIM_INFINITY:
+            soft = min(soft, hard)
+        resource.setrlimit(resource.RLIMIT_CPU, (soft, hard))
+
+
+def write_reply(replies, operation):
+    try:
+        reply = json.dumps(operation())
+    except Exception as err:
+        reply = json.dumps({'error': '{0}: {1}'.format(err.__class__.__name__, err)})
+    replies.write(reply + '\n')
+    replies.flush()
+
+
+def exec_code(request, globals_dict):
+    exec(compile(request['code'], request['slug'], 'exec', 0, True), globals_dict)
+
+
+def call_function(namespace, state, name, expect, ans, kwargs):
+    if state is not None:
+        namespace['random'].setstate(state)
+        sys.modules['random'] = namespace['random']
+    namespace['expect'] = expect
+    namespace['ans'] = ans
+    namespace.update(kwargs)
+    kwargs = dict((str(key), value) for key, value in kwargs.items())
+    return namespace[name](expect, ans, **kwargs)
+
+
+def call(namespace, state, request):
+    return {'return': call_function(namespace, state, request['name'], request['expect'], request['ans'],
+                                    request['kwargs'])}
+
+
+def call_batch(namespace, state, request):
+    returns = []
+    for expect, ans, kwargs in request['calls']:
+        try:
+            value = call_function(namespace, state, request['name'], expect, ans, kwargs)
+            json.dumps(value)
+            returns.append([value, None])
+        except Exception as err:
+            returns.append([None, '{0}: {1}'.format(err.__class__.__name__, err)])
+    return {'returns': returns}
+
+
+CALLS = {'call': call, 'batch': call_batch}
+
+
+def serve_namespace(requests, replies, request):
+    namespace = {}
+    loaded = []
+
+    def load_and_call():
+        limit_cpu()
+        exec_code(request, namespace)
+        rng = namespace.get('random')
+        loaded.append(rng.getstate() if hasattr(rng, 'getstate') else None)
+        return CALLS[request.get('op', 'call')](namespace, loaded[0], request)
+
+    write_reply(replies, load_and_call)
+    if loaded:
+        for line in iter(requests.readline, ''):
+            request = json.loads(line)
+            limit_cpu()
+            write_reply(replies, lambda: CALLS[request.get('op', 'call')](namespace, loaded[0], request))
+
+
+def serve_exec(requests, replies, request, base, base_json, overlay, deleted):
+    def execute():
+        globals_dict = json.loads(base_json)
+        for name in deleted:
+            globals_dict.pop(name, None)
+        globals_dict.update(overlay)
+        exec_code(request, globals_dict)
+        changed = [name for name, value in globals_dict.items() if name not in base or base[name] != value]
+        return {'globals': json_results(globals_dict, changed)}
+
+    write_reply(replies, execute)
+
+
+def json_results(globals_dict, names):
+    results = {}
+    for name in names:
+        try:
+            results[name] = json.loads(json.dumps(globals_dict[name]))
+        except (TypeError, ValueError):
+            pass
+    return results
+
+
+def call_namespace(request):
+    key = (request['location'], request['version'], request['seed'])
+    child = namespaces.pop(key, None)
+    if child is None:
+        if 'code' not in request:
+            return {'missing': True}
+        # Enough CPU to run the script and every call it is kept for
+        child = Child(serve_namespace, request, CPU_TIME * (NAMESPACE_CALLS + 1))
+    else:
+        child.send(request)
+    reply = child.reply()
+    child.calls += 1
+    # A script that failed to run leaves no namespace behind, and one that
+    # has had all its calls is run again for the next.
+    if reply.pop('gone', False) or ('error' in reply and 'code' in request) or child.calls >= NAMESPACE_CALLS:
+        child.stop()
+        return reply
+    namespaces[key] = child
+    while len(namespaces) > MAX_NAMESPACES:
+        namespaces.popitem(last=False)[1].stop()
+    return reply
+
+
+def run_once(request, base, base_json, overlay, deleted):
+    child = Child(serve_exec, request, CPU_TIME, base, base_json, overlay, deleted)
+    try:
+        reply = child.reply()
+    finally:
+        child.stop()
+    reply.pop('gone', None)
+    return reply
+
+
+def execute(request):
+    return run_once(request, {}, '{}', request['globals'], [])
+
+
+def execute_layered(request):
+    key = request['base_hash']
+    if key not in bases:
+        if 'base' not in request:
+            return {'missing': True}
+        # Each run parses a copy of the base from its JSON, which is quicker
+        # than a deep copy, and leaves the base as it was to compare with.
+        bases[key] = (request['base'], json.dumps(request['base']))
+        while len(bases) > MAX_NAMESPACES:
+            bases.popitem(last=False)
+    base, base_json = bases[key]
+    return run_once(request, base, base_json, request['overlay'], request['deleted'])
+
+
+OPERATIONS = {'call': call_namespace, 'batch': call_namespace, 'exec': execute, 'exec_layered': execute_layered}
+
+
+def main():
+    requests, replies = sys.stdin, sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    # Children are reaped as they exit.
+    signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+    for module in sys.argv[7:]:
+        try:
+            __import__(module)
+        except ImportError:
+            pass
+    for line in iter(requests.readline, ''):
+        try:
+            request = json.loads(line)
+            reply = json.dumps(OPERATIONS[request.get('op', 'call')](request))
+        except Exception as err:
+            reply = json.dumps({'error': '{0}: {1}'.format(err.__class__.__name__, err)})
+        replies.write(reply + '\n')
+        replies.flush()
+
+main()
+'''
+
+# Put after a problem script by CheckFunction.call_batch: calls the check
+# function once per (expect, ans, kwargs) in cfn_calls, each with the script's
+# random generator as the script left it, and collects a [return value, error
+# message] pair for each call in cfn_returns.
+BATCH_CALL_CODE = """
+import json as cfn_json
+cfn_random_state = random.getstate() if hasattr(random, 'getstate') else None
+cfn_returns = []
+for expect, ans, cfn_kwargs in cfn_calls:
+    globals().update(cfn_kwargs)
+    if cfn_random_state is not None:
+        random.setstate(cfn_random_state)
+    try:
+        cfn_return = {0}(expect, ans, **cfn_kwargs)
+        cfn_json.dumps(cfn_return)
+        cfn_returns.append([cfn_return, None])
+    except Exception as cfn_error:
+        cfn_returns.append([None, '{{0}}: {{1}}'.format(cfn_error.__class__.__name__, cfn_error)])
+"""
+
+
+class CheckFunctionError(Exception):
+    """
+    A check function failed, or its worker did.
+    """
+    pass
+
+
+class CheckFunction(object):
+    """
+    A check function (cfn) defined in the <script> of a CustomResponse problem.
+
+    The code sent to safe_exec for each call, the script followed by a call of
+    the function, is put together once; the arguments travel as globals so
+    that the code doesn't change from call to call. With a `sandbox` (a
+    CheckFunctionWorkerPool), that code runs in one of its workers instead of
+    a new safe_exec interpreter.
+
+    Code that may run unsafely always runs with safe_exec.safe_exec, which
+    is what honours `unsafely`: a worker is only as safe as its command.
+
+    With a `worker`, the script is instead run once per problem, version and
+    seed in a long-lived CheckFunctionWorker process, and each call only sends
+    expect, ans and the extra arguments. The problem is told apart by the
+    slug, the response id, which starts with the problem's location. The
+    namespace is then shared by all the calls for that problem, so problems
+    only get a worker if they opt in with reuse_script="true": a check
+    function that changes global state would see the changes of earlier
+    calls.
+
+    With a `cache` (anything with get(key) and set(key, value), like
+    capa_system.cache or a CheckResultCache), the return value of each call
+    is kept, as JSON, under a hash of the script, the function name, the
+    seed and the arguments, and identical calls don't run the function
+    again. Only for functions of those alone: problems opt in with
+    cacheable="true". Errors are not cached.
+    """
+
+    def __init__(self, script_code, name, python_path, extra_files, slug, random_seed, unsafely,
+                 worker=None, sandbox=None, cache=None):
+        self.script_code = script_code
+        self.name = name
+        self.python_path = python_path
+        self.extra_files = extra_files
+        self.slug = slug
+        self.random_seed = random_seed
+        self.unsafely = unsafely
+        self.worker = worker if not unsafely else None
+        self.sandbox = sandbox if not unsafely else None
+        self.cache = cache
+        self.code = script_code + "\n" + "cfn_return = {0}(expect, ans, **cfn_kwargs)\n".format(name)
+        self._version = None
+
+    def __call__(self, expect, ans, **kwargs):
+        key = self.result_key(expect, ans, kwargs)
+        if key is not None:
+            cached = self.cache.get(key)
+            if cached is not None:
+                return json.loads(cached)
+
+        value = self._call(expect, ans, kwargs)
+        if key is not None:
+            self.cache.set(key, json.dumps(value))
+        return value
+
+    def _call(self, expect, ans, kwargs):
+        """
+        Calls the function in the worker or the sandbox.
+        """
+        if self.worker is not None:
+            return self.worker.call(self, expect, ans, kwargs)
+
+        globals_dict = {
+            'expect': expect,
+            'ans': ans,
+            'cfn_kwargs': kwargs,
+        }
+        globals_dict.update(kwargs)
+        self._run(self.code, globals_dict)
+        return globals_dict['cfn_return']
+
+    def call_batch(self, calls):
+        """
+        Calls the function once per (expect, ans, kwargs) in `calls`, with a
+        single run of the script (or a single worker request).
+
+        Returns one (return value, error message) pair per call: an exception
+        raised by one call only gives that call an error message. Errors that
+        stop the whole run, like one in the script itself, are raised.
+        """
+        keys = [self.result_key(*call) for call in calls]
+        results = [None] * len(calls)
+        for index, key in enumerate(keys):
+            cached = self.cache.get(key) if key is not None else None
+            if cached is not None:
+                results[index] = (json.loads(cached), None)
+
+        uncalled = [index for index, result in enumerate(results) if result is None]
+        for index, result in zip(uncalled, self._call_batch([calls[index] for index in uncalled])):
+            results[index] = result
+            value, error = result
+            if keys[index] is not None and error is None:
+                self.cache.set(keys[index], json.dumps(value))
+        return results
+
+    def _call_batch(self, calls):
+        """
+        Calls the function for each call in the worker or the sandbox.
+        """
+        if not calls:
+            return []
+        if self.worker is not None:
+            return self.worker.call_batch(self, calls)
+
+        globals_dict = {'cfn_calls': [list(call) for call in calls]}
+        self._run(self.script_code + "\n" + BATCH_CALL_CODE.format(self.name), globals_dict)
+        return [tuple(pair) for pair in globals_dict['cfn_returns']]
+
+    def _run(self, code, globals_dict):
+        """
+        Runs code in the sandbox, or with safe_exec.
+        """
+        options = dict(python_path=self.python_path, extra_files=self.extra_files, slug=self.slug,
+                       random_seed=self.random_seed)
+        if self.sandbox is not None:
+            self.sandbox.safe_exec(code, globals_dict, **options)
+        else:
+            safe_exec.safe_exec(code, globals_dict, unsafely=self.unsafely, **options)
+
+    def result_key(self, expect, ans, kwargs):
+        """
+        The key of the result of a call in `cache`: a hash of the version,
+        the seed and the arguments as the sandbox would see them. None if
+        results aren't cached, or if the arguments can't be sent as JSON.
+        """
+        if self.cache is None:
+            return None
+        try:
+            arguments = json.dumps([self.random_seed, expect, ans, kwargs], sort_keys=True)
+        except (TypeError, ValueError):
+            return None
+        return 'cfn_result.' + hashlib.sha1((self.version + arguments).encode('utf-8')).hexdigest()
+
+    @property
+    def version(self):
+        """
+        A hash of everything the script's namespace depends on, apart from
+        the seed. Only worked out when it is needed, for a worker's
+        namespaces or for result_key, since the extra files can be large.
+        """
+        if self._version is None:
+            digest = hashlib.sha1()
+            for part in [self.name, self.script_code] + list(self.python_path or []):
+                digest.update(part.encode('utf-8') + b'\0')
+            for name, content in self.extra_files or []:
+                digest.update(name.encode('utf-8') + b'\0' + content + b'\0')
+            self._version = digest.hexdigest()
+        return self._version
+
+    def load_request(self):
+        """
+        What a worker needs to run the script.
+        """
+        return dict(code=CODE_PROLOG % self.random_seed + LAZY_IMPORTS + self.script_code,
+                    **file_request(self.slug, self.python_path, self.extra_files))
+
+
+class CheckResultCache(object):
+    """
+    A bounded, thread-safe, in-process LRU cache of check function results,
+    for CheckFunction when there is no shared cache.
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """
+        Returns the value stored under key, or None.
+        """
+        with self._lock:
+            value = self._entries.pop(key, None)
+            if value is not None:
+                self.hits += 1
+                self._entries[key] = value
+            else:
+                self.misses += 1
+            return value
+
+    def set(self, key, value):
+        """
+        Stores value under key, dropping the least recently used entries
+        past maxsize.
+        """
+        with self._lock:
+            if self.maxsize > 0:
+                self._entries.pop(key, None)
+                self._entries[key] = value
+                while len(self._entries) > self.maxsize:
+                    self._entries.popitem(last=False)
+
+
+CHECK_RESULT_CACHE = CheckResultCache(maxsize=10000)
+
+
+def file_request(slug, python_path, extra_files):
+    """
+    The slug, python_path and extra files of a worker request.
+    """
+    return {
+        'slug': slug or '<problem code>',
+        'python_path': list(python_path or []),
+        'extra_files': [(name, base64.b64encode(content).decode('ascii')) for name, content in extra_files or []],
+    }
+
+
+def codejail_python_command():
+    """
+    The command line codejail runs its sandboxed python with, for
+    CheckFunctionWorker. Raises CheckFunctionError if codejail isn't
+    configured with one, rather than falling back to an unconfined python.
+    """
+    if not jail_code.is_configured('python'):
+        raise CheckFunctionError("codejail has no sandboxed python configured")
+    python = jail_code.COMMANDS['python']
+    command = ['sudo', '-u', python['user']] if python['user'] else []
+    return command + list(python['cmdline_start'])
+
+
+# How much longer than its wall_time a CheckFunctionWorker waits for a reply
+# before it takes the worker for stuck and restarts it.
+WORKER_GRACE_TIME = 1
+
+
+class CheckFunctionWorker(object):
+    """
+    A long-lived Python process that keeps the namespaces of the problem
+    scripts it has run, for check functions of problems with
+    reuse_script="true", and can also run code the way safe_exec does.
+    The process itself only forks: each request's code runs in a child of
+    its own (each namespace in a child of its own), so nothing it changes
+    is seen by the code of other problems.
+
+    `command` starts the interpreter. In production it must be the sandboxed
+    python that codejail is configured with, as codejail_python_command()
+    gives it, so that the worker is confined like safe_exec is; anything
+    else, like [sys.executable], is only fit for trusted code. At most
+    `max_namespaces` scripts are kept, each for `max_namespace_calls` calls,
+    after which the script is run again. The modules named in `preload` are
+    imported once, before any child is forked.
+
+    Each request may take `cpu_time` seconds of CPU and `wall_time` seconds
+    in all, may use `memory` bytes of address space and may write files of
+    `file_size` bytes; a child that goes over them is stopped and the
+    request fails. Limits left at None are codejail's, from
+    jail_code.LIMITS, where 0 means no limit (but no files for file_size).
+    If the process itself doesn't reply, it is killed and the next request
+    starts a new one.
+    """
+
+    def __init__(self, command, max_namespaces=100, max_namespace_calls=100, cpu_time=None, wall_time=None,
+                 memory=None, file_size=None, preload=()):
+        self.command = list(command)
+        self.max_namespaces = max_namespaces
+        self.max_namespace_calls = max_namespace_calls
+        self.cpu_time = jail_code.LIMITS['CPU'] if cpu_time is None else cpu_time
+        self.wall_time = jail_code.LIMITS['REALTIME'] if wall_time is None else wall_time
+        self.memory = jail_code.LIMITS['VMEM'] if memory is None else memory
+        self.file_size = jail_code.LIMITS['FSIZE'] if file_size is None else file_size
+        self.preload = list(preload)
+        self.calls = 0
+        self._process = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        """
+        Starts the process, if it isn't running.
+        """
+        if self._process is None or self._process.poll() is not None:
+            limits = [self.max_namespaces, self.max_namespace_calls, self.cpu_time, self.wall_time, self.memory,
+                      self.file_size]
+            self._process = subprocess.Popen(
+                self.command + ['-c', WORKER_SOURCE] + [str(limit) for limit in limits] + self.preload,
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                close_fds=True,
+            )
+            self.calls = 0
+
+    def stop(self):
+        """
+        Stops the process, if it is running.
+        """
+        if self._process is not None:
+            if self._process.poll() is None:
+                self._process.kill()
+            self._process.wait()
+            self._process = None
+
+    @property
+    def alive(self):
+        return self._process is not None and self._process.poll() is None
+
+    def call(self, check_function, expect, ans, kwargs):
+        """
+        Calls the check function, running its script first if this worker
+        doesn't have its namespace yet.
+        """
+        request = {
+            'location': check_function.slug,
+            'version': check_function.version,
+            'seed': check_function.random_seed,
+            'name': check_function.name,
+            'expect': expect,
+            'ans': ans,
+            'kwargs': kwargs,
+        }
+        return self._send_loading(check_function, request)['return']
+
+    def call_batch(self, check_function, calls):
+        """
+        CheckFunction.call_batch, with the script's namespace kept.
+        """
+        request = {
+            'op': 'batch',
+            'location': check_function.slug,
+            'version': check_function.version,
+            'seed': check_function.random_seed,
+            'name': check_function.name,
+            'calls': [list(call) for call in calls],
+        }
+        return [tuple(pair) for pair in self._send_loading(check_function, request)['returns']]
+
+    def safe_exec(self, code, globals_dict, random_seed=None, python_path=None, extra_files=None, slug=None):
+        """
+        Runs code like safe_exec.safe_exec does, in a fresh namespace but in
+        this worker's interpreter. There is no `unsafely`: the worker confines
+        the code as codejail would, and code that may run unsafely is run
+        with safe_exec.safe_exec instead. For a LayeredContext, the base is
+        only sent if the worker doesn't have it yet.
+        """
+        request = dict(code=CODE_PROLOG % random_seed + LAZY_IMPORTS + code,
+                       **file_request(slug, python_path, extra_files))
+        with self._lock:
+            if isinstance(globals_dict, LayeredContext):
+                request.update(op='exec_layered', base_hash=globals_dict.base_hash,
+                               overlay=json_safe(globals_dict.overlay), deleted=list(globals_dict.deleted))
+                reply = self._send(request)
+                if reply.get('missing'):
+                    reply = self._send(request, encoded={'base': globals_dict.base_json})
+            else:
+                request.update(op='exec', globals=json_safe(globals_dict))
+                reply = self._send(request)
+        globals_dict.update(reply['globals'])
+
+    def _send_loading(self, check_function, request):
+        """
+        Sends a request for a check function, and sends it again with the
+        script if this worker doesn't have its namespace.
+        """
+        with self._lock:
+            reply = self._send(request)
+            if reply.get('missing'):
+                request.update(check_function.load_request())
+                reply = self._send(request)
+        return reply
+
+    def _send(self, request, encoded=None):
+        """
+        Sends one request and waits for the reply, starting the process if
+        it isn't running. The values in `encoded` are JSON already, and go
+        into the request as they are. Raises CheckFunctionError if the code
+        failed or the process died or ran out of time.
+        """
+        self.start()
+        self.calls += 1
+        text = json.dumps(request)
+        for name, value in (encoded or {}).items():
+            text = text[:-1] + ', ' + json.dumps(name) + ': ' + value + '}'
+        line = b''
+        try:
+            self._process.stdin.write((text + '\n').encode('utf-8'))
+            self._process.stdin.flush()
+            # The worker stops code that runs over wall_time itself; past
+            # the grace period, the worker is the one that is stuck.
+            if not self.wall_time or select.select([self._process.stdout], [], [],
+                                                   self.wall_time + WORKER_GRACE_TIME)[0]:
+                line = self._process.stdout.readline()
+        except IOError:
+            pass
+        if not line:
+            self.stop()
+            raise CheckFunctionError("The check function worker exited or ran out of time")
+        reply = json.loads(line.decode('utf-8'))
+        if 'error' in reply:
+            raise CheckFunctionError(reply['error'])
+        return reply
+
+
+class CheckFunctionWorkerPool(object):
+    """
+    A pool of pre-started CheckFunctionWorkers, so that checks don't wait
+    for a new sandbox interpreter. It runs code like safe_exec and calls
+    check functions like a single worker does, on whichever worker is free;
+    callers queue while all of them are busy.
+
+    A worker is restarted after `max_calls` requests and after a crash or
+    time-out. `command` and the other arguments are passed on to each worker.
+    """
+
+    def __init__(self, size, command, max_calls=1000, latency_samples=1000, **worker_options):
+        self.max_calls = max_calls
+        self._workers = [CheckFunctionWorker(command, **worker_options) for _ in range(size)]
+        self._idle = Queue.Queue()
+        for worker in self._workers:
+            worker.start()
+            self._idle.put(worker)
+        self._lock = threading.Lock()
+        self._waiting = 0
+        self._counts = {'requests': 0, 'errors': 0, 'recycled': 0}
+        self._waits = deque(maxlen=latency_samples)
+        self._latencies = deque(maxlen=latency_samples)
+
+    def call(self, check_function, expect, ans, kwargs):
+        """
+        CheckFunctionWorker.call on a free worker.
+        """
+        return self._run('call', check_function, expect, ans, kwargs)
+
+    def call_batch(self, check_function, calls):
+        """
+        CheckFunctionWorker.call_batch on a free worker.
+        """
+        return self._run('call_batch', check_function, calls)
+
+    def safe_exec(self, code, globals_dict, **kwargs):
+        """
+        CheckFunctionWorker.safe_exec on a free worker.
+        """
+        return self._run('safe_exec', code, globals_dict, **kwargs)
+
+    def _run(self, method, *args, **kwargs):
+        """
+        Waits for a free worker and runs the request on it, keeping track of
+        the waiting and total times.
+        """
+        started = time.time()
+        with self._lock:
+            self._waiting += 1
+        worker = self._idle.get()
+        with self._lock:
+            self._waiting -= 1
+        self._waits.append(time.time() - started)
+        failed = False
+        try:
+            return getattr(worker, method)(*args, **kwargs)
+        except CheckFunctionError:
+            failed = True
+            raise
+        finally:
+            self._latencies.append(time.time() - started)
+            recycle = not worker.alive or worker.calls >= self.max_calls
+            if recycle:
+                worker.stop()
+                worker.start()
+            with self._lock:
+                self._counts['requests'] += 1
+                self._counts['errors'] += failed
+                self._counts['recycled'] += recycle
+            self._idle.put(worker)
+
+    def metrics(self):
+        """
+        Returns a dict with the number of workers, requests waiting for one
+        (queue depth), requests served, failed and workers recycled so far,
+        and the median and 95th percentile of the recent waiting and total
+        times, in seconds.
+        """
+        with self._lock:
+            result = dict(self._counts, workers=len(self._workers), waiting=self._waiting)
+        for name, samples in [('wait', self._waits), ('latency', self._latencies)]:
+            samples = sorted(samples)
+            for label, fraction in [('p50', 0.5), ('p95', 0.95)]:
+                result['{0}_{1}'.format(name, label)] = (
+                    samples[min(int(len(samples) * fraction), len(samples) - 1)] if samples else None
+                )
+        return result
+
+    def close(self):
+        """
+        Stops all the workers.
+        """
+        for worker in self._workers:
+            worker.stop()
+
+#-----------------------------------------------------------------------------
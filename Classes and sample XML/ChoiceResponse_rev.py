@@ -1,4 +1,18 @@
 #-----------------------------------------------------------------------------
+
+
+def _popcount(mask):
+    """
+    Returns the number of set bits in a non-negative integer bitmask.
+    """
+    return bin(mask).count('1')
+
+
+# Outcome tables for small checkbox problems, shared between all responses
+# with the same choice layout and grading scheme.
+_CHOICE_OUTCOME_TABLES = {}
+
+
 @registry.register
 class ChoiceResponse(LoncapaResponse):
     """
@@ -55,36 +69,117 @@ class ChoiceResponse(LoncapaResponse):
     correct_choices = None
     has_responsive_ui = True
 
+    # Problems with at most this many choices precompute the outcome of every
+    # possible submission at setup time. Set to 0 to always compute grades.
+    max_outcome_table_choices = 8
+
     def setup_response(self):
 
+        # This below checks to see whether we're using an alternate grading scheme.
+        #  Set partial_credit="false" (or remove it) to require an exact answer for any credit.
+        #  Set partial_credit="EDC" to count each choice for equal points (Every Decision Counts).
+        #  Set partial_credit="halves" to take half credit off for each error.
+        #  Set partial_credit="count_correct" to score a point for each correct choice selected.
+        #  Set partial_credit="dock_incorrect" to take a point off for each choice gotten wrong.
+        # Partial credit type - only one type at a time right now.
+        _ = self.capa_system.i18n.ugettext
+        try:
+            self.partial_credit = PartialCreditPolicy.from_xml(
+                self.xml, ['edc', 'halves', 'count_correct', 'dock_incorrect']
+            )
+        except ValueError:
+            # Translators: 'partial_credit' is an attribute name and should not be translated.
+            # 'EDC', 'halves', 'count_correct', 'dock_incorrect' and 'false' should also not be translated.
+            msg = _("partial_credit value should be one of 'EDC', 'halves', 'count_correct', "
+                    "'dock_incorrect', or 'false'.")
+            raise LoncapaProblemError(msg)
+
+        # The points a fully right answer is worth (count_correct and
+        # dock_incorrect), and the decimal places partial credit is rounded to.
+        try:
+            expected_count = self.xml.get('partial_expected')
+            if expected_count is not None:
+                expected_count = int(expected_count)
+                if expected_count < 1:
+                    raise ValueError(expected_count)
+            rounding = int(self.xml.get('partial_round', '2'))
+        except ValueError:
+            # Translators: 'partial_expected' and 'partial_round' are attribute names and should not be translated.
+            msg = _("partial_expected should be a positive whole number and partial_round a whole number.")
+            raise LoncapaProblemError(msg)
+        self.partial_credit = self.partial_credit._replace(expected_count=expected_count, rounding=rounding)
+
+        self.element_index = ResponseElementIndex(self.xml)
+
         self.assign_choice_names()
 
-        correct_xml = self.xml.xpath(
-            '//*[@id=$id]//choice[@correct="true"]',
-            id=self.xml.get('id')
-        )
+        correct_xml = self.element_index.find_all('choice', correct='true')
 
         self.correct_choices = set([choice.get(
             'name') for choice in correct_xml])
 
-        incorrect_xml = self.xml.xpath(
-            '//*[@id=$id]//choice[@correct="false"]',
-            id=self.xml.get('id')
-        )
+        incorrect_xml = self.element_index.find_all('choice', correct='false')
 
         self.incorrect_choices = set([choice.get(
             'name') for choice in incorrect_xml])
 
+        # Compile the choices into integer bitmasks (bit N is choice_N), so
+        # grading a submission is a few bitwise operations instead of set
+        # arithmetic over the choice names.
+        self.choice_bits = dict(
+            (choice.get('name'), 1 << index)
+            for index, choice in enumerate(self.element_index.find_all('choice'))
+        )
+        self.correct_mask = self.get_choice_mask(self.correct_choices)[0]
+        self.incorrect_mask = self.get_choice_mask(self.incorrect_choices)[0]
+        self.all_choices_mask = self.correct_mask | self.incorrect_mask
+        self.num_choices = _popcount(self.all_choices_mask)
+
+        # Out of how many points count_correct and dock_incorrect grade: by
+        # default the number of correct choices, or of all choices.
+        self.expected_count = self.partial_credit.expected_count
+        if self.expected_count is None:
+            if self.partial_credit.scheme == 'count_correct':
+                self.expected_count = _popcount(self.correct_mask)
+            else:
+                self.expected_count = self.num_choices
+
+        self.outcome_table = None
+        if 0 < self.num_choices and len(self.choice_bits) <= self.max_outcome_table_choices:
+            self.outcome_table = self.get_outcome_table(self.partial_credit.scheme)
+
     def assign_choice_names(self):
         """
         Initialize name attributes in <choice> tags for this response.
         """
 
-        for index, choice in enumerate(self.xml.xpath('//*[@id=$id]//choice',
-                                                      id=self.xml.get('id'))):
+        for index, choice in enumerate(self.element_index.find_all('choice')):
             choice.set("name", "choice_" + str(index))
 
-    def grade_via_edc(self, all_choices, student_answer, student_non_answers):
+    def get_choice_mask(self, names):
+        """
+        Turns a collection of choice names into a bitmask over this response's
+        choices.
+        Returns a tuple (mask, has_unknown), where has_unknown is True if any
+        of the names does not belong to a choice of this response.
+        """
+        mask = 0
+        has_unknown = False
+        for name in names:
+            bit = self.choice_bits.get(name)
+            if bit is None:
+                has_unknown = True
+            else:
+                mask |= bit
+        return mask, has_unknown
+
+    def count_errors(self, student_mask):
+        """
+        Counts the correct choices left blank plus the incorrect choices selected.
+        """
+        return _popcount((student_mask ^ self.correct_mask) & self.all_choices_mask)
+
+    def grade_via_edc(self, student_mask):
         """
         Calculates partial credit on the EDC scheme.
         For each correctly selected or correctly blank choice, score 1 point.
@@ -92,21 +187,18 @@ class ChoiceResponse(LoncapaResponse):
         Returns a CorrectMap.
         """
 
-        edc_max_grade = len(all_choices)
-        edc_current_grade = 0
+        edc_max_grade = self.num_choices
+        edc_current_grade = edc_max_grade - self.count_errors(student_mask)
 
-        good_answers = sum([1 for answer in student_answer if answer in self.correct_choices])
-        good_non_answers = sum([1 for blank in student_non_answers if blank in self.incorrect_choices])
-        edc_current_grade = good_answers + good_non_answers
-
-        return_grade = round(self.get_max_score() * float(edc_current_grade) / float(edc_max_grade), 2)
+        return_grade = round(self.get_max_score() * float(edc_current_grade) / float(edc_max_grade),
+                             self.partial_credit.rounding)
 
         if edc_current_grade > 0:
             return CorrectMap(self.answer_id, correctness='partially-correct', npoints=return_grade)
         else:
             return CorrectMap(self.answer_id, correctness='incorrect', npoints=0)
 
-    def grade_via_halves(self, all_choices, student_answer, student_non_answers):
+    def grade_via_halves(self, student_mask):
         """
         Calculates partial credit on the Halves scheme.
         If no errors, full credit.
@@ -116,34 +208,63 @@ class ChoiceResponse(LoncapaResponse):
         Returns a CorrectMap
         """
 
-        halves_error_count = 0
-
-        incorrect_answers = sum([1 for answer in student_answer if answer in self.incorrect_choices])
-        missed_answers = sum([1 for blank in student_non_answers if blank in self.correct_choices])
-        halves_error_count = incorrect_answers + missed_answers
+        halves_error_count = self.count_errors(student_mask)
 
         if halves_error_count == 0:
             return_grade = self.get_max_score()
             return CorrectMap(self.answer_id, correctness='correct', npoints=return_grade)
-        elif halves_error_count == 1 and len(all_choices) > 2:
-            return_grade = round(self.get_max_score() / 2.0, 2)
+        elif halves_error_count == 1 and self.num_choices > 2:
+            return_grade = round(self.get_max_score() / 2.0, self.partial_credit.rounding)
             return CorrectMap(self.answer_id, correctness='partially-correct', npoints=return_grade)
-        elif halves_error_count == 2 and len(all_choices) > 4:
-            return_grade = round(self.get_max_score() / 4.0, 2)
+        elif halves_error_count == 2 and self.num_choices > 4:
+            return_grade = round(self.get_max_score() / 4.0, self.partial_credit.rounding)
             return CorrectMap(self.answer_id, correctness='partially-correct', npoints=return_grade)
         else:
             return CorrectMap(self.answer_id, 'incorrect')
 
-    def get_score(self, student_answers):
+    def grade_via_count_correct(self, student_mask, has_unknown=False):
+        """
+        Calculates partial credit on the count_correct scheme.
+        Exactly the correct choices get full credit. Otherwise, score 1 point
+        for each correct choice selected, with no penalty for incorrect ones,
+        out of the expected count.
+        Returns a CorrectMap.
+        """
+        if student_mask == self.correct_mask and not has_unknown:
+            return CorrectMap(self.answer_id, correctness='correct', npoints=self.get_max_score())
+        return self.grade_points(_popcount(student_mask & self.correct_mask))
 
-        # Setting up answer lists:
-        #  all_choices: the full list of checkboxes
-        #  student_answer: what the student actually chose (note no "s")
-        #  student_non_answer: what they didn't choose
-        #  self.correct_choices: boxes that should be checked
-        #  self.incorrect_choices: boxes that should NOT be checked
+    def grade_via_dock_incorrect(self, student_mask, has_unknown=False):
+        """
+        Calculates partial credit on the dock_incorrect scheme.
+        Exactly the correct choices get full credit. Otherwise, start from the
+        expected count (by default the number of choices) and take 1 point
+        off for each incorrect choice selected or correct choice left blank.
+        Returns a CorrectMap.
+        """
+        if student_mask == self.correct_mask and not has_unknown:
+            return CorrectMap(self.answer_id, correctness='correct', npoints=self.get_max_score())
+        return self.grade_points(self.expected_count - self.count_errors(student_mask))
+
+    def grade_points(self, points):
+        """
+        Turns the points an inexact answer scored out of the expected count
+        into a CorrectMap, rounded as configured and capped at full credit.
+        """
+        if points > 0:
+            fraction = min(float(points) / self.expected_count, 1.0)
+            return_grade = round(self.get_max_score() * fraction, self.partial_credit.rounding)
+            return CorrectMap(self.answer_id, correctness='partially-correct', npoints=return_grade)
+        else:
+            return CorrectMap(self.answer_id, correctness='incorrect', npoints=0)
+
+    def get_score(self, student_answers):
 
-        all_choices = self.correct_choices.union(self.incorrect_choices)
+        # Setting up answer masks:
+        #  student_mask: the choices the student actually chose
+        #  has_unknown: whether they submitted a name that isn't one of our choices
+        #  self.correct_mask: boxes that should be checked
+        #  self.incorrect_mask: boxes that should NOT be checked
 
         student_answer = student_answers.get(self.answer_id, [])
 
@@ -152,52 +273,161 @@ class ChoiceResponse(LoncapaResponse):
 
         # "None apply" should really be a valid choice for "check all that apply",
         # but it throws an error if all the checks are blank.
-        no_empty_answer = student_answer != []
-
-        student_answer = set(student_answer)
-
-        student_non_answers = all_choices - student_answer
-
-        if not no_empty_answer:
+        if not student_answer:
             return CorrectMap(self.answer_id, 'incorrect')
 
-        # This below checks to see whether we're using an alternate grading scheme.
-        #  Set partial_credit="false" (or remove it) to require an exact answer for any credit.
-        #  Set partial_credit="EDC" to count each choice for equal points (Every Decision Counts).
-        #  Set partial_credit="halves" to take half credit off for each error.
+        student_mask, has_unknown = self.get_choice_mask(student_answer)
 
-        tree = self.xml
-        problem_xml = tree.xpath('.')
+        credit_type = self.partial_credit.scheme
 
-        # Partial credit type - only one type at a time right now.
-        credit_type = problem_xml[0].get('partial_credit', default=False)
+        # Names that aren't our choices aren't in the outcome table, but only
+        # the exact-match scheme needs to know about them.
+        if self.outcome_table is not None and (not has_unknown or credit_type in ('edc', 'halves')):
+            correctness, npoints = self.outcome_table[student_mask]
+            return CorrectMap(self.answer_id, correctness=correctness, npoints=npoints)
 
-        try:
-            credit_type = str(credit_type).lower().strip()
-        except ValueError:
-            _ = self.capa_system.i18n.ugettext
-            # Translators: 'partial_credit' is an attribute name and should not be translated.
-            # 'EDC' and 'halves' and 'false' should also not be translated.
-            msg = _("partial_credit value should be one of 'EDC', 'halves', or 'false'.")
-            raise LoncapaProblemError(msg)
+        return self.grade_mask(student_mask, has_unknown, credit_type)
 
+    def grade_mask(self, student_mask, has_unknown, credit_type):
+        """
+        Grades a submission given as a bitmask over this response's choices.
+        Returns a CorrectMap.
+        """
         if credit_type == 'false':
             pass
         elif credit_type == 'halves':
-            return self.grade_via_halves(all_choices, student_answer, student_non_answers)
+            return self.grade_via_halves(student_mask)
         elif credit_type == 'edc':
-            return self.grade_via_edc(all_choices, student_answer, student_non_answers)
-
-        required_selected = len(self.correct_choices - student_answer) == 0
-        no_extra_selected = len(student_answer - self.correct_choices) == 0
+            return self.grade_via_edc(student_mask)
+        elif credit_type == 'count_correct':
+            return self.grade_via_count_correct(student_mask, has_unknown)
+        elif credit_type == 'dock_incorrect':
+            return self.grade_via_dock_incorrect(student_mask, has_unknown)
 
-        correct = required_selected & no_extra_selected & no_empty_answer
+        # Exactly the correct choices, and nothing we don't recognize.
+        correct = student_mask == self.correct_mask and not has_unknown
 
         if correct:
             return CorrectMap(self.answer_id, 'correct')
         else:
             return CorrectMap(self.answer_id, 'incorrect')
 
+    def get_outcome_table(self, credit_type):
+        """
+        Returns a tuple indexed by submission bitmask, giving the
+        (correctness, npoints) that grade_mask assigns to each possible
+        submission under the given scheme.
+        """
+        layout = (len(self.choice_bits), self.correct_mask, self.incorrect_mask,
+                  credit_type, self.get_max_score(), self.expected_count, self.partial_credit.rounding)
+        table = _CHOICE_OUTCOME_TABLES.get(layout)
+        if table is None:
+            outcomes = []
+            for student_mask in xrange(1 << len(self.choice_bits)):
+                grade = self.grade_mask(student_mask, False, credit_type).cmap[self.answer_id]
+                outcomes.append((grade['correctness'], grade['npoints']))
+            table = tuple(outcomes)
+            _CHOICE_OUTCOME_TABLES[layout] = table
+        return table
+
+    def get_error_count_outcomes(self, credit_type):
+        """
+        For the EDC and halves schemes the grade depends only on the number of
+        errors. Returns a list indexed by error count (0 to the number of
+        choices) of (correctness, npoints) pairs, matching get_score.
+        """
+        max_score = self.get_max_score()
+        rounding = self.partial_credit.rounding
+        outcomes = []
+        for error_count in range(self.num_choices + 1):
+            if credit_type == 'edc':
+                edc_current_grade = self.num_choices - error_count
+                if edc_current_grade > 0:
+                    outcomes.append(('partially-correct', round(
+                        max_score * float(edc_current_grade) / float(self.num_choices), rounding)))
+                else:
+                    outcomes.append(('incorrect', 0))
+            elif error_count == 0:
+                outcomes.append(('correct', max_score))
+            elif error_count == 1 and self.num_choices > 2:
+                outcomes.append(('partially-correct', round(max_score / 2.0, rounding)))
+            elif error_count == 2 and self.num_choices > 4:
+                outcomes.append(('partially-correct', round(max_score / 4.0, rounding)))
+            else:
+                outcomes.append(('incorrect', 0))
+        return outcomes
+
+    def grade_batch(self, submissions):
+        """
+        Grades many students' submissions to this response at once, e.g. to
+        regrade a course after its partial_credit scheme changes.
+
+        `submissions` is a sequence with one entry per student: what get_score
+        would find under this response's answer id (a choice name, a list of
+        them, or None if nothing was submitted).
+
+        Returns a dict of numpy arrays with one element per submission:
+            'correctness': 'correct', 'partially-correct' or 'incorrect'
+            'npoints': the points the matching CorrectMap would report
+        """
+        credit_type = self.partial_credit.scheme
+
+        columns = dict((name, bit.bit_length() - 1) for name, bit in self.choice_bits.iteritems())
+        num_columns = len(columns)
+
+        # Pack the submissions into a students x choices matrix.
+        selected = numpy.zeros((len(submissions), num_columns), dtype=bool)
+        has_unknown = numpy.zeros(len(submissions), dtype=bool)
+        is_empty = numpy.zeros(len(submissions), dtype=bool)
+        for row, student_answer in enumerate(submissions):
+            if student_answer is None:
+                student_answer = []
+            elif not isinstance(student_answer, list):
+                student_answer = [student_answer]
+            if not student_answer:
+                is_empty[row] = True
+            for name in student_answer:
+                column = columns.get(name)
+                if column is None:
+                    has_unknown[row] = True
+                else:
+                    selected[row, column] = True
+
+        column_bits = [1 << column for column in range(num_columns)]
+        correct_row = numpy.array([bool(self.correct_mask & bit) for bit in column_bits], dtype=bool)
+        graded_row = numpy.array([bool(self.all_choices_mask & bit) for bit in column_bits], dtype=bool)
+
+        mismatched = selected ^ correct_row
+
+        if credit_type in ('edc', 'halves'):
+            error_counts = (mismatched & graded_row).sum(axis=1)
+            outcomes = self.get_error_count_outcomes(credit_type)
+            correctness = numpy.array([outcome[0] for outcome in outcomes], dtype=object)[error_counts]
+            npoints = numpy.array([outcome[1] for outcome in outcomes], dtype=float)[error_counts]
+        elif credit_type in ('count_correct', 'dock_incorrect'):
+            if credit_type == 'count_correct':
+                points = (selected & correct_row).sum(axis=1)
+            else:
+                points = self.expected_count - (mismatched & graded_row).sum(axis=1)
+            # Grade each distinct score once, so the rounding matches get_score.
+            scores, score_index = numpy.unique(points, return_inverse=True)
+            outcomes = [self.grade_points(score).cmap[self.answer_id] for score in scores]
+            correctness = numpy.array([outcome['correctness'] for outcome in outcomes], dtype=object)[score_index]
+            npoints = numpy.array([outcome['npoints'] for outcome in outcomes], dtype=float)[score_index]
+
+            is_correct = ~mismatched.any(axis=1) & ~has_unknown
+            correctness[is_correct] = 'correct'
+            npoints[is_correct] = self.get_max_score()
+        else:
+            is_correct = ~mismatched.any(axis=1) & ~has_unknown
+            correctness = numpy.where(is_correct, 'correct', 'incorrect').astype(object)
+            npoints = is_correct.astype(float)
+
+        correctness[is_empty] = 'incorrect'
+        npoints[is_empty] = 0
+
+        return {'correctness': correctness, 'npoints': npoints}
+
     def get_answers(self):
         return {self.answer_id: list(self.correct_choices)}
 
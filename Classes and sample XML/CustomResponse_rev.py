@@ -1,5 +1,64 @@
 #-----------------------------------------------------------------------------
 
+from concurrent.futures import Future, ThreadPoolExecutor
+
+# Cleaned feedback messages, by raw message
+CLEAN_MESSAGE_CACHE = {}
+CLEAN_MESSAGE_CACHE_SIZE = 1000
+
+# Text that clean_message_html would only strip and ASCII-encode: no markup
+# or entities, and no characters that BeautifulSoup or lxml change or reject.
+PLAIN_MESSAGE = re.compile(u'[^<>&\r\x00-\x08\x0b\x0c\x0e-\x1f\x7f-\x9f\ud800-\udfff\ufffe\uffff]*\\Z')
+
+
+def is_plain_message(msg):
+    """
+    Whether clean_message_html can skip the HTML round trip for msg.
+    Byte strings only qualify if they are ASCII.
+    """
+    if isinstance(msg, str):
+        try:
+            msg = msg.decode('ascii')
+        except UnicodeDecodeError:
+            return False
+    return PLAIN_MESSAGE.match(msg) is not None
+
+
+class ImmediateExecutor(object):
+    """
+    An executor that runs each function as it is submitted, in the calling
+    thread, so that the asynchronous grading path can also serve get_score.
+    """
+
+    def submit(self, fn, *args, **kwargs):
+        future = Future()
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except Exception as err:  # pylint: disable=broad-except
+            future.set_exception(err)
+        return future
+
+
+IMMEDIATE_EXECUTOR = ImmediateExecutor()
+
+# Runs the sandbox calls of CustomResponse.get_score_async
+CHECK_EXECUTOR = ThreadPoolExecutor(max_workers=32)
+
+
+def then(future, callback):
+    """
+    Returns a Future of callback(future), called once `future` is done.
+    """
+    result = Future()
+
+    def done(finished):
+        try:
+            result.set_result(callback(finished))
+        except Exception as err:  # pylint: disable=broad-except
+            result.set_exception(err)
+    future.add_done_callback(done)
+    return result
+
 
 @registry.register
 class CustomResponse(LoncapaResponse):
@@ -22,9 +81,20 @@ class CustomResponse(LoncapaResponse):
     # Standard amount for partial credit if not otherwise specified:
     default_pc = 0.5
 
+    # The CheckFunctionWorker (or CheckFunctionWorkerPool) that runs the cfn
+    # of problems with reuse_script="true", if the deployment sets one up.
+    check_function_worker = None
+
+    # The CheckFunctionWorkerPool that runs all other problem code instead of
+    # safe_exec, if the deployment sets one up.
+    sandbox_pool = None
+
     def setup_response(self):
         xml = self.xml
 
+        # Checks write into their own layer on top of the problem's context
+        self.context = LayeredContext(self.context)
+
         # if <customresponse> has an "expect" (or "answer") attribute then save
         # that
         self.expect = xml.get('expect') or xml.get('answer')
@@ -50,33 +120,25 @@ class CustomResponse(LoncapaResponse):
                 # This is a bit twisty.  We used to grab the cfn function from
                 # the context, but now that we sandbox Python execution, we
                 # can't get functions from previous executions.  So we make an
-                # actual function that will re-execute the original script,
-                # and invoke the function with the data needed.
-                def make_check_function(script_code, cfn):
-                    def check_function(expect, ans, **kwargs):
-                        extra_args = "".join(", {0}={0}".format(k) for k in kwargs)
-                        code = (
-                            script_code + "\n" +
-                            "cfn_return = %s(expect, ans%s)\n" % (cfn, extra_args)
-                        )
-                        globals_dict = {
-                            'expect': expect,
-                            'ans': ans,
-                        }
-                        globals_dict.update(kwargs)
-                        safe_exec.safe_exec(
-                            code,
-                            globals_dict,
-                            python_path=self.context['python_path'],
-                            extra_files=self.context['extra_files'],
-                            slug=self.id,
-                            random_seed=self.context['seed'],
-                            unsafely=self.capa_system.can_execute_unsafe_code(),
-                        )
-                        return globals_dict['cfn_return']
-                    return check_function
-
-                self.code = make_check_function(self.context['script_code'], cfn)
+                # actual function that will re-execute the original script
+                # (or reuse a worker's namespace for it), and invoke the
+                # function with the data needed.
+                reuse_script = xml.get('reuse_script', 'false').lower() == 'true'
+                result_cache = None
+                if xml.get('cacheable', 'false').lower() == 'true':
+                    result_cache = self.capa_system.cache or CHECK_RESULT_CACHE
+                self.code = CheckFunction(
+                    self.context['script_code'],
+                    cfn,
+                    python_path=self.context['python_path'],
+                    extra_files=self.context['extra_files'],
+                    slug=self.id,
+                    random_seed=self.context['seed'],
+                    unsafely=self.capa_system.can_execute_unsafe_code(),
+                    worker=self.check_function_worker if reuse_script else None,
+                    sandbox=self.sandbox_pool,
+                    cache=result_cache,
+                )
 
         if not self.code:
             if answer is None:
@@ -96,6 +158,94 @@ class CustomResponse(LoncapaResponse):
         student_answers is a dict with everything from request.POST, but with the first part
         of each key removed (the string before the first "_").
         """
+        return self.get_score_async(student_answers, IMMEDIATE_EXECUTOR).result()
+
+    def get_score_async(self, student_answers, executor=None):
+        """
+        get_score, with the run of the check function or code handed to
+        `executor` (CHECK_EXECUTOR, a thread pool, by default) instead of
+        blocking the caller.
+
+        Returns a concurrent.futures.Future of the CorrectMap, which an
+        event loop can wait on (e.g. asyncio.wrap_future). The check goes
+        through the overlay of self.context, so only check one submission
+        per response at a time.
+        """
+        graded = Future()
+        try:
+            idset, submission, correct_map = self.prepare_check(student_answers)
+        except Exception as err:  # pylint: disable=broad-except
+            graded.set_exception(err)
+            return graded
+        if correct_map is not None:
+            graded.set_result(correct_map)
+            return graded
+
+        # Run the check function
+        def function_checked(finished):
+            finished.result()
+            return self.build_correct_map(idset)
+        return then(self.execute_check_function_async(idset, submission, executor), function_checked)
+
+    def grade_batch(self, submissions):
+        """
+        Grades many students' submissions to this response at once, e.g. for
+        a regrade or to try a cfn out before release.
+
+        `submissions` is a sequence with one entry per student: the
+        student_answers dictionary get_score would be given. A cfn check
+        function is called for all of them in one sandbox run (see
+        CheckFunction.call_batch); inline <answer> code is run once per
+        submission.
+
+        Returns a list with, for each submission, the CorrectMap get_score
+        would return, or the exception it would raise: an error in one
+        submission doesn't stop the others from being graded.
+        """
+        results = [None] * len(submissions)
+        pending = []
+        calls = []
+        for index, student_answers in enumerate(submissions):
+            try:
+                if not isinstance(self.code, CheckFunction):
+                    results[index] = self.get_score(student_answers)
+                    continue
+                idset, submission, correct_map = self.prepare_check(student_answers)
+            except Exception as err:  # pylint: disable=broad-except
+                results[index] = err
+                continue
+            if correct_map is not None:
+                results[index] = correct_map
+                continue
+            answer_given = submission[0] if (len(idset) == 1) else submission
+            pending.append((index, student_answers))
+            calls.append((self.expect, answer_given, self.get_check_function_kwargs()))
+
+        try:
+            returns = self.code.call_batch(calls) if calls else []
+        except Exception as err:  # pylint: disable=broad-except
+            returns = [(None, err.message)] * len(calls)
+
+        for (index, student_answers), (ret, error) in zip(pending, returns):
+            try:
+                if error is not None:
+                    raise ResponseError(error)
+                idset = self.prepare_check(student_answers)[0]
+                self.apply_check_result(ret, idset)
+                results[index] = self.build_correct_map(idset)
+            except Exception as err:  # pylint: disable=broad-except
+                results[index] = err
+        return results
+
+    def prepare_check(self, student_answers):
+        """
+        Puts the submission in student_answers into the context of the check
+        function.
+
+        Returns (idset, submission, correct_map): the ordered answer ids and
+        answers, and the CorrectMap to give without running the check
+        function (for an empty answer), or None.
+        """
         _ = self.capa_system.i18n.ugettext
 
         log.debug('%s: student_answers=%s', unicode(self), student_answers)
@@ -134,7 +284,7 @@ class CustomResponse(LoncapaResponse):
             # empty_answer_err attribute
             msg = (u'<span class="inline-error">{0}</span>'.format(_(u'No answer entered!'))
                    if self.xml.get('empty_answer_err') else '')
-            return CorrectMap(idset[0], 'incorrect', msg=msg)
+            return idset, submission, CorrectMap(idset[0], 'incorrect', msg=msg)
 
         # NOTE: correct = 'unknown' could be dangerous. Inputtypes such as textline are
         # not expecting 'unknown's
@@ -144,6 +294,7 @@ class CustomResponse(LoncapaResponse):
 
         # put these in the context of the check function evaluator
         # note that this doesn't help the "cfn" version - only the exec version
+        self.context.new_overlay()
         self.context.update({
             # my ID
             'response_id': self.id,
@@ -180,10 +331,12 @@ class CustomResponse(LoncapaResponse):
 
         # Pass DEBUG to the check function.
         self.context['debug'] = self.capa_system.DEBUG
+        return idset, submission, None
 
-        # Run the check function
-        self.execute_check_function(idset, submission)
-
+    def build_correct_map(self, idset):
+        """
+        Turns what the check function left in the context into a CorrectMap.
+        """
         # build map giving "correct"ness of the answer(s)
         correct = self.context['correct']
         messages = self.context['messages']
@@ -205,21 +358,37 @@ class CustomResponse(LoncapaResponse):
         return correct_map
 
     def execute_check_function(self, idset, submission):
+        self.execute_check_function_async(idset, submission, IMMEDIATE_EXECUTOR).result()
+
+    def execute_check_function_async(self, idset, submission, executor=None):
+        """
+        Runs the check function or code on `executor`, and returns a Future
+        that is done once its results are in the context.
+        """
+        executor = executor or CHECK_EXECUTOR
+
         # exec the check function
         if isinstance(self.code, basestring):
-            try:
-                safe_exec.safe_exec(
-                    self.code,
-                    self.context,
-                    cache=self.capa_system.cache,
-                    python_path=self.context['python_path'],
-                    extra_files=self.context['extra_files'],
-                    slug=self.id,
-                    random_seed=self.context['seed'],
-                    unsafely=self.capa_system.can_execute_unsafe_code(),
-                )
-            except Exception as err:
-                self._handle_exec_exception(err)
+            exec_options = {
+                'python_path': self.context['python_path'],
+                'extra_files': self.context['extra_files'],
+                'slug': self.id,
+                'random_seed': self.context['seed'],
+            }
+            unsafely = self.capa_system.can_execute_unsafe_code()
+            if self.sandbox_pool is not None and not unsafely:
+                # The pool's workers keep the base layer of the context
+                ran = executor.submit(self.sandbox_pool.safe_exec, self.code, self.context, **exec_options)
+            else:
+                exec_options['unsafely'] = unsafely
+                ran = executor.submit(self._safe_exec_flattened, exec_options)
+
+            def code_ran(finished):
+                try:
+                    finished.result()
+                except Exception as err:
+                    self._handle_exec_exception(err)
+            return then(ran, code_ran)
 
         else:
             # self.code is not a string; it's a function we created earlier.
@@ -227,154 +396,199 @@ class CustomResponse(LoncapaResponse):
             # this is an interface to the Tutor2 check functions
             fn = self.code
             answer_given = submission[0] if (len(idset) == 1) else submission
-            kwnames = self.xml.get("cfn_extra_args", "").split()
-            kwargs = {n: self.context.get(n) for n in kwnames}
+            kwargs = self.get_check_function_kwargs()
             log.debug(" submission = %s", submission)
-            try:
-                ret = fn(self.expect, answer_given, **kwargs)
-            except Exception as err:  # pylint: disable=broad-except
-                self._handle_exec_exception(err)
-            log.debug(
-                "[courseware.capa.responsetypes.customresponse.get_score] ret = %s",
-                ret
-            )
-            if isinstance(ret, dict):
-                # One kind of dictionary the check function can return has the
-                # form {'ok': BOOLEAN or STRING, 'msg': STRING, 'grade_decimal' (optional): FLOAT (between 0.0 and 1.0)}
-                # 'ok' will control the checkmark, while grade_decimal, if present, will scale
-                # the score the student receives on the response.
-                # If there are multiple inputs, they all get marked
-                # to the same correct/incorrect value
-                if 'ok' in ret:
-
-                    # Returning any falsy value or the "false" string for "ok" gives incorrect.
-                    # Returning any string that includes "partial" for "ok" gives partial credit.
-                    # Returning any other truthy value for "ok" gives correct
-
-                    ok_val = str(ret['ok']).lower().strip() if bool(ret['ok']) else 'false'
-
-                    if ok_val == 'false':
-                        correct = 'incorrect'
-                    elif 'partial' in ok_val:
-                        correct = 'partially-correct'
-                    else:
-                        correct = 'correct'
-                    correct = [correct] * len(idset)   # All inputs share the same mark.
 
-                    # old version, no partial credit:
-                    # correct = ['correct' if ret['ok'] else 'incorrect'] * len(idset)
+            def function_ran(finished):
+                try:
+                    ret = finished.result()
+                except Exception as err:  # pylint: disable=broad-except
+                    self._handle_exec_exception(err)
+                self.apply_check_result(ret, idset)
+            return then(executor.submit(fn, self.expect, answer_given, **kwargs), function_ran)
+
+    def _safe_exec_flattened(self, exec_options):
+        """
+        Runs the inline code with safe_exec, which needs the whole context
+        as a plain dict.
+        """
+        context = self.context.flatten()
+        safe_exec.safe_exec(self.code, context, cache=self.capa_system.cache, **exec_options)
+        self.context.update_from(context)
+
+    def get_check_function_kwargs(self):
+        """
+        The extra arguments named in cfn_extra_args, from the context.
+        """
+        kwnames = self.xml.get("cfn_extra_args", "").split()
+        return {n: self.context.get(n) for n in kwnames}
+
+    def apply_check_result(self, ret, idset):
+        """
+        Puts what a check function returned into the context: correct,
+        messages, overall_message and grade_decimals.
+        """
+        log.debug(
+            "[courseware.capa.responsetypes.customresponse.get_score] ret = %s",
+            ret
+        )
+        if isinstance(ret, dict):
+            # One kind of dictionary the check function can return has the
+            # form {'ok': BOOLEAN or STRING, 'msg': STRING, 'grade_decimal' (optional): FLOAT (between 0.0 and 1.0)}
+            # 'ok' will control the checkmark, while grade_decimal, if present, will scale
+            # the score the student receives on the response.
+            # If there are multiple inputs, they all get marked
+            # to the same correct/incorrect value
+            if 'ok' in ret:
+
+                # Returning any falsy value or the "false" string for "ok" gives incorrect.
+                # Returning any string that includes "partial" for "ok" gives partial credit.
+                # Returning any other truthy value for "ok" gives correct
+
+                ok_val = str(ret['ok']).lower().strip() if bool(ret['ok']) else 'false'
+
+                if ok_val == 'false':
+                    correct = 'incorrect'
+                elif 'partial' in ok_val:
+                    correct = 'partially-correct'
+                else:
+                    correct = 'correct'
+                correct = [correct] * len(idset)   # All inputs share the same mark.
+
+                # old version, no partial credit:
+                # correct = ['correct' if ret['ok'] else 'incorrect'] * len(idset)
+
+                msg = ret.get('msg', None)
+                msg = self.clean_message_html(msg)
+
+                # If there is only one input, apply the message to that input
+                # Otherwise, apply the message to the whole problem
+                if len(idset) > 1:
+                    self.context['overall_message'] = msg
+                else:
+                    self.context['messages'][0] = msg
 
-                    msg = ret.get('msg', None)
-                    msg = self.clean_message_html(msg)
+                if 'grade_decimal' in ret:
+                    decimal = float(ret['grade_decimal'])
+                else:
+                    if correct[0] == 'correct':
+                        decimal = 1.0
+                    elif correct[0] == 'partially_correct':
+                        decimal = self.default_pc
+                    else:
+                        decimal = 0.0
+                grade_decimals = [decimal] * len(idset)
+                self.context['grade_decimals'] = grade_decimals
+
+            # Another kind of dictionary the check function can return has
+            # the form:
+            # { 'overall_message': STRING,
+            #   'input_list': [
+            #     {
+            #         'ok': BOOLEAN or STRING,
+            #         'msg': STRING,
+            #         'grade_decimal' (optional): FLOAT (between 0.0 and 1.0)
+            #     },
+            #   ...
+            #   ]
+            # }
+            # 'ok' will control the checkmark, while grade_decimal, if present, will scale
+            # the score the student receives on the response.
+            #
+            # This allows the function to return an 'overall message'
+            # that applies to the entire problem, as well as correct/incorrect
+            # status, scaled grades, and messages for individual inputs
+            elif 'input_list' in ret:
+                overall_message = ret.get('overall_message', '')
+                input_list = ret['input_list']
+
+                correct = []
+                messages = []
+                grade_decimals = []
+
+                # Returning any falsy value or the "false" string for "ok" gives incorrect.
+                # Returning any string that includes "partial" for "ok" gives partial credit.
+                # Returning any other truthy value for "ok" gives correct
 
-                    # If there is only one input, apply the message to that input
-                    # Otherwise, apply the message to the whole problem
-                    if len(idset) > 1:
-                        self.context['overall_message'] = msg
+                for input_dict in input_list:
+                    if str(input_dict['ok']).lower().strip() == "false" or not input_dict['ok']:
+                        correct.append('incorrect')
+                    elif 'partial' in str(input_dict['ok']).lower().strip():
+                        correct.append('partially-correct')
                     else:
-                        self.context['messages'][0] = msg
+                        correct.append('correct')
 
-                    if 'grade_decimal' in ret:
-                        decimal = float(ret['grade_decimal'])
+                    # old version, no partial credit
+                    # correct.append('correct'
+                    #                if input_dict['ok'] else 'incorrect')
+
+                    msg = (self.clean_message_html(input_dict['msg'])
+                           if 'msg' in input_dict else None)
+                    messages.append(msg)
+                    if 'grade_decimal' in input_dict:
+                        decimal = input_dict['grade_decimal']
                     else:
-                        if correct[0] == 'correct':
+                        if input_dict['ok']:
                             decimal = 1.0
-                        elif correct[0] == 'partially_correct':
+                        elif 'partial' in str(input_dict['ok']).lower().strip():
                             decimal = self.default_pc
                         else:
                             decimal = 0.0
-                    grade_decimals = [decimal] * len(idset)
-                    self.context['grade_decimals'] = grade_decimals
-
-                # Another kind of dictionary the check function can return has
-                # the form:
-                # { 'overall_message': STRING,
-                #   'input_list': [
-                #     {
-                #         'ok': BOOLEAN or STRING,
-                #         'msg': STRING,
-                #         'grade_decimal' (optional): FLOAT (between 0.0 and 1.0)
-                #     },
-                #   ...
-                #   ]
-                # }
-                # 'ok' will control the checkmark, while grade_decimal, if present, will scale
-                # the score the student receives on the response.
-                #
-                # This allows the function to return an 'overall message'
-                # that applies to the entire problem, as well as correct/incorrect
-                # status, scaled grades, and messages for individual inputs
-                elif 'input_list' in ret:
-                    overall_message = ret.get('overall_message', '')
-                    input_list = ret['input_list']
-
-                    correct = []
-                    messages = []
-                    grade_decimals = []
-
-                    # Returning any falsy value or the "false" string for "ok" gives incorrect.
-                    # Returning any string that includes "partial" for "ok" gives partial credit.
-                    # Returning any other truthy value for "ok" gives correct
-
-                    for input_dict in input_list:
-                        if str(input_dict['ok']).lower().strip() == "false" or not input_dict['ok']:
-                            correct.append('incorrect')
-                        elif 'partial' in str(input_dict['ok']).lower().strip():
-                            correct.append('partially-correct')
-                        else:
-                            correct.append('correct')
+                    grade_decimals.append(decimal)
 
-                        # old version, no partial credit
-                        # correct.append('correct'
-                        #                if input_dict['ok'] else 'incorrect')
-
-                        msg = (self.clean_message_html(input_dict['msg'])
-                               if 'msg' in input_dict else None)
-                        messages.append(msg)
-                        if 'grade_decimal' in input_dict:
-                            decimal = input_dict['grade_decimal']
-                        else:
-                            if input_dict['ok']:
-                                decimal = 1.0
-                            elif 'partial' in str(input_dict['ok']).lower().strip():
-                                decimal = self.default_pc
-                            else:
-                                decimal = 0.0
-                        grade_decimals.append(decimal)
-
-                    self.context['messages'] = messages
-                    self.context['overall_message'] = overall_message
-                    self.context['grade_decimals'] = grade_decimals
-
-                # Otherwise, we do not recognize the dictionary
-                # Raise an exception
-                else:
-                    log.error(traceback.format_exc())
-                    _ = self.capa_system.i18n.ugettext
-                    raise ResponseError(
-                        _("CustomResponse: check function returned an invalid dictionary!")
-                    )
+                self.context['messages'] = messages
+                self.context['overall_message'] = overall_message
+                self.context['grade_decimals'] = grade_decimals
 
+            # Otherwise, we do not recognize the dictionary
+            # Raise an exception
             else:
+                log.error(traceback.format_exc())
+                _ = self.capa_system.i18n.ugettext
+                raise ResponseError(
+                    _("CustomResponse: check function returned an invalid dictionary!")
+                )
 
-                # Returning any falsy value or the "false" string for "ok" gives incorrect.
-                # Returning any string that includes "partial" for "ok" gives partial credit.
-                # Returning any other truthy value for "ok" gives correct
+        else:
 
-                if str(ret).lower().strip() == "false" or not bool(ret):
-                    correct = 'incorrect'
-                elif 'partial' in str(ret).lower().strip():
-                    correct = 'partially-correct'
-                else:
-                    correct = 'correct'
-                correct = [correct] * len(idset)
+            # Returning any falsy value or the "false" string for "ok" gives incorrect.
+            # Returning any string that includes "partial" for "ok" gives partial credit.
+            # Returning any other truthy value for "ok" gives correct
 
-                # old version, no partial credit:
-                # correct = ['correct' if ret else 'incorrect'] * len(idset)
+            if str(ret).lower().strip() == "false" or not bool(ret):
+                correct = 'incorrect'
+            elif 'partial' in str(ret).lower().strip():
+                correct = 'partially-correct'
+            else:
+                correct = 'correct'
+            correct = [correct] * len(idset)
 
-            self.context['correct'] = correct
+            # old version, no partial credit:
+            # correct = ['correct' if ret else 'incorrect'] * len(idset)
+
+        self.context['correct'] = correct
 
     def clean_message_html(self, msg):
+        """
+        Prettifies the HTML of a feedback message. Messages without markup
+        skip the HTML round trip, and the results for the others are cached,
+        since check functions give the same few messages over and over.
+        """
+        if not msg or not isinstance(msg, basestring):
+            return self._clean_message_html(msg)
+        if is_plain_message(msg):
+            # What the round trip makes of plain text
+            return msg.encode('ascii', 'xmlcharrefreplace').strip()
+
+        cleaned = CLEAN_MESSAGE_CACHE.get(msg)
+        if cleaned is None:
+            cleaned = self._clean_message_html(msg)
+            if len(CLEAN_MESSAGE_CACHE) >= CLEAN_MESSAGE_CACHE_SIZE:
+                CLEAN_MESSAGE_CACHE.clear()
+            CLEAN_MESSAGE_CACHE[msg] = cleaned
+        return cleaned
+
+    def _clean_message_html(self, msg):
 
         # If *msg* is an empty string, then the code below
         # will return "</html>".  To avoid this, we first check
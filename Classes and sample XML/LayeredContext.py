@@ -0,0 +1,142 @@
+#-----------------------------------------------------------------------------
+
+from collections import MutableMapping
+import hashlib
+import json
+
+# The entries of a problem's context that its script ran with. The rest of
+# the context is what the script made of them.
+SCRIPT_INPUTS = ['script_code', 'python_path', 'seed', 'anonymous_student_id']
+
+
+def json_safe(globals_dict):
+    """
+    The entries of globals_dict that can be sent to a worker, as safe_exec
+    only sends those.
+    """
+    result = {}
+    for name, value in globals_dict.iteritems():
+        try:
+            json.dumps(value)
+        except (TypeError, ValueError):
+            continue
+        result[name] = value
+    return result
+
+
+class LayeredContext(MutableMapping):
+    """
+    The context a CustomResponse checks a submission in: the problem's
+    context (the globals of its script) as a base layer, and a thin overlay
+    with the values of one submission (answers, submission, correct,
+    messages, ...).
+
+    Reads look in the overlay first; writes and deletions only change the
+    overlay, so a check never changes the problem's context and
+    new_overlay() starts the next one from a clean slate. The base is taken
+    to stay the same once the problem is set up, so a CheckFunctionWorker
+    that already has it only needs its hash and the overlay, and its JSON is
+    only worked out once, the first time a worker doesn't have it.
+    """
+
+    def __init__(self, base):
+        self.base = base
+        self.overlay = {}
+        self.deleted = set()
+        self._base_hash = None
+        self._base_json = None
+
+    def new_overlay(self):
+        """
+        Drops the values of the previous check.
+        """
+        self.overlay = {}
+        self.deleted = set()
+
+    def __getitem__(self, key):
+        if key in self.overlay:
+            return self.overlay[key]
+        if key in self.deleted:
+            raise KeyError(key)
+        return self.base[key]
+
+    def __setitem__(self, key, value):
+        self.overlay[key] = value
+        self.deleted.discard(key)
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        self.overlay.pop(key, None)
+        if key in self.base:
+            self.deleted.add(key)
+
+    def __contains__(self, key):
+        return key in self.overlay or (key in self.base and key not in self.deleted)
+
+    def __iter__(self):
+        for key in self.overlay:
+            yield key
+        for key in self.base:
+            if key not in self.overlay and key not in self.deleted:
+                yield key
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def flatten(self):
+        """
+        A plain dict with the contents of both layers, for safe_exec.
+        """
+        flat = dict(self.base)
+        for key in self.deleted:
+            flat.pop(key, None)
+        flat.update(self.overlay)
+        return flat
+
+    def update_from(self, flat):
+        """
+        Puts the values of a flattened copy that safe_exec changed into the
+        overlay.
+        """
+        for key, value in flat.iteritems():
+            if key in self.overlay or key not in self.base or value is not self.base[key]:
+                self[key] = value
+
+    @property
+    def base_hash(self):
+        """
+        A hash that tells bases apart. For a problem's context, one with
+        script_code, it is a hash of the script and what it ran with (the
+        SCRIPT_INPUTS and extra files), which is much cheaper than hashing
+        everything the script made; the script gives the same context for
+        the same inputs, as safe_exec's cache also takes it to. For any
+        other base, it is a hash of its JSON.
+        """
+        if self._base_hash is None:
+            if 'script_code' in self.base:
+                digest = hashlib.sha1(json.dumps([self.base.get(name) for name in SCRIPT_INPUTS]))
+                for name, content in self.base.get('extra_files') or []:
+                    digest.update(name.encode('utf-8') + b'\0' + content + b'\0')
+            else:
+                digest = hashlib.sha1(json.dumps(json_safe(self.base), sort_keys=True))
+            self._base_hash = digest.hexdigest()
+        return self._base_hash
+
+    @property
+    def base_json(self):
+        """
+        The JSON of the base's entries that can be sent to a sandbox, with
+        each entry serialized only once.
+        """
+        if self._base_json is None:
+            entries = []
+            for name, value in self.base.iteritems():
+                try:
+                    entries.append(json.dumps(name) + ': ' + json.dumps(value))
+                except (TypeError, ValueError):
+                    continue
+            self._base_json = '{' + ', '.join(entries) + '}'
+        return self._base_json
+
+#-----------------------------------------------------------------------------
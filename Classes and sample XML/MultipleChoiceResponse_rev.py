@@ -1,6 +1,126 @@
 #-----------------------------------------------------------------------------
 
 
+# Choice orders picked by shuffle and answer-pool, shared by all problem instances:
+# (seed, earlier uses of the problem's shared rng, choicegroup layout)
+#     -> (indices of the choices shown, in order; draws made from the shared rng)
+# Set the size to 0 to always draw.
+CHOICE_ORDER_CACHE = {}
+CHOICE_ORDER_CACHE_SIZE = 2000
+
+
+class RecordingRandom(random.Random):
+    """
+    A random.Random that can note the draws made from it (0 for a random(),
+    k for a getrandbits(k)), so that another generator in the same state
+    can be moved forward the same way by replaying them.
+    """
+    draws = None
+
+    def random(self):
+        if self.draws is not None:
+            self.draws.append(0)
+        return random.Random.random(self)
+
+    def getrandbits(self, k):
+        if self.draws is not None:
+            self.draws.append(k)
+        return random.Random.getrandbits(self, k)
+
+    def replay(self, draws):
+        """
+        Makes the given draws, without noting them.
+        """
+        for k in draws:
+            if k:
+                random.Random.getrandbits(self, k)
+            else:
+                random.Random.random(self)
+
+
+# The shuffle and answer-pool draws, kept apart from the response class so
+# that tools/answer_pool_simulator.py runs exactly the same code.
+
+def shuffle_choice_list(choices, rng):
+    """
+    Returns a list of choice nodes with the shuffling done,
+    using the provided random number generator.
+    Choices with 'fixed'='true' are held back from the shuffle.
+    """
+    # Separate out a list of the stuff to be shuffled
+    # vs. the head/tail of fixed==true choices to be held back from the shuffle.
+    # Rare corner case: A fixed==true choice "island" in the middle is lumped in
+    # with the tail group of fixed choices.
+    # Slightly tricky one-pass implementation using a state machine
+    head = []
+    middle = []  # only this one gets shuffled
+    tail = []
+    at_head = True
+    for choice in choices:
+        if at_head and choice.get('fixed') == 'true':
+            head.append(choice)
+            continue
+        at_head = False
+        if choice.get('fixed') == 'true':
+            tail.append(choice)
+        else:
+            middle.append(choice)
+    rng.shuffle(middle)
+    return head + middle + tail
+
+
+def sample_choice_list(choices, rng, num_pool):
+    """
+    Takes in:
+        1. list of choices
+        2. random number generator
+        3. the requested size "answer-pool" number, in effect a max
+
+    Returns a tuple with 2 items:
+        1. the solution_id corresponding with the chosen correct answer
+        2. (subset) list of choice nodes with num-1 incorrect and 1 correct
+
+    Raises ValueError if the number of correct or incorrect choices is 0.
+    """
+
+    correct_choices = []
+    incorrect_choices = []
+
+    for choice in choices:
+        if choice.get('correct') == 'true':
+            correct_choices.append(choice)
+        else:
+            incorrect_choices.append(choice)
+            # In my small test, capa seems to treat the absence of any correct=
+            # attribute as equivalent to ="false", so that's what we do here.
+
+    # We raise an error if the problem is highly ill-formed.
+    # There must be at least one correct and one incorrect choice.
+    # IDEA: perhaps this sort semantic-lint constraint should be generalized to all multichoice
+    # not just down in this corner when answer-pool is used.
+    # Or perhaps in the overall author workflow, these errors are unhelpful and
+    # should all be removed.
+    if len(correct_choices) < 1 or len(incorrect_choices) < 1:
+        raise ValueError("Choicegroup must include at least 1 correct and 1 incorrect choice")
+
+    # Limit the number of incorrect choices to what we actually have
+    num_incorrect = num_pool - 1
+    num_incorrect = min(num_incorrect, len(incorrect_choices))
+
+    # Select the one correct choice
+    index = rng.randint(0, len(correct_choices) - 1)
+    correct_choice = correct_choices[index]
+    solution_id = correct_choice.get('explanation-id')
+
+    # Put together the result, pushing most of the work onto rng.shuffle()
+    subset_choices = [correct_choice]
+    rng.shuffle(incorrect_choices)
+    subset_choices += incorrect_choices[:num_incorrect]
+    rng.shuffle(subset_choices)
+
+    return (solution_id, subset_choices)
+
+
 @registry.register
 class MultipleChoiceResponse(LoncapaResponse):
     """
@@ -29,31 +149,44 @@ class MultipleChoiceResponse(LoncapaResponse):
     has_responsive_ui = True
 
     def setup_response(self):
+        # Partial credit type - can set 'points' only at the moment.
+        try:
+            self.partial_credit = PartialCreditPolicy.from_xml(self.xml, ['points'])
+        except ValueError:
+            _ = self.capa_system.i18n.ugettext
+            # Translators: 'partial_credit' is an attribute name and should not be translated.
+            # 'points' should also not be translated.
+            msg = _("partial_credit value can only be set to 'points' or be removed.")
+            raise LoncapaProblemError(msg)
+
         # call secondary setup for MultipleChoice questions, to set name
         # attributes
         self.mc_setup_response()
 
         # define correct choices (after calling secondary setup)
-        xml = self.xml
-        cxml = xml.xpath('//*[@id=$id]//choice', id=xml.get('id'))
-
-        # contextualize correct attribute and then select ones for which
-        # correct = "true"
-        self.correct_choices = [
-            contextualize_text(choice.get('name'), self.context)
-            for choice in cxml
-            if contextualize_text(choice.get('correct'), self.context) == 'true'
-        ]
-        self.partial_choices = [
-            contextualize_text(choice.get('name'), self.context)
-            for choice in cxml
-            if contextualize_text(choice.get('correct'), self.context) == 'partial'
-        ]
-        self.partial_values = [
-            float(choice.get('point_value', default='0.5'))    # Default partial credit: 50%
-            for choice in cxml
-            if contextualize_text(choice.get('correct'), self.context) == 'partial'
-        ]
+        cxml = ResponseElementIndex(self.xml).find_all('choice')
+
+        # contextualize the correct attribute of each choice once, and sort
+        # the choices into correct = "true" and correct = "partial"
+        self.correct_choices = []
+        self.partial_choices = []
+        self.partial_values = []
+        for choice in cxml:
+            correctness = contextualize_text(choice.get('correct'), self.context)
+            if correctness == 'true':
+                self.correct_choices.append(contextualize_text(choice.get('name'), self.context))
+            elif correctness == 'partial':
+                self.partial_choices.append(contextualize_text(choice.get('name'), self.context))
+                self.partial_values.append(float(choice.get('point_value', default='0.5')))  # Default partial credit: 50%
+
+        # What each choice that earns anything is worth, for get_score to look
+        # up: choice name -> (correctness, npoints). Built once; treat as read-only.
+        self.choice_outcomes = {}
+        if 'points' in self.partial_credit.schemes:
+            for name, value in zip(self.partial_choices, self.partial_values):
+                self.choice_outcomes.setdefault(name, ('partially-correct', value))
+        for name in self.correct_choices:
+            self.choice_outcomes[name] = ('correct', None)
 
     def mc_setup_response(self):
         """
@@ -101,36 +234,18 @@ class MultipleChoiceResponse(LoncapaResponse):
         # log.debug('%s: student_answers=%s, correct_choices=%s' % (
         #   unicode(self), student_answers, self.correct_choices))
 
-        tree = self.xml
-        problem_xml = tree.xpath('.')
-
-        # Partial credit type - can set 'points' only at the moment.
-        credit_type = problem_xml[0].get('partial_credit', default=False)
-
-        try:
-            credit_type = str(credit_type).lower().strip()
-        except ValueError:
-            _ = self.capa_system.i18n.ugettext
-            # Translators: 'partial_credit' is an attribute name and should not be translated.
-            # 'points' should also not be translated.
-            msg = _("partial_credit value can only be set to 'points' or be removed.")
-            raise LoncapaProblemError(msg)
-
-        if (self.answer_id in student_answers
-                and student_answers[self.answer_id] in self.correct_choices):
-            return CorrectMap(self.answer_id, correctness='correct')
-
-        elif (
-                credit_type == 'points'
-                and self.answer_id in student_answers
-                and student_answers[self.answer_id] in self.partial_choices
-        ):
-            choice_index = self.partial_choices.index(student_answers[self.answer_id])
-            credit_amount = self.partial_values[choice_index]
-            return CorrectMap(self.answer_id, correctness='partially-correct', npoints=credit_amount)
+        outcome = None
+        if self.answer_id in student_answers:
+            try:
+                outcome = self.choice_outcomes.get(student_answers[self.answer_id])
+            except TypeError:
+                # Not a string (e.g. a list), so it can't be one of the choices.
+                pass
 
-        else:
+        if outcome is None:
             return CorrectMap(self.answer_id, 'incorrect')
+        correctness, npoints = outcome
+        return CorrectMap(self.answer_id, correctness=correctness, npoints=npoints)
 
     def get_answers(self):
         return {self.answer_id: self.correct_choices}
@@ -181,10 +296,12 @@ class MultipleChoiceResponse(LoncapaResponse):
                 return
             self._has_shuffle = True  # pylint: disable=attribute-defined-outside-init
             # Move elements from tree to list for shuffling, then put them back.
-            ordering = list(choicegroup.getchildren())
-            for choice in ordering:
+            choices = list(choicegroup.getchildren())
+            for choice in choices:
                 choicegroup.remove(choice)
-            ordering = self.shuffle_choices(ordering, self.get_rng(problem))
+            # The order only depends on which choices are fixed.
+            layout = (self.__class__, 'shuffle', tuple(choice.get('fixed') == 'true' for choice in choices))
+            ordering = self.get_choice_order(problem, layout, choices, lambda rng: self.shuffle_choices(choices, rng))
             for choice in ordering:
                 choicegroup.append(choice)
 
@@ -194,26 +311,7 @@ class MultipleChoiceResponse(LoncapaResponse):
         using the provided random number generator.
         Choices with 'fixed'='true' are held back from the shuffle.
         """
-        # Separate out a list of the stuff to be shuffled
-        # vs. the head/tail of fixed==true choices to be held back from the shuffle.
-        # Rare corner case: A fixed==true choice "island" in the middle is lumped in
-        # with the tail group of fixed choices.
-        # Slightly tricky one-pass implementation using a state machine
-        head = []
-        middle = []  # only this one gets shuffled
-        tail = []
-        at_head = True
-        for choice in choices:
-            if at_head and choice.get('fixed') == 'true':
-                head.append(choice)
-                continue
-            at_head = False
-            if choice.get('fixed') == 'true':
-                tail.append(choice)
-            else:
-                middle.append(choice)
-        rng.shuffle(middle)
-        return head + middle + tail
+        return shuffle_choice_list(choices, rng)
 
     def get_rng(self, problem):
         """
@@ -229,9 +327,56 @@ class MultipleChoiceResponse(LoncapaResponse):
         # for general use.
         # pylint: disable=protected-access
         if not hasattr(problem, '_shared_rng'):
-            problem._shared_rng = random.Random(self.context['seed'])
+            problem._shared_rng = RecordingRandom(self.context['seed'])
+        # Catch up on any draws that get_choice_order took from its cache.
+        if getattr(problem, '_shared_rng_draws', None):
+            problem._shared_rng.replay(problem._shared_rng_draws)
+            problem._shared_rng_draws = None
+        # Draws made by the caller aren't recorded, so later choice orders
+        # can't be looked up in the cache for this problem instance.
+        problem._shared_rng_history = None
         return problem._shared_rng
 
+    def get_choice_order(self, problem, layout, choices, pick):
+        """
+        Returns the choices to show, in order, as `pick(rng)` chooses them from
+        `choices` with the problem's shared random number generator.
+
+        The result only depends on the seed, on what was drawn from the shared
+        rng before, and on the `layout` of the choicegroup, so it is cached
+        under those as a list of indices, along with the draws `pick` made. A
+        problem loaded again with the same seed then puts its choices in the
+        same order without shuffling, and only makes the draws again if
+        something else uses the shared rng afterwards.
+        """
+        # pylint: disable=protected-access
+        history = getattr(problem, '_shared_rng_history', ())
+        if history is None or not CHOICE_ORDER_CACHE_SIZE:
+            key = None
+        else:
+            key = (self.context['seed'], history, layout)
+
+        cached = CHOICE_ORDER_CACHE.get(key) if key is not None else None
+        if cached is not None:
+            order, draws = cached
+            problem._shared_rng_draws = (getattr(problem, '_shared_rng_draws', None) or ()) + draws
+        else:
+            rng = self.get_rng(problem)
+            positions = dict((id(choice), index) for index, choice in enumerate(choices))
+            recording = key is not None and isinstance(rng, RecordingRandom)
+            if recording:
+                rng.draws = []
+            order = tuple(positions[id(choice)] for choice in pick(rng))
+            if recording:
+                draws, rng.draws = tuple(rng.draws), None
+                if len(CHOICE_ORDER_CACHE) >= CHOICE_ORDER_CACHE_SIZE:
+                    CHOICE_ORDER_CACHE.clear()
+                CHOICE_ORDER_CACHE[key] = (order, draws)
+
+        if history is not None:
+            problem._shared_rng_history = history + (layout,)
+        return [choices[index] for index in order]
+
     def do_answer_pool(self, tree, problem):
         """
         Implements the answer-pool subsetting operation in-place on the tree.
@@ -271,9 +416,17 @@ class MultipleChoiceResponse(LoncapaResponse):
             for choice in choices_list:
                 choicegroup.remove(choice)
 
-            rng = self.get_rng(problem)  # random number generator to use
-            # Sample from the answer pool to get the subset choices and solution id
-            (solution_id, subset_choices) = self.sample_from_answer_pool(choices_list, rng, num_choices)
+            # Sample from the answer pool to get the subset choices and solution id.
+            # The sample only depends on the pool size and which choices are correct.
+            layout = (
+                self.__class__, 'answer-pool', num_choices,
+                tuple(choice.get('correct') == 'true' for choice in choices_list)
+            )
+            subset_choices = self.get_choice_order(
+                problem, layout, choices_list,
+                lambda rng: self.sample_from_answer_pool(choices_list, rng, num_choices)[1]
+            )
+            solution_id = [choice for choice in subset_choices if choice.get('correct') == 'true'][0].get('explanation-id')
 
             # Add back in randomly selected choices
             for choice in subset_choices:
@@ -291,58 +444,19 @@ class MultipleChoiceResponse(LoncapaResponse):
 
     def sample_from_answer_pool(self, choices, rng, num_pool):
         """
-        Takes in:
-            1. list of choices
-            2. random number generator
-            3. the requested size "answer-pool" number, in effect a max
-
-        Returns a tuple with 2 items:
-            1. the solution_id corresponding with the chosen correct answer
-            2. (subset) list of choice nodes with num-1 incorrect and 1 correct
-
-        Raises an error if the number of correct or incorrect choices is 0.
+        Returns a tuple (solution_id, subset list of choice nodes), as
+        sample_choice_list does.
+        Raises LoncapaProblemError if the number of correct or incorrect
+        choices is 0.
         """
-
-        correct_choices = []
-        incorrect_choices = []
-
-        for choice in choices:
-            if choice.get('correct') == 'true':
-                correct_choices.append(choice)
-            else:
-                incorrect_choices.append(choice)
-                # In my small test, capa seems to treat the absence of any correct=
-                # attribute as equivalent to ="false", so that's what we do here.
-
-        # We raise an error if the problem is highly ill-formed.
-        # There must be at least one correct and one incorrect choice.
-        # IDEA: perhaps this sort semantic-lint constraint should be generalized to all multichoice
-        # not just down in this corner when answer-pool is used.
-        # Or perhaps in the overall author workflow, these errors are unhelpful and
-        # should all be removed.
-        if len(correct_choices) < 1 or len(incorrect_choices) < 1:
+        try:
+            return sample_choice_list(choices, rng, num_pool)
+        except ValueError:
             _ = self.capa_system.i18n.ugettext
             # Translators: 'Choicegroup' is an input type and should not be translated.
             msg = _("Choicegroup must include at least 1 correct and 1 incorrect choice")
             raise LoncapaProblemError(msg)
 
-        # Limit the number of incorrect choices to what we actually have
-        num_incorrect = num_pool - 1
-        num_incorrect = min(num_incorrect, len(incorrect_choices))
-
-        # Select the one correct choice
-        index = rng.randint(0, len(correct_choices) - 1)
-        correct_choice = correct_choices[index]
-        solution_id = correct_choice.get('explanation-id')
-
-        # Put together the result, pushing most of the work onto rng.shuffle()
-        subset_choices = [correct_choice]
-        rng.shuffle(incorrect_choices)
-        subset_choices += incorrect_choices[:num_incorrect]
-        rng.shuffle(subset_choices)
-
-        return (solution_id, subset_choices)
-
 
 @registry.register
 class TrueFalseResponse(MultipleChoiceResponse):
@@ -1,5 +1,276 @@
 #-----------------------------------------------------------------------------
 
+from bisect import bisect_left
+from collections import OrderedDict
+import threading
+
+
+# Plain int/float/scientific literals, optionally times a power of ten
+# ("42", "-3.5", "6.02e23", "1.5*10^8"): what most students actually submit.
+_NUMERIC_LITERAL = re.compile(
+    r'^\s*(?P<sign>[+-]?)\s*(?P<mantissa>(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?)'
+    r'(?:\s*\*\s*10\s*\^\s*(?P<exponent>[+-]?\d+))?\s*$'
+)
+
+
+def parse_numeric_literal(expression):
+    """
+    Returns the value of `expression` if it is a plain numeric literal, the
+    same float `evaluator` would give. Returns None for anything else,
+    including literals that overflow, so the caller falls back to `evaluator`.
+    """
+    match = _NUMERIC_LITERAL.match(expression)
+    if match is None:
+        return None
+
+    value = float(match.group('mantissa'))
+    if match.group('exponent') is not None:
+        try:
+            value = value * 10.0 ** float(match.group('exponent'))
+        except OverflowError:
+            return None
+    if abs(value) == float('inf'):
+        return None
+    return -value if match.group('sign') == '-' else value
+
+
+class ExpressionCache(object):
+    """
+    A bounded, thread-safe LRU cache of evaluated student expressions.
+
+    Maps an expression string (with surrounding whitespace stripped) to what
+    `evaluator` made of it: either the value, or the exception it raised.
+    Errors are stored as the raw exception, not as a message, so callers still
+    build the message for each student in that student's language.
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def evaluate(self, expression):
+        """
+        Returns evaluator({}, {}, expression), or raises what it raised,
+        using the cached outcome when there is one.
+        Plain numeric literals are parsed directly and never cached.
+        """
+        value = parse_numeric_literal(expression)
+        if value is not None:
+            return value
+
+        key = expression.strip()
+        with self._lock:
+            outcome = self._entries.pop(key, None)
+            if outcome is not None:
+                self.hits += 1
+                self._entries[key] = outcome
+            else:
+                self.misses += 1
+
+        if outcome is None:
+            try:
+                outcome = (True, evaluator({}, {}, expression))
+            except Exception as err:  # pylint: disable=broad-except
+                outcome = (False, err)
+            with self._lock:
+                if self.maxsize > 0:
+                    self._entries[key] = outcome
+                    while len(self._entries) > self.maxsize:
+                        self._entries.popitem(last=False)
+
+        succeeded, result = outcome
+        if not succeeded:
+            raise result
+        return result
+
+    def resize(self, maxsize):
+        """
+        Changes the number of expressions kept, dropping the least recently
+        used ones if needed. A size of 0 turns caching off.
+        """
+        with self._lock:
+            self.maxsize = maxsize
+            while len(self._entries) > max(maxsize, 0):
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        """
+        Empties the cache and resets the hit and miss counters.
+        """
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.misses = 0
+
+    def info(self):
+        """
+        Returns a dict of the hits, misses, maxsize and current size.
+        """
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'maxsize': self.maxsize,
+                'currsize': len(self._entries),
+            }
+
+
+# Shared by all numerical responses in the process: thousands of students
+# submit the same handful of strings.
+NUMERICAL_EXPRESSION_CACHE = ExpressionCache(maxsize=10000)
+
+
+def _evaluate_tolerance(tolerance):
+    """
+    Returns the value of a tolerance string (without any '%').
+    Plain numbers skip the full evaluator.
+    """
+    try:
+        return float(tolerance)
+    except ValueError:
+        return evaluator(dict(), dict(), tolerance)
+
+
+class ToleranceWindow(namedtuple('ToleranceWindow', ['center', 'tolerance', 'relative'])):
+    """
+    A staff answer together with its tolerance, already evaluated into the
+    numeric form compare_with_tolerance takes.
+    """
+    __slots__ = ()
+
+    @classmethod
+    def compile(cls, center, tolerance):
+        """
+        `tolerance` is either a number, or a string in the form the tolerance
+        responseparam uses: a number or a percentage of the staff answer.
+        A string equal to the default tolerance is relative to the larger of
+        the two answers being compared, as in compare_with_tolerance.
+        """
+        if not isinstance(tolerance, basestring):
+            return cls(center, tolerance, False)
+
+        relative = tolerance == default_tolerance
+        if tolerance.endswith('%'):
+            value = _evaluate_tolerance(tolerance[:-1]) * 0.01
+            if not relative:
+                value = value * abs(center)
+        else:
+            value = _evaluate_tolerance(tolerance)
+        return cls(center, value, relative)
+
+    def contains(self, value):
+        """
+        Returns whether `value` is within tolerance of the staff answer.
+        """
+        return compare_with_tolerance(value, self.center, self.tolerance, relative_tolerance=self.relative)
+
+    def contains_array(self, values):
+        """
+        `contains` for each element of a numpy array of finite real numbers.
+        Only for windows that have bounds().
+        """
+        center = self.center.real
+        tolerance = self.tolerance.real
+        if self.relative:
+            tolerance = tolerance * numpy.maximum(numpy.abs(values), abs(center))
+        return numpy.abs(values - center) <= tolerance
+
+    def bounds(self):
+        """
+        Returns (low, high) such that every real number `contains` accepts is
+        between them, widened a little to allow for rounding. Returns None if
+        the window isn't an interval of the real line (complex, infinite or nan
+        answer or tolerance).
+        """
+        center, tolerance = self.center, self.tolerance
+        if isinstance(center, complex) and center.imag == 0:
+            center = center.real
+        if isinstance(tolerance, complex) and tolerance.imag == 0:
+            tolerance = tolerance.real
+        if not (_is_finite_real(center) and _is_finite_real(tolerance)):
+            return None
+
+        tolerance = abs(tolerance)
+        if self.relative:
+            # |x - c| <= t * max(|x|, |c|) implies |x - c| <= t * |c| / (1 - t)
+            if tolerance >= 1:
+                return (float('-inf'), float('inf'))
+            half_width = tolerance * abs(center) / (1 - tolerance)
+        else:
+            half_width = tolerance
+        half_width += 1e-9 * (abs(center) + half_width)
+        return (center - half_width, center + half_width)
+
+
+def _is_finite_real(value):
+    """
+    Returns whether `value` is a real number other than inf or nan.
+    """
+    return not isinstance(value, complex) and not isnan(value) and abs(value) != float('inf')
+
+
+class PartialAnswerIndex(object):
+    """
+    Finds the alternative answers a real number could be within tolerance of,
+    by binary search over the endpoints of their tolerance windows instead of
+    a comparison against every one of them.
+
+    The real line is cut at every endpoint, and for each endpoint and each gap
+    between two endpoints we store which intervals cover it. The intervals are
+    a little wider than the windows they come from, so the candidates still
+    have to be confirmed with ToleranceWindow.contains.
+    """
+
+    def __init__(self, intervals):
+        """
+        `intervals` is a list of (low, high) bounds, one per alternative answer.
+        """
+        inf = float('inf')
+        self._points = sorted(set(bound for interval in intervals for bound in interval if abs(bound) != inf))
+        self._at_point = [
+            tuple(i for i, (low, high) in enumerate(intervals) if low <= point <= high)
+            for point in self._points
+        ]
+        gaps = zip([-inf] + self._points, self._points + [inf])
+        self._in_gap = [
+            tuple(i for i, (low, high) in enumerate(intervals) if low <= left and right <= high)
+            for left, right in gaps
+        ]
+
+    def candidates(self, value):
+        """
+        Returns the indices, in ascending order, of the intervals containing
+        the finite real number `value`.
+        """
+        position = bisect_left(self._points, value)
+        if position < len(self._points) and self._points[position] == value:
+            return self._at_point[position]
+        return self._in_gap[position]
+
+
+# Staff-side values of a numerical response, computed once per seed:
+#  correct: ToleranceWindow around the staff answer (None for range answers)
+#  close: the same with the expanded "close" tolerance (None without partial credit)
+#  partial_answers: (ToleranceWindow, expanded ToleranceWindow or None) per alternative answer
+#  partial_answer_index: PartialAnswerIndex over partial_answers (None if not needed or not possible)
+#  boundaries, extended_boundaries: real endpoints for range answers (None otherwise)
+class CompiledStaffAnswers(namedtuple('CompiledStaffAnswers', [
+        'seed', 'correct', 'close', 'partial_answers', 'partial_answer_index', 'boundaries', 'extended_boundaries'
+])):
+    __slots__ = ()
+
+    def partial_answer_candidates(self, value):
+        """
+        Returns the (window, expanded window) pairs of the alternative answers
+        that `value` might match, in the order staff listed them. Without an
+        index, or for complex, infinite or nan values, that is all of them.
+        """
+        if self.partial_answer_index is None or not _is_finite_real(value):
+            return self.partial_answers
+        return [self.partial_answers[i] for i in self.partial_answer_index.candidates(value)]
+
 
 @registry.register
 class NumericalResponse(LoncapaResponse):
@@ -21,6 +292,7 @@ class NumericalResponse(LoncapaResponse):
         self.tolerance = default_tolerance
         self.range_tolerance = False
         self.answer_range = self.inclusion = None
+        self._compiled_staff_answers = None
         super(NumericalResponse, self).__init__(*args, **kwargs)
 
     def setup_response(self):
@@ -28,6 +300,31 @@ class NumericalResponse(LoncapaResponse):
         context = self.context
         answer = xml.get('answer')
 
+        # Make sure we're using an approved partial credit style.
+        # Currently implemented: 'close' and 'list'
+        graders = ['list', 'close']
+        try:
+            self.partial_credit = PartialCreditPolicy.from_xml(xml, graders, max_schemes=len(graders))
+        except ValueError:
+            raise LoncapaProblemError('partial_credit attribute should be one of: ' + ','.join(graders))
+
+        # What multiple of the tolerance is worth partial credit?
+        has_partial_range = xml.xpath('responseparam[@partial_range]')
+        if has_partial_range:
+            try:
+                partial_range = float(has_partial_range[0].get('partial_range', default='2'))
+            except ValueError:
+                raise LoncapaProblemError('partial_range should be a number')
+            self.partial_credit = self.partial_credit._replace(partial_range=partial_range)
+
+        # Take in alternative answers that are worth partial credit.
+        has_partial_answers = xml.xpath('responseparam[@partial_answers]')
+        if has_partial_answers:
+            partial_answers = has_partial_answers[0].get('partial_answers').split(',')
+            self.partial_credit = self.partial_credit._replace(
+                partial_answers=tuple(word.strip() for word in partial_answers)
+            )
+
         if answer.startswith(('[', '(')) and answer.endswith((']', ')')):  # range tolerance case
             self.range_tolerance = True
             self.inclusion = (
@@ -46,10 +343,11 @@ class NumericalResponse(LoncapaResponse):
             self.correct_answer = contextualize_text(answer, context)
 
             # Find the tolerance
-            tolerance_xml = xml.xpath(
-                '//*[@id=$id]//responseparam[@type="tolerance"]/@default',
-                id=xml.get('id')
-            )
+            tolerance_xml = [
+                param.get('default')
+                for param in ResponseElementIndex(xml).find_all('responseparam', type='tolerance')
+                if param.get('default') is not None
+            ]
             if tolerance_xml:  # If it isn't an empty list...
                 self.tolerance = contextualize_text(tolerance_xml[0], context)
 
@@ -84,14 +382,6 @@ class NumericalResponse(LoncapaResponse):
         if self.answer_id not in student_answers:
             return CorrectMap(self.answer_id, 'incorrect')
 
-        # Make sure we're using an approved partial credit style.
-        # Currently implemented: 'close' and 'list'
-        if self.has_partial_credit:
-            graders = ['list','close']
-            for style in self.credit_type:
-                if style not in graders:
-                    raise LoncapaProblemError('partial_credit attribute should be one of: ' + ','.join(graders))
-
         student_answer = student_answers[self.answer_id]
 
         _ = self.capa_system.i18n.ugettext
@@ -102,7 +392,7 @@ class NumericalResponse(LoncapaResponse):
         # Begin `evaluator` block
         # Catch a bunch of exceptions and give nicer messages to the student.
         try:
-            student_float = evaluator({}, {}, student_answer)
+            student_float = NUMERICAL_EXPRESSION_CACHE.evaluate(student_answer)
         except UndefinedVariable as undef_var:
             raise StudentInputError(
                 _(u"You may not use variables ({bad_variables}) in numerical problems.").format(bad_variables=undef_var.message)
@@ -127,26 +417,14 @@ class NumericalResponse(LoncapaResponse):
             raise general_exception
         # End `evaluator` block -- we figured out the student's answer!
 
-        tree = self.xml
-        problem_xml = tree.xpath('.')
-
-        # What multiple of the tolerance is worth partial credit?
-        has_partial_range = tree.xpath('responseparam[@partial_range]')
-        if has_partial_range:
-            partial_range = float(has_partial_range[0].get('partial_range', default='2'))
-        else:
-            partial_range = 2
+        return self.grade_value(student_float)
 
-        # Take in alternative answers that are worth partial credit.
-        has_partial_answers = tree.xpath('responseparam[@partial_answers]')
-        if has_partial_answers:
-            partial_answers = has_partial_answers[0].get('partial_answers').split(',')
-            for index, word in enumerate(partial_answers):
-                partial_answers[index] = word.strip()
-                partial_answers[index] = self.get_staff_ans(partial_answers[index])
-
-        else:
-            partial_answers = False
+    def grade_value(self, student_float):
+        """
+        Grades a student answer that has already been evaluated to a number.
+        """
+        _ = self.capa_system.i18n.ugettext
+        credit_type = self.partial_credit.schemes
 
         partial_score = 0.5
         is_correct = 'incorrect'
@@ -154,18 +432,9 @@ class NumericalResponse(LoncapaResponse):
         if self.range_tolerance:
             if isinstance(student_float, complex):
                 raise StudentInputError(_(u"You may not use complex numbers in range tolerance problems"))
-            boundaries = []
-            for inclusion, answer in zip(self.inclusion, self.answer_range):
-                boundary = self.get_staff_ans(answer)
-                if boundary.imag != 0:
-                    # Translators: This is an error message for a math problem. If the instructor provided a boundary
-                    # (end limit) for a variable that is a complex number (a + bi), this message displays.
-                    raise StudentInputError(_("There was a problem with the staff answer to this problem: complex boundary."))
-                if isnan(boundary):
-                    # Translators: This is an error message for a math problem. If the instructor did not provide
-                    # a boundary (end limit) for a variable, this message displays.
-                    raise StudentInputError(_("There was a problem with the staff answer to this problem: empty boundary."))
-                boundaries.append(boundary.real)
+            staff_answers = self.get_compiled_staff_answers()
+            boundaries = staff_answers.boundaries
+            for inclusion, boundary in zip(self.inclusion, boundaries):
                 if compare_with_tolerance(
                         student_float,
                         boundary,
@@ -178,21 +447,17 @@ class NumericalResponse(LoncapaResponse):
                 if boundaries[0] < student_float < boundaries[1]:
                     is_correct = 'correct'
                 else:
-                    if self.has_partial_credit is False:
+                    if not credit_type:
                         pass
-                    elif 'close' in self.credit_type:
+                    elif 'close' in credit_type:
                         # Partial credit: 50% if the student is outside the specified boundaries,
                         # but within an extended set of boundaries.
-
-                        extended_boundaries = []
-                        boundary_range = boundaries[1] - boundaries[0]
-                        extended_boundaries.append(boundaries[0] - partial_range * boundary_range)
-                        extended_boundaries.append(boundaries[1] + partial_range * boundary_range)
+                        extended_boundaries = staff_answers.extended_boundaries
                         if extended_boundaries[0] < student_float < extended_boundaries[1]:
                             is_correct = 'partially-correct'
 
         else:
-            correct_float = self.get_staff_ans(self.correct_answer)
+            staff_answers = self.get_compiled_staff_answers()
 
             # Partial credit is available in three cases:
             #  If the student answer is within expanded tolerance of the actual answer,
@@ -207,30 +472,27 @@ class NumericalResponse(LoncapaResponse):
             #  the student gets 25%. (We take the 50% and square it, at the moment.)
             #  Set via partial_credit="list,close" or "close, list" or the like.
 
-            if str(self.tolerance).endswith('%'):
-                expanded_tolerance = str(partial_range * float(str(self.tolerance)[:-1])) + '%'
-            else:
-                expanded_tolerance = partial_range * float(self.tolerance)
-
-            if compare_with_tolerance(student_float, correct_float, self.tolerance):
+            if staff_answers.correct.contains(student_float):
                 is_correct = 'correct'
-            elif self.has_partial_credit is False:
+            elif not credit_type:
                 pass
-            elif 'list' in self.credit_type:
-                for value in partial_answers:
-                    if compare_with_tolerance(student_float, value, self.tolerance):
-                        is_correct = 'partially-correct'
-                        break
-                    elif 'close' in self.credit_type:
-                        if compare_with_tolerance(student_float, correct_float, expanded_tolerance):
+            elif 'list' in credit_type:
+                # Being close to the main answer doesn't depend on the
+                # alternative answers, so it's checked once, up front.
+                if ('close' in credit_type and staff_answers.partial_answers and
+                        staff_answers.close.contains(student_float)):
+                    is_correct = 'partially-correct'
+                else:
+                    for window, expanded_window in staff_answers.partial_answer_candidates(student_float):
+                        if window.contains(student_float):
                             is_correct = 'partially-correct'
                             break
-                        elif compare_with_tolerance(student_float, value, expanded_tolerance):
+                        elif 'close' in credit_type and expanded_window.contains(student_float):
                             is_correct = 'partially-correct'
                             partial_score = partial_score * partial_score
                             break
-            elif 'close' in self.credit_type:
-                if compare_with_tolerance(student_float, correct_float, expanded_tolerance):
+            elif 'close' in credit_type:
+                if staff_answers.close.contains(student_float):
                     is_correct = 'partially-correct'
 
         if is_correct == 'partially-correct':
@@ -238,14 +500,227 @@ class NumericalResponse(LoncapaResponse):
         else:
             return CorrectMap(self.answer_id, is_correct)
 
+    def get_compiled_staff_answers(self):
+        """
+        Evaluates the staff answer, the alternative partial-credit answers and
+        the tolerances into the values get_score compares against.
+
+        None of this depends on the student, so it is done on the first
+        submission and cached on the response. Randomized problems keep the
+        result only for the seed it was computed with.
+        """
+        seed = self.context.get('seed')
+        if self._compiled_staff_answers is not None and self._compiled_staff_answers.seed == seed:
+            return self._compiled_staff_answers
+
+        _ = self.capa_system.i18n.ugettext
+        partial_range = self.partial_credit.partial_range
+
+        if self.range_tolerance:
+            boundaries = []
+            for answer in self.answer_range:
+                boundary = self.get_staff_ans(answer)
+                if boundary.imag != 0:
+                    # Translators: This is an error message for a math problem. If the instructor provided a boundary
+                    # (end limit) for a variable that is a complex number (a + bi), this message displays.
+                    raise StudentInputError(_("There was a problem with the staff answer to this problem: complex boundary."))
+                if isnan(boundary):
+                    # Translators: This is an error message for a math problem. If the instructor did not provide
+                    # a boundary (end limit) for a variable, this message displays.
+                    raise StudentInputError(_("There was a problem with the staff answer to this problem: empty boundary."))
+                boundaries.append(boundary.real)
+
+            boundary_range = boundaries[1] - boundaries[0]
+            extended_boundaries = (
+                boundaries[0] - partial_range * boundary_range,
+                boundaries[1] + partial_range * boundary_range,
+            )
+            compiled = CompiledStaffAnswers(
+                seed=seed,
+                correct=None,
+                close=None,
+                partial_answers=(),
+                partial_answer_index=None,
+                boundaries=tuple(boundaries),
+                extended_boundaries=extended_boundaries,
+            )
+
+        else:
+            correct_float = self.get_staff_ans(self.correct_answer)
+            partial_answers = [self.get_staff_ans(answer) for answer in self.partial_credit.partial_answers]
+
+            # The "close" tolerance is partial_range times the regular one.
+            expanded_tolerance = None
+            if self.partial_credit.schemes:
+                if str(self.tolerance).endswith('%'):
+                    expanded_tolerance = str(partial_range * float(str(self.tolerance)[:-1])) + '%'
+                else:
+                    expanded_tolerance = partial_range * float(self.tolerance)
+
+            def window(center, tolerance):
+                """ToleranceWindow.compile, or None without a tolerance."""
+                return ToleranceWindow.compile(center, tolerance) if tolerance is not None else None
+
+            partial_windows = tuple(
+                (window(value, self.tolerance), window(value, expanded_tolerance))
+                for value in partial_answers
+            )
+
+            compiled = CompiledStaffAnswers(
+                seed=seed,
+                correct=window(correct_float, self.tolerance),
+                close=window(correct_float, expanded_tolerance),
+                partial_answers=partial_windows,
+                partial_answer_index=self.index_partial_answers(partial_windows),
+                boundaries=None,
+                extended_boundaries=None,
+            )
+
+        self._compiled_staff_answers = compiled
+        return compiled
+
+    def grade_batch(self, values):
+        """
+        Grades many students' answers to this response at once, e.g. to
+        regrade a course after its tolerance or partial credit changes,
+        without evaluating the students' expressions again.
+
+        `values` is a sequence with one entry per student: the number the
+        student's answer evaluated to, or None if nothing was submitted.
+        Finite real numbers are graded together with numpy; anything else
+        goes through grade_value one at a time, and raises what it raises.
+
+        Returns a dict of numpy arrays with one element per value:
+            'correctness': 'correct', 'partially-correct' or 'incorrect'
+            'npoints': the points the matching CorrectMap would report
+        """
+        staff_answers = self.get_compiled_staff_answers()
+        credit_type = self.partial_credit.schemes
+
+        correctness = numpy.empty(len(values), dtype=object)
+        correctness[:] = 'incorrect'
+        npoints = numpy.zeros(len(values), dtype=float)
+
+        if self.is_batch_gradable(staff_answers):
+            is_vectorized = numpy.array(
+                [value is not None and _is_finite_real(value) for value in values], dtype=bool
+            )
+        else:
+            is_vectorized = numpy.zeros(len(values), dtype=bool)
+        student_floats = numpy.array(
+            [value if vectorized else 0.0 for value, vectorized in zip(values, is_vectorized)], dtype=float
+        )
+
+        # Partial credit is worth 0.5, or 0.25 when close to an alternative answer.
+        is_correct = numpy.zeros(len(values), dtype=bool)
+        is_half = numpy.zeros(len(values), dtype=bool)
+        is_quarter = numpy.zeros(len(values), dtype=bool)
+
+        if self.range_tolerance:
+            boundaries = staff_answers.boundaries
+            extended_boundaries = staff_answers.extended_boundaries
+            # Within float_info.epsilon (relative) of a boundary, as in grade_value.
+            at_boundary = [
+                numpy.abs(student_floats - boundary) <=
+                float_info.epsilon * numpy.maximum(numpy.abs(student_floats), abs(boundary))
+                for boundary in boundaries
+            ]
+            at_boundary[1] &= ~at_boundary[0]
+            inside = (boundaries[0] < student_floats) & (student_floats < boundaries[1])
+            elsewhere = ~at_boundary[0] & ~at_boundary[1]
+
+            for inclusion, at in zip(self.inclusion, at_boundary):
+                if inclusion:
+                    is_correct |= at
+            is_correct |= elsewhere & inside
+            if 'close' in credit_type:
+                is_half = elsewhere & ~inside & (
+                    (extended_boundaries[0] < student_floats) & (student_floats < extended_boundaries[1])
+                )
+
+        else:
+            is_correct = staff_answers.correct.contains_array(student_floats)
+            if not credit_type:
+                pass
+            elif 'list' in credit_type:
+                if staff_answers.partial_answers:
+                    if 'close' in credit_type:
+                        is_half = ~is_correct & staff_answers.close.contains_array(student_floats)
+                    # Each student gets the credit of the first alternative they match.
+                    unmatched = ~is_correct & ~is_half
+                    for window, expanded_window in staff_answers.partial_answers:
+                        matched = unmatched & window.contains_array(student_floats)
+                        is_half |= matched
+                        unmatched &= ~matched
+                        if 'close' in credit_type:
+                            matched = unmatched & expanded_window.contains_array(student_floats)
+                            is_quarter |= matched
+                            unmatched &= ~matched
+            elif 'close' in credit_type:
+                is_half = ~is_correct & staff_answers.close.contains_array(student_floats)
+
+        is_correct &= is_vectorized
+        is_half &= is_vectorized
+        is_quarter &= is_vectorized
+        correctness[is_correct] = 'correct'
+        correctness[is_half | is_quarter] = 'partially-correct'
+        npoints[is_correct] = 1
+        npoints[is_half] = 0.5
+        npoints[is_quarter] = 0.25
+
+        for row, value in enumerate(values):
+            if value is None or is_vectorized[row]:
+                continue
+            correct_map = self.grade_value(value)
+            correctness[row] = correct_map.get_correctness(self.answer_id)
+            npoints[row] = correct_map.get_npoints(self.answer_id)
+
+        return {'correctness': correctness, 'npoints': npoints}
+
+    def is_batch_gradable(self, staff_answers):
+        """
+        Returns whether grade_batch can compare against these staff answers
+        with numpy: all the answers, boundaries and tolerances it needs are
+        finite real numbers.
+        """
+        if self.range_tolerance:
+            return all(_is_finite_real(boundary) for boundary in staff_answers.boundaries)
+
+        windows = [staff_answers.correct]
+        if self.partial_credit.schemes:
+            windows.append(staff_answers.close)
+            for partial_windows in staff_answers.partial_answers:
+                windows.extend(partial_windows)
+        return all(window.bounds() is not None for window in windows)
+
+    def index_partial_answers(self, partial_windows):
+        """
+        Builds a PartialAnswerIndex over the windows of the alternative answers
+        that earn "list" credit: the regular window, and with "close" credit
+        also the expanded one. Returns None if there are no alternative
+        answers, or if any window isn't a real interval.
+        """
+        if 'list' not in self.partial_credit.schemes or not partial_windows:
+            return None
+
+        intervals = []
+        for windows in partial_windows:
+            if 'close' not in self.partial_credit.schemes:
+                windows = windows[:1]
+            bounds = [window.bounds() for window in windows]
+            if None in bounds:
+                return None
+            intervals.append((min(low for low, high in bounds), max(high for low, high in bounds)))
+        return PartialAnswerIndex(intervals)
+
     def compare_answer(self, ans1, ans2):
         """
         Outside-facing function that lets us compare two numerical answers,
         with this problem's tolerance.
         """
         return compare_with_tolerance(
-            evaluator({}, {}, ans1),
-            evaluator({}, {}, ans2),
+            NUMERICAL_EXPRESSION_CACHE.evaluate(ans1),
+            NUMERICAL_EXPRESSION_CACHE.evaluate(ans2),
             self.tolerance
         )
 
@@ -254,7 +729,7 @@ class NumericalResponse(LoncapaResponse):
         Returns whether this answer is in a valid form.
         """
         try:
-            evaluator(dict(), dict(), answer)
+            NUMERICAL_EXPRESSION_CACHE.evaluate(answer)
             return True
         except (StudentInputError, UndefinedVariable):
             return False
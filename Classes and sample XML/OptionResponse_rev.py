@@ -16,51 +16,33 @@ class OptionResponse(LoncapaResponse):
 
     def setup_response(self):
         self.answer_fields = self.inputfields
-
-    def get_score(self, student_answers):
-        # log.debug('%s: student_answers=%s' % (unicode(self),student_answers))
-        cmap = CorrectMap()
-
-        answer_map = self.get_answers()
-
-        tree = self.xml
-        problem_xml = tree.xpath('.')
+        self._compiled_answers = None
+        self._context_value_index = None
 
         # Partial credit type - can set 'points' only at the moment.
-        credit_type = problem_xml[0].get('partial_credit', default=False)
-
         try:
-            credit_type = str(credit_type).lower().strip()
+            self.partial_credit = PartialCreditPolicy.from_xml(self.xml, ['points'])
         except ValueError:
             _ = self.capa_system.i18n.ugettext
             # Translators: 'partial_credit' is an attribute name and should not be translated.
             msg = _("partial_credit value can only be set to 'points' or be removed.")
             raise LoncapaProblemError(msg)
 
-        for aid in answer_map:
-            # Set correct/incorrect first, check for partial credit later.
-            for word in answer_map[aid]:
-                if aid in student_answers and student_answers[aid] == word:
-                    cmap.set(aid, 'correct')
-                    break
-                else:
-                    cmap.set(aid, 'incorrect')
-
-            # For partial credit:
-            if credit_type == 'points':
-                partial_map = self.get_partial()
-                points_map = self.get_partial_points(partial_map)
-
-                if not cmap.is_correct(aid) and partial_map[aid] is not None:
-                    for index, word in enumerate(partial_map[aid]):
-                        # Set the correctness and point value
-                        # for each answer id independently.
-                        if aid in student_answers and student_answers[aid] == word:
-                            cmap.set(aid, 'partially-correct')
-                            cmap.set_property(aid, 'npoints', points_map[aid][index])
-                            break
-                        else:
-                            cmap.set(aid, 'incorrect')
+    def get_score(self, student_answers):
+        # log.debug('%s: student_answers=%s' % (unicode(self),student_answers))
+        cmap = CorrectMap()
+
+        answer_tables = self.get_compiled_answers()
+
+        for aid, answer_table in answer_tables.iteritems():
+            correctness, npoints = 'incorrect', None
+            if aid in student_answers:
+                try:
+                    correctness, npoints = answer_table.get(student_answers[aid], (correctness, npoints))
+                except TypeError:
+                    # Not a string (e.g. a list), so it can't match any option.
+                    pass
+            cmap.set(aid, correctness, npoints=npoints)
 
             answer_variable = self.get_student_answer_variable_name(student_answers, aid)
             if answer_variable:
@@ -68,6 +50,99 @@ class OptionResponse(LoncapaResponse):
 
         return cmap
 
+    def get_compiled_answers(self):
+        """
+        Returns a dictionary with problem ids as keys. Each entry maps the
+        text of an option to the (correctness, npoints) choosing it earns;
+        options that aren't in it are incorrect.
+
+        Correct answers win over partially-correct ones, and an option listed
+        twice as partially correct earns the points of its first listing.
+
+        The answers only depend on the context, so they are worked out on the
+        first submission and cached on the response. Randomized problems keep
+        them only for the seed they were computed with.
+        """
+        seed = self.context.get('seed')
+        if self._compiled_answers is not None and self._compiled_answers[0] == seed:
+            return self._compiled_answers[1]
+
+        answer_map = self.get_answers()
+        answer_tables = dict((aid, {}) for aid in answer_map)
+
+        if 'points' in self.partial_credit.schemes:
+            partial_map = self.get_partial()
+            points_map = self.get_partial_points(partial_map)
+            for aid, words in partial_map.iteritems():
+                for index, word in enumerate(words or []):
+                    if index >= len(points_map[aid]):
+                        _ = self.capa_system.i18n.ugettext
+                        # Translators: 'point_values' and 'partial' are attribute names and should not be translated.
+                        msg = _("point_values needs a value for each partial answer.")
+                        raise LoncapaProblemError(msg)
+                    answer_tables[aid].setdefault(word, ('partially-correct', points_map[aid][index]))
+
+        for aid, words in answer_map.iteritems():
+            for word in words:
+                answer_tables[aid][word] = ('correct', None)
+
+        self._compiled_answers = (seed, answer_tables)
+        return answer_tables
+
+    def grade_batch(self, submissions):
+        """
+        Grades many students' submissions to this response at once, e.g. to
+        regrade a course after the point_values of a dropdown change.
+
+        `submissions` is a sequence with one entry per student: the
+        student_answers dictionary get_score would be given.
+
+        Each dropdown's options are encoded as small integer codes (0 for any
+        option that earns nothing), the submissions become a students x inputs
+        matrix of codes, and the grades are looked up in per-input score
+        vectors with numpy.
+
+        Returns a dict with:
+            'answer_ids': the answer ids, in column order
+            'correctness': numpy array of 'correct', 'partially-correct' or
+                'incorrect', with one row per submission
+            'npoints': numpy array of the points the matching CorrectMap
+                would report, in the same shape
+        """
+        answer_tables = self.get_compiled_answers()
+        answer_ids = [af.get('id') for af in self.answer_fields]
+
+        width = 1 + max([len(answer_tables[aid]) for aid in answer_ids] or [0])
+        correctness_table = numpy.empty((len(answer_ids), width), dtype=object)
+        correctness_table[:] = 'incorrect'
+        npoints_table = numpy.zeros((len(answer_ids), width), dtype=float)
+
+        option_codes = []
+        for column, aid in enumerate(answer_ids):
+            codes = {}
+            for code, (option, (correctness, npoints)) in enumerate(answer_tables[aid].iteritems(), start=1):
+                codes[option] = code
+                correctness_table[column, code] = correctness
+                npoints_table[column, code] = 1 if npoints is None else npoints
+            option_codes.append(codes)
+
+        submitted = numpy.zeros((len(submissions), len(answer_ids)), dtype=int)
+        for row, student_answers in enumerate(submissions):
+            for column, aid in enumerate(answer_ids):
+                if aid in student_answers:
+                    try:
+                        submitted[row, column] = option_codes[column].get(student_answers[aid], 0)
+                    except TypeError:
+                        # Not a string (e.g. a list), so it can't match any option.
+                        pass
+
+        columns = numpy.arange(len(answer_ids))
+        return {
+            'answer_ids': answer_ids,
+            'correctness': correctness_table[columns, submitted],
+            'npoints': npoints_table[columns, submitted],
+        }
+
     def get_answers(self):
         """
         Returns a dictionary with problem ids as keys.
@@ -125,7 +200,7 @@ class OptionResponse(LoncapaResponse):
                 for index, word in enumerate(points_map[aid]):
                     points_map[aid][index] = float(word.strip())
             else:
-                points_map[aid] = [default_credit] * len(partial_map[aid])
+                points_map[aid] = [default_credit] * len(partial_map[aid] or [])
         # log.debug('%s: partial point values=%s' % (unicode(self),answer_map))
         return points_map
 
@@ -134,11 +209,56 @@ class OptionResponse(LoncapaResponse):
         Return student answers variable name if exist in context else None.
         """
         if aid in student_answers:
-            for key, val in self.context.iteritems():
+            try:
+                key = self.get_context_value_index().get(student_answers[aid])
+                # The value may have been changed in place since the index
+                # was built; if so, build it again.
+                if key is not None and unicode(self.context.get(key)) != student_answers[aid]:
+                    self._context_value_index = None
+                    key = self.get_context_value_index().get(student_answers[aid])
+            except (TypeError, UnicodeError):
+                # Not a string (e.g. a list), so it can't match any value.
+                key = None
+            if key is not None:
+                return '$' + key
+        return None
+
+    def get_context_value_index(self):
+        """
+        Returns a dictionary from unicode(value) to the name of the first
+        context variable, in context order, with that value.
+
+        Converting every context value (including whatever big lists and
+        dicts the problem script left there) is done once rather than for
+        each answer id. The index is rebuilt if any variable of the context
+        is added, removed or set to a different object; it keeps the values
+        it was built from to tell.
+        """
+        items = list(self.context.iteritems())
+        if self._context_value_index is None or not self._same_items(self._context_value_index[0], items):
+            index = {}
+            for key, val in items:
                 # convert val into unicode because student answer always be a unicode string
                 # even it is a list, dict etc.
-                if unicode(val) == student_answers[aid]:
-                    return '$' + key
-        return None
+                try:
+                    index.setdefault(unicode(val), key)
+                except UnicodeError:
+                    # Undecodable byte strings can't equal a unicode answer.
+                    continue
+            self._context_value_index = (items, index)
+        return self._context_value_index[1]
+
+    @staticmethod
+    def _same_items(old_items, items):
+        """
+        Whether two lists of context items have the same names bound to the
+        same objects.
+        """
+        if len(old_items) != len(items):
+            return False
+        for (old_key, old_val), (key, val) in zip(old_items, items):
+            if old_key != key or old_val is not val:
+                return False
+        return True
 
 #-----------------------------------------------------------------------------
@@ -0,0 +1,57 @@
+#-----------------------------------------------------------------------------
+
+from collections import namedtuple
+
+
+class PartialCreditPolicy(namedtuple('PartialCreditPolicy', ['schemes', 'partial_range', 'partial_answers',
+                                                             'expected_count', 'rounding'])):
+    """
+    The partial credit configuration of one response, read and validated once
+    in setup_response so that get_score doesn't re-parse it on every submission.
+
+        schemes: tuple of the lowercased partial_credit schemes in use,
+            empty if partial credit is off
+        partial_range: multiple of the tolerance that still earns "close"
+            credit (numerical responses only)
+        partial_answers: tuple of alternative staff answers that earn "list"
+            credit (numerical responses only)
+        expected_count: the number of points a fully right answer is worth
+            under the count_correct and dock_incorrect schemes, or None for
+            the scheme's default (checkbox responses only)
+        rounding: decimal places the partial credit is rounded to
+            (checkbox responses only)
+    """
+    __slots__ = ()
+
+    @classmethod
+    def from_xml(cls, xml, allowed_schemes, max_schemes=1):
+        """
+        Builds the policy from the partial_credit attribute of the response
+        element `xml`. Leaving the attribute out, or setting it to "false",
+        turns partial credit off.
+
+        Raises ValueError if a scheme isn't one of `allowed_schemes`, if a
+        scheme is repeated, or if more than `max_schemes` are given.
+        """
+        credit_type = xml.get('partial_credit', '').lower().strip()
+        if credit_type in ('', 'false'):
+            schemes = ()
+        else:
+            schemes = tuple(word.strip() for word in credit_type.split(','))
+
+        for scheme in schemes:
+            if scheme not in allowed_schemes:
+                raise ValueError("Unknown partial_credit scheme: {0}".format(scheme))
+        if len(set(schemes)) != len(schemes) or len(schemes) > max_schemes:
+            raise ValueError("Invalid partial_credit combination: {0}".format(credit_type))
+
+        return cls(schemes=schemes, partial_range=2.0, partial_answers=(), expected_count=None, rounding=2)
+
+    @property
+    def scheme(self):
+        """
+        For responses that allow only one scheme: the scheme in use, or 'false'.
+        """
+        return self.schemes[0] if self.schemes else 'false'
+
+#-----------------------------------------------------------------------------
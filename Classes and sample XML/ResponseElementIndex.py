@@ -0,0 +1,34 @@
+#-----------------------------------------------------------------------------
+
+
+class ResponseElementIndex(object):
+    """
+    Index of the elements inside one response, grouped by tag in document
+    order and built in a single walk of the response's subtree.
+
+    Responses used to find their own choices and responseparams with queries
+    like '//*[@id=$id]//choice', which scan the whole problem document once per
+    response. Each response indexing only its own subtree keeps problem
+    construction linear in the size of the problem.
+
+    The index records which elements exist, not their attributes, so it stays
+    valid while names are assigned, but not once elements are moved around
+    (e.g. by shuffling).
+    """
+
+    def __init__(self, xml):
+        self._elements = {}
+        for element in xml.iterdescendants():
+            self._elements.setdefault(element.tag, []).append(element)
+
+    def find_all(self, tag, **attributes):
+        """
+        Returns the elements with the given tag, in document order, whose
+        attributes have the given values.
+        """
+        return [
+            element for element in self._elements.get(tag, [])
+            if all(element.get(key) == value for key, value in attributes.iteritems())
+        ]
+
+#-----------------------------------------------------------------------------
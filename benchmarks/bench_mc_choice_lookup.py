@@ -0,0 +1,56 @@
+"""
+Benchmark: setup and grading time of a 50-choice multiple choice problem.
+
+Run from an edx-platform checkout with the revised response classes in place,
+so that the capa package is importable:
+
+    python bench_mc_choice_lookup.py [--choices N] [--repeat N]
+
+setup_response walks the choices once and get_score does a single dict
+lookup, so grading time should not depend on which choice was picked or on
+how many choices the pool has.
+"""
+
+import argparse
+import timeit
+
+from capa.tests import new_loncapa_problem
+from capa.tests.response_xml_factory import MultipleChoiceResponseXMLFactory
+
+
+def build_choices(num_choices):
+    """
+    One correct choice at the end of the pool, every fifth choice partial.
+    """
+    choices = ['partial' if index % 5 == 4 else False for index in range(num_choices - 1)]
+    return choices + [True]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--choices', type=int, default=50, help="number of choices in the pool")
+    parser.add_argument('--repeat', type=int, default=5, help="timing runs per measurement")
+    args = parser.parse_args()
+
+    xml = MultipleChoiceResponseXMLFactory().build_xml(
+        choices=build_choices(args.choices), credit_type='points'
+    )
+
+    setups = 200
+    seconds = min(timeit.Timer(lambda: new_loncapa_problem(xml)).repeat(repeat=args.repeat, number=setups))
+    print "{0:<28} {1:>10.3f} ms".format('problem construction', seconds * 1000 / setups)
+
+    responder = new_loncapa_problem(xml).responders.values()[0]
+    answer_id = responder.answer_id
+    gradings = 10000
+    for label, choice in [('first choice (incorrect)', 'choice_0'),
+                          ('partial choice', 'choice_4'),
+                          ('last choice (correct)', 'choice_{0}'.format(args.choices - 1))]:
+        student_answers = {answer_id: choice}
+        seconds = min(timeit.Timer(lambda: responder.get_score(student_answers)).repeat(
+            repeat=args.repeat, number=gradings))
+        print "{0:<28} {1:>10.3f} us".format(label, seconds * 1e6 / gradings)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+"""
+Benchmark: throughput of the numeric literal fast path vs. the full evaluator.
+
+Run from an edx-platform checkout with the revised response classes in place,
+so that calc and capa are importable:
+
+    python bench_numeric_fast_path.py [--submissions N] [--repeat N]
+
+The corpus mimics what students type into numerical problems: mostly plain
+literals and scientific notation, some expressions, and some mistakes.
+Before timing, every string is checked to give the same value (or the same
+exception) both ways.
+"""
+
+import argparse
+import random
+import timeit
+
+from calc import evaluator
+from capa.responsetypes import parse_numeric_literal
+
+# (weight, submissions)
+CORPUS = [
+    (40, ['42', '-3.5', '0.25', '3', '100', '9.81', '-1', '0', '12.0', '.5']),
+    (25, ['6.02e23', '1.5e8', '3e-2', '1.6E-19', '6.674e-11', '2.998e8']),
+    (15, ['93*10^6', '1.5*10^8', '6.02*10^23', '1.6*10^-19', '3 * 10^8']),
+    (15, ['1/3', '2*pi', 'sqrt(2)', '4+5/2^2', '10^3', '(1+2)*3', '5k']),
+    (5, ['x', '1.2.3', '3+)', '', 'twelve']),
+]
+
+
+def build_corpus(size, seed=0):
+    """
+    Returns `size` submissions drawn from CORPUS according to the weights.
+    """
+    rng = random.Random(seed)
+    population = []
+    for weight, submissions in CORPUS:
+        population.extend(submissions * weight)
+    return [rng.choice(population) for _ in range(size)]
+
+
+def evaluate_full(submission):
+    try:
+        return evaluator({}, {}, submission)
+    except Exception as err:  # pylint: disable=broad-except
+        return type(err)
+
+
+def evaluate_fast(submission):
+    value = parse_numeric_literal(submission)
+    if value is not None:
+        return value
+    return evaluate_full(submission)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--submissions', type=int, default=20000, help="size of the corpus")
+    parser.add_argument('--repeat', type=int, default=3, help="timing runs per method")
+    args = parser.parse_args()
+
+    corpus = build_corpus(args.submissions)
+
+    for submission in set(corpus):
+        assert evaluate_fast(submission) == evaluate_full(submission), submission
+
+    literal_share = sum(1 for submission in corpus if parse_numeric_literal(submission) is not None)
+    print "{0} submissions, {1:.0%} plain literals".format(len(corpus), float(literal_share) / len(corpus))
+
+    for name, function in [('evaluator only', evaluate_full), ('fast path + evaluator', evaluate_fast)]:
+        seconds = min(timeit.Timer(lambda: [function(submission) for submission in corpus]).repeat(
+            repeat=args.repeat, number=1))
+        print "{0:<24} {1:>10.0f} submissions/s".format(name, len(corpus) / seconds)
+
+
+if __name__ == '__main__':
+    main()
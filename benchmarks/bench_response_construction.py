@@ -0,0 +1,60 @@
+"""
+Benchmark: problem construction time vs. number of responses in the problem.
+
+Run from an edx-platform checkout with the revised response classes in place,
+so that the capa package is importable:
+
+    python bench_response_construction.py [--repeat N]
+
+Each response only indexes its own subtree during setup, so the time per
+response should stay roughly flat as the problem grows. With document-wide
+'//*[@id=$id]' queries it grows with the number of responses.
+"""
+
+import argparse
+import timeit
+
+from capa.tests import new_loncapa_problem
+from capa.tests.response_xml_factory import (
+    ChoiceResponseXMLFactory,
+    MultipleChoiceResponseXMLFactory,
+    NumericalResponseXMLFactory,
+)
+
+RESPONSE_COUNTS = [1, 5, 10, 20, 40, 80]
+
+FACTORIES = [
+    ('checkbox', ChoiceResponseXMLFactory(),
+     dict(choice_type='checkbox', choices=[False, True, True, False, False, True])),
+    ('multiple choice', MultipleChoiceResponseXMLFactory(),
+     dict(choices=[False, True, 'partial', False, False, False], credit_type='points')),
+    ('numerical', NumericalResponseXMLFactory(),
+     dict(answer='42', tolerance='5%')),
+]
+
+
+def time_construction(xml, repeat):
+    """
+    Returns the best time, in seconds, to build the problem from its XML.
+    """
+    timer = timeit.Timer(lambda: new_loncapa_problem(xml))
+    return min(timer.repeat(repeat=repeat, number=1))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--repeat', type=int, default=5, help="timing runs per problem size")
+    args = parser.parse_args()
+
+    print "{0:<16} {1:>10} {2:>12} {3:>16}".format('response type', 'responses', 'total (ms)', 'per response (ms)')
+    for name, factory, kwargs in FACTORIES:
+        for num_responses in RESPONSE_COUNTS:
+            xml = factory.build_xml(num_responses=num_responses, **kwargs)
+            seconds = time_construction(xml, args.repeat)
+            print "{0:<16} {1:>10} {2:>12.2f} {3:>16.3f}".format(
+                name, num_responses, seconds * 1000, seconds * 1000 / num_responses
+            )
+
+
+if __name__ == '__main__':
+    main()
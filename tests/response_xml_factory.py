@@ -264,6 +264,11 @@ class CustomResponseXMLFactory(ResponseXMLFactory):
         *expect*: The value passed to the function cfn
 
         *answer*: Inline script that calculates the answer
+
+        *reuse_script*: If True, let a check function worker keep the
+        script's namespace between calls to cfn
+
+        *cacheable*: If True, cache the results of cfn
         """
 
         # Retrieve **kwargs
@@ -272,6 +277,8 @@ class CustomResponseXMLFactory(ResponseXMLFactory):
         answer = kwargs.get('answer', None)
         options = kwargs.get('options', None)
         cfn_extra_args = kwargs.get('cfn_extra_args', None)
+        reuse_script = kwargs.get('reuse_script', False)
+        cacheable = kwargs.get('cacheable', False)
 
         # Create the response element
         response_element = etree.Element("customresponse")
@@ -292,6 +299,12 @@ class CustomResponseXMLFactory(ResponseXMLFactory):
         if cfn_extra_args:
             response_element.set('cfn_extra_args', str(cfn_extra_args))
 
+        if reuse_script:
+            response_element.set('reuse_script', 'true')
+
+        if cacheable:
+            response_element.set('cacheable', 'true')
+
         return response_element
 
     def create_input_element(self, **kwargs):
@@ -410,8 +423,27 @@ class ChoiceResponseXMLFactory(ResponseXMLFactory):
     """ Factory for creating <choiceresponse> XML trees """
 
     def create_response_element(self, **kwargs):
-        """ Create a <choiceresponse> element """
-        return etree.Element("choiceresponse")
+        """ Create a <choiceresponse> element
+
+        Uses **kwargs:
+
+        *partial_expected*: The number of points a fully right answer is
+        worth under the count_correct and dock_incorrect schemes
+
+        *partial_round*: The decimal places partial credit is rounded to
+        """
+        partial_expected = kwargs.get('partial_expected', None)
+        partial_round = kwargs.get('partial_round', None)
+
+        response_element = etree.Element("choiceresponse")
+
+        if partial_expected is not None:
+            response_element.set('partial_expected', str(partial_expected))
+
+        if partial_round is not None:
+            response_element.set('partial_round', str(partial_round))
+
+        return response_element
 
     def create_input_element(self, **kwargs):
         """ Create a <checkboxgroup> element."""
@@ -21,7 +21,7 @@ from . import new_loncapa_problem, test_capa_system, load_fixture
 import calc
 
 from capa.responsetypes import LoncapaProblemError, \
-    StudentInputError, ResponseError
+    StudentInputError, ResponseError, NUMERICAL_EXPRESSION_CACHE
 from capa.correctmap import CorrectMap
 from capa.tests.response_xml_factory import (
     AnnotationResponseXMLFactory,
@@ -140,16 +140,12 @@ class MultiChoiceResponseTest(ResponseTest):
     def test_multiple_choice_valid_grading_schemes(self):
         # Multiple Choice problems only allow one partial credit scheme.
         # Change this test if that changes.
-        problem = self.build_problem(choices=[False, True, 'partial'], credit_type='points,points')
         with self.assertRaises(LoncapaProblemError):
-            input_dict = {'1_2_1': 'choice_1'}
-            problem.grade_answers(input_dict)
+            self.build_problem(choices=[False, True, 'partial'], credit_type='points,points')
 
         # 'bongo' is not a valid grading scheme.
-        problem = self.build_problem(choices=[False, True, 'partial'], credit_type='bongo')
         with self.assertRaises(LoncapaProblemError):
-            input_dict = {'1_2_1': 'choice_1'}
-            problem.grade_answers(input_dict)
+            self.build_problem(choices=[False, True, 'partial'], credit_type='bongo')
 
     def test_partial_points_multiple_choice_grade(self):
         problem = self.build_problem(
@@ -1171,24 +1167,20 @@ class ChoiceResponseTest(ResponseTest):
     def test_checkbox_group_valid_grading_schemes(self):
         # Checkbox-type problems only allow one partial credit scheme.
         # Change this test if that changes.
-        problem = self.build_problem(
-            choice_type='checkbox',
-            choices=[False, False, True, True],
-            credit_type='edc,halves,bongo'
-        )
         with self.assertRaises(LoncapaProblemError):
-            input_dict = {'1_2_1': 'choice_1'}
-            problem.grade_answers(input_dict)
+            self.build_problem(
+                choice_type='checkbox',
+                choices=[False, False, True, True],
+                credit_type='edc,halves,bongo'
+            )
 
         # 'bongo' is not a valid grading scheme.
-        problem = self.build_problem(
-            choice_type='checkbox',
-            choices=[False, False, True, True],
-            credit_type='bongo'
-        )
         with self.assertRaises(LoncapaProblemError):
-            input_dict = {'1_2_1': 'choice_1'}
-            problem.grade_answers(input_dict)
+            self.build_problem(
+                choice_type='checkbox',
+                choices=[False, False, True, True],
+                credit_type='bongo'
+            )
 
     def test_checkbox_group_partial_credit_grade(self):
         # First: Every Decision Counts grading style
@@ -1329,6 +1321,12 @@ class JavascriptResponseTest(ResponseTest):
 class NumericalResponseTest(ResponseTest):
     xml_factory_class = NumericalResponseXMLFactory
 
+    def setUp(self):
+        super(NumericalResponseTest, self).setUp()
+        # Student expressions are cached process-wide; start each test cold
+        # so that mocked evaluators are actually called.
+        NUMERICAL_EXPRESSION_CACHE.clear()
+
     # We blend the line between integration (using evaluator) and exclusively
     # unit testing the NumericalResponse (mocking out the evaluator)
     # For simple things its not worth the effort.
@@ -1466,10 +1464,8 @@ class NumericalResponseTest(ResponseTest):
 
     def test_numerical_valid_grading_schemes(self):
         # 'bongo' is not a valid grading scheme.
-        problem = self.build_problem(answer=4, tolerance=0.1, credit_type='bongo')
-        input_dict = {'1_2_1': '4'}
         with self.assertRaises(LoncapaProblemError):
-            problem.grade_answers(input_dict)
+            self.build_problem(answer=4, tolerance=0.1, credit_type='bongo')
 
     def test_grade_decimal_tolerance(self):
         problem = self.build_problem(answer=4, tolerance=0.1)
@@ -1621,6 +1617,7 @@ class NumericalResponseTest(ResponseTest):
                     if math_string != '4':
                         raise err
                 mock_eval.side_effect = evaluator_side_effect
+                NUMERICAL_EXPRESSION_CACHE.clear()
 
                 with self.assertRaisesRegexp(StudentInputError, msg_regex):
                     problem.grade_answers({'1_2_1': 'foobar'})
@@ -3,13 +3,16 @@
 Tests of responsetypes
 """
 
+from concurrent.futures import ThreadPoolExecutor, wait
 from cStringIO import StringIO
 from datetime import datetime
 import json
 import os
 import pyparsing
 import random
+import sys
 import textwrap
+import time
 import unittest
 import zipfile
 
@@ -21,8 +24,10 @@ from . import new_loncapa_problem, test_capa_system, load_fixture
 import calc
 
 from capa.responsetypes import LoncapaProblemError, \
-    StudentInputError, ResponseError
+    StudentInputError, ResponseError, NUMERICAL_EXPRESSION_CACHE, parse_numeric_literal, CHOICE_ORDER_CACHE, \
+    CustomResponse, CheckFunction, CheckFunctionWorker, CheckFunctionWorkerPool, CHECK_RESULT_CACHE
 from capa.correctmap import CorrectMap
+import capa.safe_exec as safe_exec
 from capa.tests.response_xml_factory import (
     AnnotationResponseXMLFactory,
     ChoiceResponseXMLFactory,
@@ -40,7 +45,7 @@ from capa.tests.response_xml_factory import (
     SymbolicResponseXMLFactory,
     TrueFalseResponseXMLFactory,
 )
-from capa.util import convert_files_to_filenames
+from capa.util import convert_files_to_filenames, compare_with_tolerance
 from capa.xqueue_interface import dateformat
 
 
@@ -140,16 +145,12 @@ class MultiChoiceResponseTest(ResponseTest):
     def test_multiple_choice_valid_grading_schemes(self):
         # Multiple Choice problems only allow one partial credit scheme.
         # Change this test if that changes.
-        problem = self.build_problem(choices=[False, True, 'partial'], credit_type='points,points')
         with self.assertRaises(LoncapaProblemError):
-            input_dict = {'1_2_1': 'choice_1'}
-            problem.grade_answers(input_dict)
+            self.build_problem(choices=[False, True, 'partial'], credit_type='points,points')
 
         # 'bongo' is not a valid grading scheme.
-        problem = self.build_problem(choices=[False, True, 'partial'], credit_type='bongo')
         with self.assertRaises(LoncapaProblemError):
-            input_dict = {'1_2_1': 'choice_1'}
-            problem.grade_answers(input_dict)
+            self.build_problem(choices=[False, True, 'partial'], credit_type='bongo')
 
     def test_partial_points_multiple_choice_grade(self):
         problem = self.build_problem(
@@ -169,6 +170,84 @@ class MultiChoiceResponseTest(ResponseTest):
         correct_map = problem.grade_answers({'1_2_1': 'choice_2'})
         self.assertAlmostEqual(correct_map.get_npoints('1_2_1'), 0)
 
+    def test_multiple_choice_outcomes(self):
+        problem = self.build_problem(
+            choices=[False, True, 'partial', False, 'partial'],
+            credit_type='points',
+            points=[None, None, '0.3', None, None]
+        )
+        responder = problem.responders.values()[0]
+        self.assertEqual(responder.choice_outcomes, {
+            'choice_1': ('correct', None),
+            'choice_2': ('partially-correct', 0.3),
+            'choice_4': ('partially-correct', 0.5),
+        })
+
+        # Without partial credit, partial choices are just incorrect.
+        problem = self.build_problem(choices=[False, True, 'partial'])
+        self.assertEqual(problem.responders.values()[0].choice_outcomes, {'choice_1': ('correct', None)})
+        self.assert_grade(problem, 'choice_2', 'incorrect')
+
+    def test_choice_order_cache(self):
+        xml = textwrap.dedent("""
+            <problem>
+            <multiplechoiceresponse>
+              <choicegroup type="MultipleChoice" shuffle="true">
+                <choice correct="false" fixed="true">Apple</choice>
+                <choice correct="false">Banana</choice>
+                <choice correct="false">Chocolate</choice>
+                <choice correct="true">Donut</choice>
+                <choice correct="false">Eggplant</choice>
+                <choice correct="false" fixed="true">None of the above</choice>
+              </choicegroup>
+            </multiplechoiceresponse>
+            <multiplechoiceresponse>
+              <choicegroup type="MultipleChoice" answer-pool="3">
+                <choice correct="false">wrong-1</choice>
+                <choice correct="false">wrong-2</choice>
+                <choice correct="true" explanation-id="solution1">correct-1</choice>
+                <choice correct="false">wrong-3</choice>
+                <choice correct="true" explanation-id="solution2">correct-2</choice>
+              </choicegroup>
+            </multiplechoiceresponse>
+            <solutionset>
+                <solution explanation-id="solution1">First solution</solution>
+                <solution explanation-id="solution2">Second solution</solution>
+            </solutionset>
+            </problem>
+        """)
+
+        # The same shuffle, then a different answer-pool
+        other_xml = xml.replace('answer-pool="3"', 'answer-pool="4"')
+
+        def displayed(problem_xml, seed):
+            """The choice orders and the solution shown for this seed."""
+            problem = new_loncapa_problem(problem_xml, seed=seed)
+            orders = [responder.unmask_order() for responder in problem.responders.values()]
+            return sorted(orders), problem.tree.xpath('//solution/@explanation-id')
+
+        with mock.patch('capa.responsetypes.CHOICE_ORDER_CACHE_SIZE', 0):
+            uncached = [displayed(xml, seed) for seed in range(10)]
+            other_uncached = [displayed(other_xml, seed) for seed in range(10)]
+
+        CHOICE_ORDER_CACHE.clear()
+        self.assertEqual([displayed(xml, seed) for seed in range(10)], uncached)
+        self.assertEqual(len(CHOICE_ORDER_CACHE), 20)
+
+        # Loading the problems again replays the cached orders, unchanged.
+        self.assertEqual([displayed(xml, seed) for seed in range(10)], uncached)
+        self.assertEqual(len(CHOICE_ORDER_CACHE), 20)
+
+        # A cached shuffle followed by an answer-pool that isn't cached yet:
+        # the pool draws from where the shuffle left the rng.
+        self.assertEqual([displayed(other_xml, seed) for seed in range(10)], other_uncached)
+        self.assertEqual(len(CHOICE_ORDER_CACHE), 30)
+
+        for orders, solutions in uncached:
+            shuffled = [order for order in orders if len(order) == 6][0]
+            self.assertEqual((shuffled[0], shuffled[-1]), ('choice_0', 'choice_5'))
+            self.assertEqual(len(solutions), 1)
+
 
 class TrueFalseResponseTest(ResponseTest):
     xml_factory_class = TrueFalseResponseXMLFactory
@@ -454,28 +533,75 @@ class OptionResponseTest(ResponseTest):
         correct_map = problem.grade_answers({'1_2_1': 'third'})
         self.assertAlmostEqual(correct_map.get_npoints('1_2_1'), 0.3)
 
-    def test_grade_partial_credit_valid_scheme(self):
-        # Only one type of partial credit currently allowed.
+    def test_grade_many_dropdowns(self):
         problem = self.build_problem(
             options=["first", "second", "third"],
             correct_option="second",
-            credit_type="points,points",
-            partial_option="third"
+            credit_type="points",
+            partial_option="third",
+            point_values="0.3",
+            num_inputs=30
         )
-        with self.assertRaises(LoncapaProblemError):
-            input_dict = {'1_2_1': 'second'}
-            problem.grade_answers(input_dict)
-
-        # 'bongo' is not a valid grading scheme.
+        responder = problem.responders.values()[0]
+        options = ["first", "second", "third"]
+        input_dict = dict(('1_2_{}'.format(index + 1), options[index % 3]) for index in range(30))
+
+        with mock.patch.object(responder, 'get_answers', wraps=responder.get_answers) as mock_get_answers:
+            for _ in range(3):
+                correct_map = problem.grade_answers(input_dict)
+            # The answers are worked out once, not per dropdown or per submission.
+            self.assertEqual(mock_get_answers.call_count, 1)
+
+        for index in range(30):
+            answer_id = '1_2_{}'.format(index + 1)
+            expected = [('incorrect', 0), ('correct', 1), ('partially-correct', 0.3)][index % 3]
+            self.assertEqual(correct_map.get_correctness(answer_id), expected[0])
+            self.assertAlmostEqual(correct_map.get_npoints(answer_id), expected[1])
+
+    def test_grade_batch(self):
         problem = self.build_problem(
             options=["first", "second", "third"],
             correct_option="second",
-            credit_type="bongo",
-            partial_option="third"
+            credit_type="points",
+            partial_option="third",
+            point_values="0.3",
+            num_inputs=3
         )
+        submissions = [
+            {'1_2_1': 'first', '1_2_2': 'second', '1_2_3': 'third'},
+            {'1_2_1': 'second', '1_2_2': 'second'},
+            {'1_2_1': 'third', '1_2_2': 'invalid_option', '1_2_3': 'second'},
+            {},
+        ]
+        results = problem.responders.values()[0].grade_batch(submissions)
+        self.assertEqual(results['answer_ids'], ['1_2_1', '1_2_2', '1_2_3'])
+        self.assertEqual(results['correctness'].shape, (4, 3))
+
+        # The batch results should agree with grading one student at a time.
+        for row, input_dict in enumerate(submissions):
+            correct_map = problem.grade_answers(input_dict)
+            for column, answer_id in enumerate(results['answer_ids']):
+                self.assertEqual(results['correctness'][row, column], correct_map.get_correctness(answer_id))
+                self.assertAlmostEqual(results['npoints'][row, column], correct_map.get_npoints(answer_id))
+
+    def test_grade_partial_credit_valid_scheme(self):
+        # Only one type of partial credit currently allowed.
         with self.assertRaises(LoncapaProblemError):
-            input_dict = {'1_2_1': 'second'}
-            problem.grade_answers(input_dict)
+            self.build_problem(
+                options=["first", "second", "third"],
+                correct_option="second",
+                credit_type="points,points",
+                partial_option="third"
+            )
+
+        # 'bongo' is not a valid grading scheme.
+        with self.assertRaises(LoncapaProblemError):
+            self.build_problem(
+                options=["first", "second", "third"],
+                correct_option="second",
+                credit_type="bongo",
+                partial_option="third"
+            )
 
     def test_quote_option(self):
         # Test that option response properly escapes quotes inside options strings
@@ -533,6 +659,47 @@ class OptionResponseTest(ResponseTest):
         self.assertEqual(correct_map.get_correctness('1_2_1'), 'partially-correct')
         self.assertEqual(correct_map.get_property('1_2_1', 'answervariable'), '$b')
 
+    def test_variable_options_context_changes(self):
+        """
+        Test that the answervariable lookup follows changes to the context.
+        """
+        script = textwrap.dedent("""\
+        a = 1000
+        b = a*2
+        table = dict((n, [n] * 10) for n in range(1000))
+        """)
+        problem = self.build_problem(
+            options=['$a', '$b', '3000'],
+            correct_option='$a',
+            script=script,
+            num_inputs=2
+        )
+        responder = problem.responders.values()[0]
+
+        correct_map = problem.grade_answers({'1_2_1': '1000', '1_2_2': '2000'})
+        self.assertEqual(correct_map.get_property('1_2_1', 'answervariable'), '$a')
+        self.assertEqual(correct_map.get_property('1_2_2', 'answervariable'), '$b')
+
+        correct_map = problem.grade_answers({'1_2_1': '3000'})
+        self.assertIsNone(correct_map.get_property('1_2_1', 'answervariable'))
+
+        responder.context['c'] = 3000
+        correct_map = problem.grade_answers({'1_2_1': '3000'})
+        self.assertEqual(correct_map.get_property('1_2_1', 'answervariable'), '$c')
+
+        # Same variables, but one set to a new value
+        responder.context['c'] = 4000
+        correct_map = problem.grade_answers({'1_2_1': '3000'})
+        self.assertIsNone(correct_map.get_property('1_2_1', 'answervariable'))
+
+        # A value changed in place
+        responder.context['d'] = [1]
+        correct_map = problem.grade_answers({'1_2_1': '[1]'})
+        self.assertEqual(correct_map.get_property('1_2_1', 'answervariable'), '$d')
+        responder.context['d'].append(2)
+        correct_map = problem.grade_answers({'1_2_1': '[1]'})
+        self.assertIsNone(correct_map.get_property('1_2_1', 'answervariable'))
+
 
 class FormulaResponseTest(ResponseTest):
     """
@@ -1292,24 +1459,20 @@ class ChoiceResponseTest(ResponseTest):
     def test_checkbox_group_valid_grading_schemes(self):
         # Checkbox-type problems only allow one partial credit scheme.
         # Change this test if that changes.
-        problem = self.build_problem(
-            choice_type='checkbox',
-            choices=[False, False, True, True],
-            credit_type='edc,halves,bongo'
-        )
         with self.assertRaises(LoncapaProblemError):
-            input_dict = {'1_2_1': 'choice_1'}
-            problem.grade_answers(input_dict)
+            self.build_problem(
+                choice_type='checkbox',
+                choices=[False, False, True, True],
+                credit_type='edc,halves,bongo'
+            )
 
         # 'bongo' is not a valid grading scheme.
-        problem = self.build_problem(
-            choice_type='checkbox',
-            choices=[False, False, True, True],
-            credit_type='bongo'
-        )
         with self.assertRaises(LoncapaProblemError):
-            input_dict = {'1_2_1': 'choice_1'}
-            problem.grade_answers(input_dict)
+            self.build_problem(
+                choice_type='checkbox',
+                choices=[False, False, True, True],
+                credit_type='bongo'
+            )
 
     def test_checkbox_group_partial_credit_grade(self):
         # First: Every Decision Counts grading style
@@ -1395,6 +1558,160 @@ class ChoiceResponseTest(ResponseTest):
         correct_map = problem.grade_answers({'1_2_1': 'choice_2,choice4'})
         self.assertAlmostEqual(correct_map.get_npoints('1_2_1'), 0.25)
 
+    def test_checkbox_group_counted_partial_credit(self):
+        # count_correct: a point for each correct choice selected
+        problem = self.build_problem(
+            choice_type='checkbox',
+            choices=[False, True, True, False, False],
+            credit_type='count_correct'
+        )
+        self.assert_grade(problem, ['choice_1', 'choice_2'], 'correct')
+        self.assert_grade(problem, ['choice_0', 'choice_3'], 'incorrect')
+
+        correct_map = problem.grade_answers({'1_2_1': ['choice_0', 'choice_1']})
+        self.assertEqual(correct_map.get_correctness('1_2_1'), 'partially-correct')
+        self.assertAlmostEqual(correct_map.get_npoints('1_2_1'), 0.5)
+
+        # Incorrect choices cost nothing
+        correct_map = problem.grade_answers({'1_2_1': ['choice_0', 'choice_1', 'choice_2']})
+        self.assertEqual(correct_map.get_correctness('1_2_1'), 'partially-correct')
+        self.assertAlmostEqual(correct_map.get_npoints('1_2_1'), 1)
+
+        # dock_incorrect: a point off for each choice gotten wrong
+        problem = self.build_problem(
+            choice_type='checkbox',
+            choices=[True, False, False, True],
+            credit_type='dock_incorrect'
+        )
+        self.assert_grade(problem, ['choice_0', 'choice_3'], 'correct')
+        self.assert_grade(problem, ['choice_1', 'choice_2'], 'incorrect')
+
+        correct_map = problem.grade_answers({'1_2_1': ['choice_0', 'choice_1']})
+        self.assertEqual(correct_map.get_correctness('1_2_1'), 'partially-correct')
+        self.assertAlmostEqual(correct_map.get_npoints('1_2_1'), 0.5)
+
+        # The expected count and the rounding can be set
+        problem = self.build_problem(
+            choice_type='checkbox',
+            choices=[True, True, True, False],
+            credit_type='count_correct',
+            partial_expected=2,
+            partial_round=1
+        )
+        correct_map = problem.grade_answers({'1_2_1': 'choice_0'})
+        self.assertAlmostEqual(correct_map.get_npoints('1_2_1'), 0.5)
+
+        problem = self.build_problem(
+            choice_type='checkbox',
+            choices=[True, False, False],
+            credit_type='dock_incorrect',
+            partial_round=1
+        )
+        correct_map = problem.grade_answers({'1_2_1': 'choice_1'})
+        self.assertAlmostEqual(correct_map.get_npoints('1_2_1'), 0.3)
+
+        with self.assertRaises(LoncapaProblemError):
+            self.build_problem(
+                choice_type='checkbox',
+                choices=[True, False],
+                credit_type='count_correct',
+                partial_expected=0
+            )
+
+    def test_checkbox_group_many_choices_grade(self):
+        # More choices than fit in a machine word, with the correct ones at the far end.
+        problem = self.build_problem(
+            choice_type='checkbox',
+            choices=[False] * 68 + [True, True],
+            credit_type='halves'
+        )
+
+        self.assert_grade(problem, ['choice_68', 'choice_69'], 'correct')
+        self.assert_grade(problem, ['choice_0', 'choice_68', 'choice_69'], 'partially-correct')
+        self.assert_grade(problem, ['choice_0', 'choice_1', 'choice_68'], 'incorrect')
+
+        # Names that aren't choices of this problem can never make an answer correct.
+        problem = self.build_problem(
+            choice_type='checkbox',
+            choices=[False, True, True]
+        )
+        self.assert_grade(problem, ['choice_1', 'choice_2', 'choice_3'], 'incorrect')
+
+    def test_checkbox_group_multiple_responses(self):
+        # Each response only names and grades the choices inside it.
+        problem = self.build_problem(
+            choice_type='checkbox',
+            choices=[False, True, True],
+            num_responses=3
+        )
+        for responder in problem.responders.values():
+            self.assertEqual(responder.correct_choices, set(['choice_1', 'choice_2']))
+
+        correct_map = problem.grade_answers({
+            '1_2_1': ['choice_1', 'choice_2'],
+            '1_3_1': ['choice_0'],
+            '1_4_1': ['choice_1', 'choice_2'],
+        })
+        self.assertEqual(correct_map.get_correctness('1_2_1'), 'correct')
+        self.assertEqual(correct_map.get_correctness('1_3_1'), 'incorrect')
+        self.assertEqual(correct_map.get_correctness('1_4_1'), 'correct')
+
+    def test_checkbox_group_outcome_table(self):
+        # Small problems with the same layout share one precomputed table.
+        first = self.build_problem(
+            choice_type='checkbox',
+            choices=[False, False, True, True],
+            credit_type='edc'
+        )
+        second = self.build_problem(
+            choice_type='checkbox',
+            choices=[False, False, True, True],
+            credit_type='edc'
+        )
+        first_responder = first.responders.values()[0]
+        second_responder = second.responders.values()[0]
+        self.assertEqual(len(first_responder.outcome_table), 16)
+        self.assertIs(first_responder.outcome_table, second_responder.outcome_table)
+
+        correct_map = first.grade_answers({'1_2_1': 'choice_2'})
+        self.assertEqual(correct_map.get_correctness('1_2_1'), 'partially-correct')
+        self.assertAlmostEqual(correct_map.get_npoints('1_2_1'), 0.75)
+
+        # Larger problems compute their grades on every submission.
+        problem = self.build_problem(
+            choice_type='checkbox',
+            choices=[False] * 7 + [True, True],
+            credit_type='halves'
+        )
+        self.assertIsNone(problem.responders.values()[0].outcome_table)
+        self.assert_grade(problem, ['choice_7', 'choice_8'], 'correct')
+        self.assert_grade(problem, ['choice_0', 'choice_7', 'choice_8'], 'partially-correct')
+
+    def test_checkbox_group_grade_batch(self):
+        submissions = [
+            ['choice_2', 'choice_3'],
+            'choice_2',
+            ['choice_0', 'choice_1'],
+            ['choice_1', 'choice_2', 'choice_3'],
+            None,
+        ]
+
+        # The batch results should agree with grading one student at a time.
+        for credit_type in ['false', 'edc', 'halves', 'count_correct', 'dock_incorrect']:
+            problem = self.build_problem(
+                choice_type='checkbox',
+                choices=[False, False, True, True],
+                credit_type=credit_type
+            )
+            responder = problem.responders.values()[0]
+            results = responder.grade_batch(submissions)
+
+            for index, submission in enumerate(submissions):
+                input_dict = {'1_2_1': submission} if submission is not None else {}
+                correct_map = problem.grade_answers(input_dict)
+                self.assertEqual(results['correctness'][index], correct_map.get_correctness('1_2_1'))
+                self.assertAlmostEqual(results['npoints'][index], correct_map.get_npoints('1_2_1'))
+
     def test_grade_with_no_checkbox_selected(self):
         """
         Test that answer marked as incorrect if no checkbox selected.
@@ -1450,6 +1767,12 @@ class JavascriptResponseTest(ResponseTest):
 class NumericalResponseTest(ResponseTest):
     xml_factory_class = NumericalResponseXMLFactory
 
+    def setUp(self):
+        super(NumericalResponseTest, self).setUp()
+        # Student expressions are cached process-wide; start each test cold
+        # so that mocked evaluators are actually called.
+        NUMERICAL_EXPRESSION_CACHE.clear()
+
     # We blend the line between integration (using evaluator) and exclusively
     # unit testing the NumericalResponse (mocking out the evaluator)
     # For simple things its not worth the effort.
@@ -1585,12 +1908,129 @@ class NumericalResponseTest(ResponseTest):
         partial_responses = ["2", "2.1", "1.5", "8", "7.5", "8.1", "-4", "-4.15", "-3.5", "4.5", "3.5"]
         self.assert_multiple_partial(problem, correct_responses, incorrect_responses, partial_responses)
 
+    def test_grade_partial_many_alternatives(self):
+        # Unit-conversion style problem: the answer in meters, with the same
+        # length in other units (and in meters with a tolerance of their own)
+        # worth partial credit.
+        alternatives = [str(10 ** power) for power in range(-12, 13)] + ['-4', '4.3']
+        problem = self.build_problem(
+            answer=4,
+            tolerance=0.1,
+            credit_type='list,close',
+            partial_answers=','.join(alternatives)
+        )
+        responder = problem.responders.values()[0]
+
+        self.assert_multiple_partial(
+            problem,
+            ["4", "4.05"],
+            ["5", "-5", "99", "1e13", "1+1j"],
+            ["4.15", "-4.05", "1000", "1e12", "1e-12", "4.45"]
+        )
+
+        def npoints(answer):
+            """The points earned by `answer`."""
+            return responder.get_score({'1_2_1': answer}).get_npoints('1_2_1')
+
+        self.assertAlmostEqual(npoints("4.15"), 0.5)  # close to the answer
+        self.assertAlmostEqual(npoints("1000.05"), 0.5)  # within tolerance of an alternative
+        self.assertAlmostEqual(npoints("1000.15"), 0.25)  # close to an alternative
+        self.assertAlmostEqual(npoints("-3.85"), 0.25)
+
+        # Only the alternatives near the student's answer are compared.
+        with mock.patch('capa.responsetypes.compare_with_tolerance', wraps=compare_with_tolerance) as mock_compare:
+            self.assertAlmostEqual(npoints("1000.15"), 0.25)
+            self.assertLessEqual(mock_compare.call_count, 4)
+
+    def test_grade_batch(self):
+        submissions = ["4", "4.05", "4.15", "2", "2.3", "8.1", "-4.35", "3.5", "0", None]
+        values = [calc.evaluator({}, {}, submission) if submission is not None else None
+                  for submission in submissions]
+
+        # The batch results should agree with grading one student at a time.
+        problems = [
+            dict(answer=4, tolerance=0.1),
+            dict(answer=4, tolerance=0.1, credit_type='close'),
+            dict(answer=4, tolerance="5%", credit_type='list', partial_answers='2,8,-4'),
+            dict(answer=4, tolerance=0.1, partial_range=3, credit_type='close,list', partial_answers='2,8,-4'),
+            dict(answer="[2, 4)", credit_type='close'),
+            dict(answer="1+1j", tolerance=0.1, credit_type='list', partial_answers='2,8'),
+        ]
+        for kwargs in problems:
+            problem = self.build_problem(**kwargs)
+            results = problem.responders.values()[0].grade_batch(values)
+
+            for index, submission in enumerate(submissions):
+                input_dict = {'1_2_1': submission} if submission is not None else {}
+                correct_map = problem.grade_answers(input_dict)
+                self.assertEqual(results['correctness'][index], correct_map.get_correctness('1_2_1'), kwargs)
+                self.assertAlmostEqual(results['npoints'][index], correct_map.get_npoints('1_2_1'))
+
+    def test_staff_answers_compiled_once(self):
+        problem = self.build_problem(
+            answer=4,
+            tolerance=0.2,
+            credit_type='close,list',
+            partial_answers='2,8,-4'
+        )
+        responder = problem.responders.values()[0]
+
+        with mock.patch.object(responder, 'get_staff_ans', wraps=responder.get_staff_ans) as mock_staff_ans:
+            self.assert_multiple_partial(problem, ["4"], ["1", "0"], ["2", "8.1", "4.5"])
+            # The staff answer and the three alternatives, evaluated only once.
+            self.assertEqual(mock_staff_ans.call_count, 4)
+
+            # A new seed means a new randomization, so everything is evaluated again.
+            responder.context['seed'] += 1
+            self.assert_grade(problem, "4", "correct")
+            self.assertEqual(mock_staff_ans.call_count, 8)
+
+    def test_student_expression_cache(self):
+        problem = self.build_problem(answer="93*10^6", tolerance="1%")
+
+        self.assert_grade(problem, "93*10^(3+3)", "correct")
+        self.assert_grade(problem, " 93*10^(3+3) ", "correct")
+        self.assert_grade(problem, "9.3*10^7/1", "correct")
+        info = NUMERICAL_EXPRESSION_CACHE.info()
+        self.assertEqual((info['hits'], info['misses']), (1, 2))
+
+        # Plain literals skip the evaluator, and the cache, entirely.
+        self.assert_grade(problem, "93*10^6", "correct")
+        self.assertEqual(NUMERICAL_EXPRESSION_CACHE.info()['currsize'], 2)
+
+        # Cached errors give the same message every time.
+        for _ in range(2):
+            with self.assertRaisesRegexp(StudentInputError, r"Invalid math syntax: '3\+\)'"):
+                problem.grade_answers({'1_2_1': '3+)'})
+        self.assertEqual(NUMERICAL_EXPRESSION_CACHE.info()['hits'], 2)
+
+        NUMERICAL_EXPRESSION_CACHE.resize(1)
+        self.assertEqual(NUMERICAL_EXPRESSION_CACHE.info()['currsize'], 1)
+        NUMERICAL_EXPRESSION_CACHE.resize(10000)
+
+    def test_numeric_literal_fast_path(self):
+        literals = [
+            '42', '-3.5', '+5', '.5', '5.', ' 4 ', '6.02e23', '6.02E23', '1e+5', '3e-2',
+            '1.5*10^8', '2 * 10 ^ -6', '1.6*10^-4', '1e5*10^3', '3141592653589793238',
+        ]
+        for literal in literals:
+            self.assertEqual(parse_numeric_literal(literal), calc.evaluator({}, {}, literal), literal)
+
+        # Anything else is left to the evaluator.
+        not_literals = ['', 'x', '1/3', '10^3', '5k', '1e', '--4', '1.2.3', '1+1j', '2*10^400', '1e400', 'pi']
+        for expression in not_literals:
+            self.assertIsNone(parse_numeric_literal(expression), expression)
+
+        # Students see the same results and errors either way.
+        problem = self.build_problem(answer="1.5*10^8", tolerance="1%")
+        self.assert_multiple_grade(problem, ["1.5*10^8", "150000000", "1.5e8", "3*10^8/2"], ["1.6e8", "-1.5e8"])
+        with self.assertRaisesRegexp(StudentInputError, "Invalid math syntax"):
+            problem.grade_answers({'1_2_1': '1.2.3'})
+
     def test_numerical_valid_grading_schemes(self):
         # 'bongo' is not a valid grading scheme.
-        problem = self.build_problem(answer=4, tolerance=0.1, credit_type='bongo')
-        input_dict = {'1_2_1': '4'}
         with self.assertRaises(LoncapaProblemError):
-            problem.grade_answers(input_dict)
+            self.build_problem(answer=4, tolerance=0.1, credit_type='bongo')
 
     def test_grade_decimal_tolerance(self):
         problem = self.build_problem(answer=4, tolerance=0.1)
@@ -1742,6 +2182,7 @@ class NumericalResponseTest(ResponseTest):
                     if math_string != '4':
                         raise err
                 mock_eval.side_effect = evaluator_side_effect
+                NUMERICAL_EXPRESSION_CACHE.clear()
 
                 with self.assertRaisesRegexp(StudentInputError, msg_regex):
                     problem.grade_answers({'1_2_1': 'foobar'})
@@ -1761,6 +2202,20 @@ class NumericalResponseTest(ResponseTest):
         self.assertFalse(responder.validate_answer('fish'))
 
 
+class FakeSandbox(object):
+    """
+    Stands in for CustomResponse.sandbox_pool: runs code with safe_exec,
+    after waiting `latency` seconds like a busy sandbox would.
+    """
+
+    def __init__(self, latency):
+        self.latency = latency
+
+    def safe_exec(self, code, globals_dict, **kwargs):
+        time.sleep(self.latency)
+        safe_exec.safe_exec(code, globals_dict, **kwargs)
+
+
 class CustomResponseTest(ResponseTest):
     xml_factory_class = CustomResponseXMLFactory
 
@@ -1870,6 +2325,307 @@ class CustomResponseTest(ResponseTest):
         self.assertEqual(msg, "Message text")
         self.assertEqual(npoints, 0)
 
+    def test_function_code_reuse_script(self):
+        # With reuse_script="true", a worker runs the script once and keeps
+        # its namespace, so the check function sees its earlier calls
+        script = textwrap.dedent("""
+            calls = []
+            def check_func(expect, answer_given):
+                calls.append(answer_given)
+                return {'ok': answer_given == expect, 'msg': str(len(calls))}
+        """)
+        worker = CheckFunctionWorker([sys.executable])
+        self.addCleanup(worker.stop)
+        with mock.patch.object(CustomResponse, 'check_function_worker', worker):
+            problem = self.build_problem(script=script, cfn="check_func", expect="42", reuse_script=True)
+
+        with mock.patch('capa.safe_exec.safe_exec') as mock_safe_exec:
+            correct_map = problem.grade_answers({'1_2_1': '42'})
+            self.assertEqual(correct_map.get_correctness('1_2_1'), 'correct')
+            self.assertEqual(correct_map.get_msg('1_2_1'), '1')
+
+            correct_map = problem.grade_answers({'1_2_1': '0'})
+            self.assertEqual(correct_map.get_correctness('1_2_1'), 'incorrect')
+            self.assertEqual(correct_map.get_msg('1_2_1'), '2')
+            self.assertFalse(mock_safe_exec.called)
+
+        # Another problem with the same script and seed doesn't see them
+        other = CheckFunction(script, "check_func", python_path=[], extra_files=[],
+                              slug='i4x-Org-Course-problem-other_2', random_seed=problem.seed,
+                              unsafely=False, worker=worker)
+        self.assertEqual(other("42", "42")['msg'], '1')
+
+        # A namespace is only kept for max_namespace_calls calls
+        retiring = CheckFunctionWorker([sys.executable], max_namespace_calls=2)
+        self.addCleanup(retiring.stop)
+        check = CheckFunction(script, "check_func", python_path=[], extra_files=[],
+                              slug='i4x-Org-Course-problem-retiring_2', random_seed=problem.seed,
+                              unsafely=False, worker=retiring)
+        self.assertEqual([check("42", "42")['msg'] for _ in range(3)], ['1', '2', '1'])
+
+        # Without the attribute, every call runs the script again
+        with mock.patch.object(CustomResponse, 'check_function_worker', worker):
+            problem = self.build_problem(script=script, cfn="check_func", expect="42")
+        for _ in range(2):
+            correct_map = problem.grade_answers({'1_2_1': '42'})
+            self.assertEqual(correct_map.get_msg('1_2_1'), '1')
+
+    def test_sandbox_pool(self):
+        # With a sandbox pool, check functions and inline code run in its
+        # workers instead of safe_exec
+        script = textwrap.dedent("""
+            def check_func(expect, answer_given):
+                return answer_given == expect
+        """)
+        inline_script = """correct[0] = 'correct' if (answers['1_2_1'] == expect) else 'incorrect'"""
+        pool = CheckFunctionWorkerPool(2, [sys.executable], max_calls=2)
+        self.addCleanup(pool.close)
+        with mock.patch.object(CustomResponse, 'sandbox_pool', pool):
+            problem = self.build_problem(script=script, cfn="check_func", expect="42")
+            inline_problem = self.build_problem(answer=inline_script, expect="42")
+
+        with mock.patch('capa.safe_exec.safe_exec') as mock_safe_exec:
+            self.assert_grade(problem, '42', 'correct')
+            self.assert_grade(problem, '0', 'incorrect')
+            self.assert_grade(inline_problem, '42', 'correct')
+            self.assertFalse(mock_safe_exec.called)
+
+        # The first worker reached max_calls on the third request
+        metrics = pool.metrics()
+        self.assertEqual(metrics['workers'], 2)
+        self.assertEqual(metrics['requests'], 3)
+        self.assertEqual(metrics['recycled'], 1)
+        self.assertEqual(metrics['waiting'], 0)
+        self.assertIsNotNone(metrics['latency_p95'])
+
+    def test_sandbox_pool_isolation(self):
+        # Each request runs in a process of its own, so what one problem's
+        # code changes isn't seen by the next one on the same worker
+        pool = CheckFunctionWorkerPool(1, [sys.executable], wall_time=1)
+        self.addCleanup(pool.close)
+        patch_script = "import math\nmath.pi = 3\ncorrect[0] = 'correct'"
+        check_script = "import math\ncorrect[0] = 'correct' if math.pi > 3 else 'incorrect'"
+        sleep_script = "import time\ntime.sleep(10)"
+        with mock.patch.object(CustomResponse, 'sandbox_pool', pool):
+            patching = self.build_problem(answer=patch_script, expect="42")
+            checking = self.build_problem(answer=check_script, expect="42")
+            sleeping = self.build_problem(answer=sleep_script, expect="42")
+
+        self.assert_grade(patching, '42', 'correct')
+        self.assert_grade(checking, '42', 'correct')
+        with self.assertRaises(ResponseError):
+            sleeping.grade_answers({'1_2_1': '42'})
+
+        # The worker stopped the sleeping code, and is still the same one
+        self.assert_grade(checking, '42', 'correct')
+        self.assertEqual(pool.metrics()['recycled'], 0)
+
+    def test_sandbox_pool_confinement(self):
+        # As with codejail, the code runs in a codejail-* directory with a
+        # tmp directory of its own, and can't write files past file_size
+        pool = CheckFunctionWorkerPool(1, [sys.executable], file_size=0)
+        self.addCleanup(pool.close)
+        script = "\n".join([
+            "import os",
+            "try:",
+            "    with open('out.txt', 'w') as out:",
+            "        out.write('x')",
+            "    wrote = True",
+            "except (IOError, OSError):",
+            "    wrote = False",
+            "jailed = os.path.basename(os.getcwd()).startswith('codejail-') and os.environ['TMPDIR'] == 'tmp'",
+            "correct[0] = 'correct' if jailed and not wrote else 'incorrect'",
+        ])
+        with mock.patch.object(CustomResponse, 'sandbox_pool', pool):
+            problem = self.build_problem(answer=script, expect="42")
+        self.assert_grade(problem, '42', 'correct')
+
+    def test_sandbox_pool_unsafely(self):
+        # Code that may run unsafely runs with safe_exec, not in the pool
+        script = textwrap.dedent("""
+            def check_func(expect, answer_given):
+                return answer_given == expect
+        """)
+        pool = CheckFunctionWorkerPool(1, [sys.executable])
+        self.addCleanup(pool.close)
+        capa_system = test_capa_system()
+        capa_system.can_execute_unsafe_code = lambda: True
+        with mock.patch.object(CustomResponse, 'sandbox_pool', pool):
+            problem = self.build_problem(capa_system=capa_system, script=script, cfn="check_func", expect="42")
+            inline_problem = self.build_problem(capa_system=capa_system, answer="correct[0] = 'correct'",
+                                                expect="42")
+
+        with mock.patch('capa.safe_exec.safe_exec', wraps=safe_exec.safe_exec) as mock_safe_exec:
+            self.assert_grade(problem, '42', 'correct')
+            self.assert_grade(inline_problem, '42', 'correct')
+            self.assertEqual(mock_safe_exec.call_count, 2)
+            self.assertTrue(all(call[1]['unsafely'] for call in mock_safe_exec.call_args_list))
+        self.assertEqual(pool.metrics()['requests'], 0)
+
+    def test_grade_batch(self):
+        # One sandbox run grades every submission, with the same results
+        # as get_score, and an error only affects its own submission
+        script = textwrap.dedent("""
+            def check_func(expect, answer_given):
+                if answer_given == 'error':
+                    raise Exception("Test")
+                if answer_given == '21':
+                    return {'ok': 'partial', 'msg': 'Half', 'grade_decimal': 0.5}
+                return {'ok': answer_given == expect, 'msg': 'Message text'}
+        """)
+        problem = self.build_problem(script=script, cfn="check_func", expect="42")
+        responder = problem.responders.values()[0]
+        submissions = [{'1_2_1': answer} for answer in ['42', '21', 'error', '0', '']]
+        expected = [responder.get_score(student_answers) for student_answers in submissions if
+                    student_answers['1_2_1'] != 'error']
+
+        with mock.patch('capa.safe_exec.safe_exec', wraps=safe_exec.safe_exec) as mock_safe_exec:
+            results = responder.grade_batch(submissions)
+            self.assertEqual(mock_safe_exec.call_count, 1)
+
+        self.assertIsInstance(results[2], ResponseError)
+        del results[2]
+        for correct_map, expected_map in zip(results, expected):
+            self.assertEqual(correct_map.get_dict(), expected_map.get_dict())
+        self.assertEqual(results[1].get_correctness('1_2_1'), 'partially-correct')
+        self.assertEqual(results[1].get_npoints('1_2_1'), 0.5)
+
+    def test_cacheable_check_function(self):
+        # With cacheable="true", identical calls only run the check function once
+        script = textwrap.dedent("""
+            def check_cached(expect, answer_given):
+                if answer_given == '21':
+                    return {'ok': 'partial', 'msg': 'Half', 'grade_decimal': 0.5}
+                return answer_given == expect
+        """)
+        xml = self.xml_factory.build_xml(script=script, cfn="check_cached", expect="42", cacheable=True)
+        problem = new_loncapa_problem(xml, seed=723)
+        hits = CHECK_RESULT_CACHE.hits
+
+        with mock.patch('capa.safe_exec.safe_exec', wraps=safe_exec.safe_exec) as mock_safe_exec:
+            for _ in range(3):
+                self.assert_multiple_partial(problem, ['42'], ['0'], ['21'])
+            self.assertEqual(mock_safe_exec.call_count, 3)
+        self.assertEqual(CHECK_RESULT_CACHE.hits - hits, 6)
+
+        # The seed is part of the key
+        problem = new_loncapa_problem(xml, seed=724)
+        with mock.patch('capa.safe_exec.safe_exec', wraps=safe_exec.safe_exec) as mock_safe_exec:
+            self.assert_grade(problem, '42', 'correct')
+            self.assertEqual(mock_safe_exec.call_count, 1)
+
+    def test_clean_message_html(self):
+        # The fast path and the cache give exactly what the HTML round trip
+        # gives with the parser that is installed
+        problem = self.build_problem(answer="correct[0] = 'correct'")
+        responder = problem.responders.values()[0]
+        messages = [
+            'Message text', u'  Caf\xe9 \u2014 ok\n', 'Line\r\nbreak', 'a <b>bold</b> message',
+            'x &amp; y', '1 &#60; 2', '', '   ', ' \n\t ', 'Tab\tseparated\t', u'Emoji \U0001f600 ok',
+            u'\U0001f600',
+        ]
+        for msg in messages:
+            expected = responder._clean_message_html(msg)
+            for _ in range(2):
+                cleaned = responder.clean_message_html(msg)
+                self.assertEqual(cleaned, expected)
+                self.assertEqual(type(cleaned), type(expected))
+
+        with mock.patch.object(CustomResponse, '_clean_message_html') as mock_clean:
+            responder.clean_message_html('Plain message')
+            responder.clean_message_html('a <b>bold</b> message')
+            self.assertFalse(mock_clean.called)
+
+    def test_get_score_async(self):
+        # Checks waiting on a slow sandbox are in flight together, and end
+        # up with what get_score gives
+        script = textwrap.dedent("""
+            def check_func(expect, answer_given):
+                if answer_given == 'error':
+                    raise Exception("Test")
+                if answer_given == '21':
+                    return {'ok': 'partial', 'msg': 'Half', 'grade_decimal': 0.5}
+                return {'ok': answer_given == expect, 'msg': 'Message text'}
+        """)
+        sandbox = FakeSandbox(latency=0.5)
+        answers = ['42', '21', '0', '', 'error'] * 2
+        with mock.patch.object(CustomResponse, 'sandbox_pool', sandbox):
+            responders = [
+                self.build_problem(script=script, cfn="check_func", expect="42").responders.values()[0]
+                for _ in answers
+            ]
+        executor = ThreadPoolExecutor(max_workers=len(answers))
+        self.addCleanup(executor.shutdown)
+
+        started = time.time()
+        futures = [
+            responder.get_score_async({'1_2_1': answer}, executor)
+            for responder, answer in zip(responders, answers)
+        ]
+        wait(futures)
+        # One after the other, the checks would take 5 seconds (10 checks of 0.5 seconds)
+        self.assertLess(time.time() - started, 2.5)
+
+        sandbox.latency = 0
+        for responder, answer, future in zip(responders, answers, futures):
+            if answer == 'error':
+                self.assertIsInstance(future.exception(), ResponseError)
+                with self.assertRaises(ResponseError):
+                    responder.get_score({'1_2_1': answer})
+            else:
+                expected = responder.get_score({'1_2_1': answer})
+                self.assertEqual(future.result().get_dict(), expected.get_dict())
+
+    def test_inline_code_context_per_submission(self):
+        # What the inline code leaves in the context is not seen by the
+        # next submission, and the problem's own globals are not changed
+        script = "seen = []"
+        inline_script = textwrap.dedent("""
+            seen.append(answers['1_2_1'])
+            messages[0] = str(len(seen))
+            if answers['1_2_1'] == 'half':
+                correct[0] = 'partially-correct'
+                grade_decimals = [0.5]
+            else:
+                correct[0] = 'incorrect'
+            """)
+        problem = self.build_problem(script=script, answer=inline_script)
+        responder = problem.responders.values()[0]
+
+        correct_map = problem.grade_answers({'1_2_1': 'half'})
+        self.assertEqual(correct_map.get_npoints('1_2_1'), 0.5)
+        self.assertEqual(correct_map.get_msg('1_2_1'), "1")
+
+        correct_map = problem.grade_answers({'1_2_1': 'none'})
+        self.assertEqual(correct_map.get_npoints('1_2_1'), 0)
+        self.assertEqual(correct_map.get_msg('1_2_1'), "1")
+
+        self.assertEqual(responder.context['answers'], {'1_2_1': 'none'})
+        self.assertEqual(problem.context['seen'], [])
+        self.assertNotIn('grade_decimals', problem.context)
+
+    def test_sandbox_pool_context_base(self):
+        # A worker is sent a problem's context once, under a hash of the
+        # script and what it ran with, so problems built again from the
+        # same script only send the values of each submission
+        script = "offset = 1"
+        inline_script = "correct[0] = 'correct' if answers['1_2_1'] == str(offset + 41) else 'incorrect'"
+        pool = CheckFunctionWorkerPool(1, [sys.executable])
+        self.addCleanup(pool.close)
+        with mock.patch.object(CustomResponse, 'sandbox_pool', pool):
+            problems = [self.build_problem(script=script, answer=inline_script) for _ in range(2)]
+        base_hashes = set(problem.responders.values()[0].context.base_hash for problem in problems)
+        self.assertEqual(len(base_hashes), 1)
+
+        send = CheckFunctionWorker._send
+        with mock.patch.object(CheckFunctionWorker, '_send', autospec=True, side_effect=send) as mock_send:
+            for problem in problems:
+                self.assert_grade(problem, '42', 'correct')
+                self.assert_grade(problem, '0', 'incorrect')
+        sent_base = [call for call in mock_send.call_args_list if call[1].get('encoded')]
+        self.assertEqual(len(sent_base), 1)
+        self.assertEqual(mock_send.call_count, 5)
+
     def test_function_code_single_input_decimal_score(self):
         # For function code, we pass in these arguments:
         #
@@ -0,0 +1,278 @@
+"""
+Tests of the command line tools in tools/
+"""
+
+from cStringIO import StringIO
+import imp
+import json
+import os
+import shutil
+import tempfile
+import textwrap
+import unittest
+
+from lxml import etree
+
+
+def load_tool(name):
+    """
+    Imports tools/<name>.py, which isn't in a package.
+    """
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'tools', name + '.py')
+    return imp.load_source(name, path)
+
+
+class ToolTest(unittest.TestCase):
+    """
+    Gives each test a scratch directory.
+    """
+
+    def setUp(self):
+        super(ToolTest, self).setUp()
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def write_file(self, name, text):
+        """
+        Writes a file under the scratch directory and returns its path.
+        """
+        path = os.path.join(self.directory, name)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as output:
+            output.write(text)
+        return path
+
+
+class AnswerPoolSimulatorTest(ToolTest):
+    """
+    Test tools/answer_pool_simulator.py
+    """
+    xml = textwrap.dedent("""
+        <problem>
+        <truefalseresponse>
+          <choicegroup type="TrueFalse" shuffle="true">
+            <choice correct="true">First</choice>
+            <choice correct="false">Second</choice>
+            <choice correct="true">Third</choice>
+            <choice correct="false">Fourth</choice>
+          </choicegroup>
+        </truefalseresponse>
+        <multiplechoiceresponse>
+          <choicegroup type="MultipleChoice" shuffle="true">
+            <choice correct="false" fixed="true">Apple</choice>
+            <choice correct="false">Banana</choice>
+            <choice correct="true">Donut</choice>
+            <choice correct="false">Eggplant</choice>
+            <choice correct="false" fixed="true">None of the above</choice>
+          </choicegroup>
+        </multiplechoiceresponse>
+        <multiplechoiceresponse>
+          <choicegroup type="MultipleChoice" answer-pool="3">
+            <choice correct="false">wrong-1</choice>
+            <choice correct="false">wrong-2</choice>
+            <choice correct="true" explanation-id="solution1">correct-1</choice>
+            <choice correct="false">wrong-3</choice>
+            <choice correct="true" explanation-id="solution2">correct-2</choice>
+          </choicegroup>
+        </multiplechoiceresponse>
+        <solutionset>
+            <solution explanation-id="solution1">First solution</solution>
+            <solution explanation-id="solution2">Second solution</solution>
+        </solutionset>
+        </problem>
+    """)
+
+    def test_matches_loncapa_problem(self):
+        simulator = load_tool('answer_pool_simulator')
+        path = self.write_file('problem.xml', self.xml)
+        layouts = simulator.read_layouts(path)
+        self.assertEqual(len(layouts), 3)
+
+        # Raises AssertionError on the first seed that LoncapaProblem shows differently
+        simulator.verify(path, layouts, range(50))
+
+        orders, kept = simulator.simulate(layouts, [7])[2]
+        self.assertEqual(len(orders[0]), 3)
+        self.assertIn(layouts[2].explanation_ids[kept[0]], ('solution1', 'solution2'))
+
+
+class UnmaskEventLogTest(ToolTest):
+    """
+    Test tools/unmask_event_log.py
+    """
+    xml = textwrap.dedent("""
+        <problem>
+        <optionresponse>
+          <optioninput options="('up','down')" correct="up"/>
+        </optionresponse>
+        <multiplechoiceresponse>
+          <choicegroup type="MultipleChoice" shuffle="true">
+            <choice correct="false">Apple</choice>
+            <choice correct="partial">Banana</choice>
+            <choice correct="true">Donut</choice>
+            <choice correct="false">Eggplant</choice>
+          </choicegroup>
+        </multiplechoiceresponse>
+        <stringresponse answer="text">
+          <textline/>
+        </stringresponse>
+        <multiplechoiceresponse>
+          <choicegroup type="MultipleChoice" answer-pool="3">
+            <choice correct="false">wrong-1</choice>
+            <choice correct="false">wrong-2</choice>
+            <choice correct="true">correct-1</choice>
+            <choice correct="false">wrong-3</choice>
+          </choicegroup>
+        </multiplechoiceresponse>
+        <multiplechoiceresponse>
+          <choicegroup type="MultipleChoice">
+            <choice correct="true">Yes</choice>
+            <choice correct="false">No</choice>
+          </choicegroup>
+        </multiplechoiceresponse>
+        <multiplechoiceresponse>
+          <choicegroup type="MultipleChoice" shuffle="true">
+            <choice correct="true">Left</choice>
+            <choice correct="false">Right</choice>
+          </choicegroup>
+          <choicegroup type="MultipleChoice" shuffle="true">
+            <choice correct="false">Up</choice>
+            <choice correct="true">Down</choice>
+          </choicegroup>
+        </multiplechoiceresponse>
+        </problem>
+    """)
+
+    # The masks the LMS gave the shuffled (3) and answer-pool (5) responses,
+    # for a few seeds, as Python 2's random.shuffle gave them
+    logged_masks = {
+        0: {
+            3: {'mask_0': 'choice_0', 'mask_1': 'choice_1', 'mask_3': 'choice_2', 'mask_2': 'choice_3'},
+            5: {'mask_2': 'choice_0', 'mask_3': 'choice_1', 'mask_1': 'choice_2', 'mask_0': 'choice_3'},
+        },
+        1: {
+            3: {'mask_0': 'choice_0', 'mask_3': 'choice_1', 'mask_2': 'choice_2', 'mask_1': 'choice_3'},
+            5: {'mask_3': 'choice_0', 'mask_2': 'choice_1', 'mask_0': 'choice_2', 'mask_1': 'choice_3'},
+        },
+        723: {
+            3: {'mask_1': 'choice_0', 'mask_3': 'choice_1', 'mask_2': 'choice_2', 'mask_0': 'choice_3'},
+            5: {'mask_3': 'choice_0', 'mask_1': 'choice_1', 'mask_2': 'choice_2', 'mask_0': 'choice_3'},
+        },
+    }
+
+    def test_logged_masks(self):
+        unmask = load_tool('unmask_event_log')
+        self.write_file('problem/sample.xml', self.xml)
+        library = unmask.ProblemLibrary(self.directory, cache_size=10)
+
+        for seed, logged in self.logged_masks.items():
+            choices = library.get('block-v1:Org+Course+Run+type@problem+block@sample', seed)
+            self.assertEqual(choices.masks[3], logged[3])
+            self.assertEqual(choices.masks[5], logged[5])
+            # Unshuffled responses and ones with more than one choicegroup
+            # have no masks
+            self.assertEqual(choices.masks[6], {})
+            self.assertEqual(choices.masks[7], {})
+
+        answers = {
+            'i4x-Org-Course-problem-sample_3_1': 'mask_1',
+            'i4x-Org-Course-problem-sample_5_1': 'mask_0',
+            'i4x-Org-Course-problem-sample_7_1': 'mask_0',
+        }
+        line = json.dumps({
+            'event_type': 'problem_check',
+            'event': {'problem_id': 'i4x://Org/Course/problem/sample', 'answers': answers, 'state': {'seed': 723}},
+        })
+        event = json.loads(unmask.rewrite(line, library, annotate=False))
+        self.assertEqual(event['event']['answers'], {
+            'i4x-Org-Course-problem-sample_3_1': 'choice_0',
+            'i4x-Org-Course-problem-sample_5_1': 'choice_3',
+            'i4x-Org-Course-problem-sample_7_1': 'mask_0',
+        })
+
+
+class MigrateCheckboxHintfnTest(ToolTest):
+    """
+    Test tools/migrate_checkbox_hintfn.py
+    """
+
+    def setUp(self):
+        super(MigrateCheckboxHintfnTest, self).setUp()
+        self.migrate = load_tool('migrate_checkbox_hintfn')
+
+    def other_code(self, name):
+        """
+        One of the two scripts in other code/, with its sample problem.
+        """
+        path = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'other code',
+                            'Checkbox Partial Credit ' + name)
+        with open(path) as snippet:
+            return snippet.read()
+
+    def migrate_problem(self, body):
+        """
+        Migrates a problem with the given body. Returns its new root element,
+        whether the file was written, and the report.
+        """
+        source = '<problem>\n' + body + '\n</problem>\n'
+        path = self.write_file('problem/checkbox.xml', source)
+        report = StringIO()
+        self.migrate.migrate_file(path, False, report)
+        with open(path) as xml_file:
+            result = xml_file.read()
+        return etree.fromstring(result), result != source, report.getvalue()
+
+    def test_other_code(self):
+        for name, scheme, change in [
+                ('Type 1 Credit for Correct', 'count_correct', ''),
+                ('Type 2 Docked for Incorrect', 'dock_incorrect', ' (with nothing selected: 0.5 before, 0 now)')]:
+            root, written, report = self.migrate_problem(self.other_code(name))
+            self.assertTrue(written)
+            self.assertTrue(report.endswith('choiceresponse 1 -> {0}{1}\n'.format(scheme, change)))
+            response = root.find('choiceresponse')
+            self.assertEqual(response.get('partial_credit'), scheme)
+            self.assertIsNone(response.get('partial_expected'))
+            self.assertIsNone(response.get('partial_round'))
+            self.assertIsNone(response.find('hintgroup'))
+            self.assertIsNone(root.find('script'))
+
+    def test_modified_script(self):
+        body = self.other_code('Type 1 Credit for Correct').replace('score += 1', 'score += 2')
+        root, written, report = self.migrate_problem(body)
+        self.assertFalse(written)
+        self.assertIn('choiceresponse 1 skipped, not one of the checkbox partial credit scripts', report)
+
+        # Only the lines authors edit and the hint text may change
+        body = self.other_code('Type 1 Credit for Correct').replace('round(score / 2, 2)', 'round(score / 3, 1)')
+        body = body.replace('is correct.', 'are right.')
+        root, written, report = self.migrate_problem(body)
+        self.assertTrue(written)
+        response = root.find('choiceresponse')
+        self.assertEqual(response.get('partial_expected'), '3')
+        self.assertEqual(response.get('partial_round'), '1')
+
+    def test_mismatched_expect(self):
+        body = self.other_code('Type 2 Docked for Incorrect').replace('expect = [1, 4]', 'expect = [1, 3]')
+        root, written, report = self.migrate_problem(body)
+        self.assertFalse(written)
+        self.assertIn("choiceresponse 1 skipped, expect ['choice_0', 'choice_2'] doesn't match", report)
+
+    def test_shared_script(self):
+        snippet = self.other_code('Type 1 Credit for Correct')
+        response = snippet[snippet.index('<choiceresponse>'):]
+
+        # The function goes once neither response uses it
+        root, written, report = self.migrate_problem(snippet + '\n' + response)
+        self.assertIn('choiceresponse 1 -> count_correct', report)
+        self.assertIn('choiceresponse 2 -> count_correct', report)
+        self.assertIsNone(root.find('script'))
+
+        # It stays while a skipped response still does
+        mismatched = response.replace('<choice correct="false">Add a point', '<choice correct="true">Add a point')
+        root, written, report = self.migrate_problem(snippet + '\n' + mismatched)
+        self.assertTrue(written)
+        self.assertIn('choiceresponse 1 -> count_correct', report)
+        self.assertIn('choiceresponse 2 skipped', report)
+        self.assertIn('def partialcredit1', root.find('script').text)
+        self.assertEqual(root.xpath('//hintgroup/@hintfn'), ['partialcredit1'])
@@ -0,0 +1,213 @@
+"""
+Simulates, for many seeds at once, which choices a multiple choice problem
+showed and in what order: the outcome of shuffle="true" and answer-pool="N"
+on each <choicegroup>, plus the explanation-id of the solution that was kept.
+
+    python answer_pool_simulator.py problem.xml --seeds 0:1000000 [--processes N] > shown.csv
+
+The problem XML is read once. For each seed, the choicegroups of the
+multiple choice and true/false responses go through the same steps as
+MultipleChoiceResponse.late_transforms: capa's own shuffle_choice_list and
+sample_choice_list, in document order, drawing from one rng per problem.
+The rest of LoncapaProblem (scripts, rendering) is skipped. Needs an
+edx-platform checkout on the path, and the same Python as the LMS: the
+sequence of draws behind random.shuffle and randint differs between
+Python 2 and 3.
+
+Each CSV row is: seed, response index, choice names in display order
+(space-separated), explanation-id ('' if none or not an answer-pool).
+
+With --verify N, the first N seeds are also checked against LoncapaProblem.
+"""
+
+import argparse
+import csv
+import itertools
+import multiprocessing
+import random
+import sys
+
+from capa.responsetypes import sample_choice_list, shuffle_choice_list
+from lxml import etree
+import numpy
+
+# The responses whose late_transforms shuffle or sample their choicegroup.
+RESPONSE_TAGS = ['multiplechoiceresponse', 'truefalseresponse']
+
+
+class ChoicegroupLayout(object):
+    """
+    One <choicegroup>: its choice elements, which capa shuffles or samples,
+    with the names capa gives them and the shuffle or pool size asked for.
+    """
+
+    def __init__(self, choicegroup):
+        choices = list(choicegroup)
+        self.choices = choices
+        self.positions = dict((id(choice), index) for index, choice in enumerate(choices))
+        self.names = []
+        unnamed = 0
+        for choice in choices:
+            # As in MultipleChoiceResponse.mc_setup_response
+            if choice.get('name') is not None:
+                self.names.append('choice_' + choice.get('name'))
+            else:
+                self.names.append('choice_' + str(unnamed))
+                unnamed += 1
+
+        self.correct = [index for index, choice in enumerate(choices) if choice.get('correct') == 'true']
+        self.incorrect = [index for index, choice in enumerate(choices) if choice.get('correct') != 'true']
+        self.explanation_ids = [choice.get('explanation-id') for choice in choices]
+
+        self.shuffle = choicegroup.get('shuffle') == 'true'
+        pool = choicegroup.get('answer-pool')
+        self.pool_size = int(pool) if pool not in (None, '0') else None
+        if self.shuffle and self.pool_size is not None:
+            raise ValueError("Do not use shuffle and answer-pool at the same time")
+        if self.pool_size is not None and not (self.correct and self.incorrect):
+            raise ValueError("Choicegroup must include at least 1 correct and 1 incorrect choice")
+
+    @property
+    def num_shown(self):
+        """
+        The number of choices shown to each student.
+        """
+        if self.pool_size is None:
+            return len(self.names)
+        return 1 + min(self.pool_size - 1, len(self.incorrect))
+
+    def draw(self, rng):
+        """
+        Returns (indices of the choices shown, in order; index of the correct
+        choice kept, or -1), drawing from `rng` with capa's own
+        shuffle_choice_list or sample_choice_list.
+        """
+        if self.shuffle:
+            shown = shuffle_choice_list(self.choices, rng)
+            return [self.positions[id(choice)] for choice in shown], -1
+
+        if self.pool_size is not None:
+            shown = [self.positions[id(choice)] for choice in sample_choice_list(self.choices, rng, self.pool_size)[1]]
+            correct_choice = [index for index in shown if index in self.correct][0]
+            return shown, correct_choice
+
+        return range(len(self.names)), -1
+
+
+def read_layouts(path):
+    """
+    Returns the ChoicegroupLayout of each multiple choice or true/false
+    response in the problem, in document order.
+    """
+    tree = etree.parse(path)
+    return [
+        ChoicegroupLayout(response.xpath('choicegroup')[0])
+        for response in tree.iter(*RESPONSE_TAGS)
+    ]
+
+
+def simulate(layouts, seeds):
+    """
+    Returns, for each layout, a pair of numpy arrays with one row per seed:
+    the indices of the choices shown in display order, and the index of the
+    correct choice kept by the answer pool (-1 without one).
+    """
+    orders = [numpy.empty((len(seeds), layout.num_shown), dtype=numpy.int32) for layout in layouts]
+    kept = [numpy.empty(len(seeds), dtype=numpy.int32) for _ in layouts]
+    for row, seed in enumerate(seeds):
+        # One rng per problem, shared by its responses.
+        rng = random.Random(seed)
+        for position, layout in enumerate(layouts):
+            orders[position][row], kept[position][row] = layout.draw(rng)
+    return zip(orders, kept)
+
+
+def _simulate_chunk(args):
+    """
+    simulate() for a multiprocessing pool.
+    """
+    path, seeds = args
+    return seeds, simulate(read_layouts(path), seeds)
+
+
+def seed_chunks(seeds, chunk_size):
+    """
+    Splits the seeds into lists of at most chunk_size.
+    """
+    seeds = iter(seeds)
+    while True:
+        chunk = list(itertools.islice(seeds, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def verify(path, layouts, seeds):
+    """
+    Checks the simulated choice orders against real LoncapaProblems.
+    """
+    from capa.tests import new_loncapa_problem
+
+    with open(path) as problem_file:
+        xml = problem_file.read()
+    for seed in seeds:
+        problem = new_loncapa_problem(xml, seed=seed)
+        document_order = dict(
+            (response, position) for position, response in enumerate(problem.tree.iter(*RESPONSE_TAGS))
+        )
+        responders = sorted(
+            (responder for responder in problem.responders.values() if responder.xml in document_order),
+            key=lambda responder: document_order[responder.xml]
+        )
+        simulated = simulate(layouts, [seed])
+        for layout, responder, (order, _) in zip(layouts, responders, simulated):
+            expected = responder.unmask_order()
+            actual = [layout.names[index] for index in order[0]]
+            if expected != actual:
+                raise AssertionError("seed {0}: expected {1}, simulated {2}".format(seed, expected, actual))
+
+
+def parse_seeds(text):
+    """
+    'start:stop' gives range(start, stop); otherwise a comma-separated list.
+    """
+    if ':' in text:
+        start, stop = text.split(':')
+        return xrange(int(start), int(stop))
+    return [int(seed) for seed in text.split(',')]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('problem', help="problem XML file")
+    parser.add_argument('--seeds', default='0:1000', help="'start:stop' or a comma-separated list")
+    parser.add_argument('--processes', type=int, default=1, help="worker processes")
+    parser.add_argument('--chunk-size', type=int, default=10000, help="seeds per worker task")
+    parser.add_argument('--verify', type=int, default=0, help="check this many seeds against LoncapaProblem")
+    args = parser.parse_args()
+
+    layouts = read_layouts(args.problem)
+    seeds = parse_seeds(args.seeds)
+    if args.verify:
+        verify(args.problem, layouts, list(itertools.islice(seeds, args.verify)))
+
+    tasks = ((args.problem, chunk) for chunk in seed_chunks(seeds, args.chunk_size))
+    if args.processes > 1:
+        pool = multiprocessing.Pool(args.processes)
+        results = pool.imap(_simulate_chunk, tasks)
+    else:
+        results = itertools.imap(_simulate_chunk, tasks)
+
+    writer = csv.writer(sys.stdout)
+    for chunk, simulated in results:
+        for position, (layout, (orders, kept)) in enumerate(zip(layouts, simulated)):
+            names = numpy.array(layout.names, dtype=object)
+            explanation_ids = numpy.array(layout.explanation_ids + [''], dtype=object)
+            for seed, order, correct_choice in zip(chunk, orders, kept):
+                writer.writerow([
+                    seed, position, ' '.join(names[order]), explanation_ids[correct_choice] or ''
+                ])
+
+
+if __name__ == '__main__':
+    main()
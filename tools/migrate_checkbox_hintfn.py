@@ -0,0 +1,364 @@
+"""
+Rewrites checkbox problems that give partial credit through the "Checkbox
+Partial Credit" hintfn scripts to use ChoiceResponse's native schemes.
+
+    python migrate_checkbox_hintfn.py COURSE_EXPORT_DIR [--dry-run]
+
+The two scripts in "other code" run in the sandbox on every check:
+
+    Type 1 Credit for Correct    -> partial_credit="count_correct"
+    Type 2 Docked for Incorrect  -> partial_credit="dock_incorrect"
+
+For each <choiceresponse> whose <hintgroup hintfn="..."> names one of them,
+the tool sets partial_credit (plus partial_expected and partial_round where
+the script divides or rounds differently from the scheme's defaults),
+removes the hintgroup, and removes the function from its <script>, or the
+whole <script> if nothing else is left in it. The "N of your choices are
+correct" hint is not carried over.
+
+One grade changes: with nothing selected, the Type 2 script gives
+(numchoices - len(expect)) / numchoices, for the boxes rightly left blank,
+where dock_incorrect gives 0. The report says so for each response it
+migrates from that script.
+
+A script is only recognised if everything below its "Don't modify anything
+below!" line is unchanged (comments and strings aside), and only migrated if
+its expect list names the same choices as correct="true". Everything else is
+left alone and listed as skipped. Each .xml file under the directory that
+mentions hintfn is read; files are only written if something was migrated.
+"""
+
+import argparse
+import ast
+import copy
+import numbers
+import os
+import sys
+
+from lxml import etree
+
+# The function bodies of the two scripts, below the lines authors edit.
+COUNT_CORRECT_BODY = """
+aid = answer_ids[0]
+try:
+    ans = student_answers[aid]
+
+    score = 0
+    if new_cmap.is_correct(aid):
+        return
+    else:
+        for answer in ans:
+            if answer in expect:
+                score += 1
+except KeyError:
+    score = 0
+
+hint = "" + str(score) + ""
+new_cmap.set_hint_and_mode(aid, hint, 'always')
+new_cmap.set_property(aid, 'npoints', round(score / 2, 2))
+"""
+
+DOCK_INCORRECT_BODY = """
+for index, item in enumerate(expect):
+    expect[index] = 'choice_' + str(item - 1)
+
+aid = answer_ids[0]
+try:
+    ans = student_answers[aid]
+
+    score = numchoices
+    if new_cmap.is_correct(aid):
+        return
+    else:
+        for answer in ans:
+            if answer not in expect:
+                score -= 1
+        for answer in expect:
+            if answer not in ans:
+                score -= 1
+except KeyError:
+    score = numchoices - len(expect)
+
+hint = "" + str(score) + "" + str(numchoices) + ""
+if shownumber:
+    new_cmap.set_hint_and_mode(aid, hint, 'always')
+new_cmap.set_property(aid, 'npoints', round(score / numchoices, 2))
+"""
+
+# The assignments authors edit at the top of each script.
+SETTINGS = ('expect', 'numchoices', 'shownumber')
+
+# The field that holds a literal's value, by node type: Python 3.8 and
+# later parse literals as Constant, Python 2 as Str and Num.
+LITERAL_FIELDS = {'Constant': 'value', 'Str': 's', 'Num': 'n'}
+
+
+def blank_literals(tree, kinds, blank):
+    """
+    Replaces the values of the literals in tree that are instances of
+    `kinds` (but not booleans) with `blank`.
+    """
+    for node in ast.walk(tree):
+        field = LITERAL_FIELDS.get(type(node).__name__)
+        if field is not None:
+            value = getattr(node, field)
+            if isinstance(value, kinds) and not isinstance(value, bool):
+                setattr(node, field, blank)
+
+
+def body_shape(statements):
+    """
+    ast.dump of a function body, with the string literals blanked out, and
+    the number literals too in the last (npoints) statement.
+    """
+    module = ast.Module(body=copy.deepcopy(statements))
+    blank_literals(module, (type(u''), type(b'')), '')
+    if module.body:
+        blank_literals(module.body[-1], numbers.Number, 0)
+    return ast.dump(module)
+
+
+def template_shape(source):
+    """
+    body_shape of a function body given as source, parsed as the body of a
+    function so that its return statements are allowed.
+    """
+    indented = ''.join('    ' + line + '\n' for line in source.strip().splitlines())
+    return body_shape(ast.parse('def f():\n' + indented).body[0].body)
+
+
+SCHEMES = [
+    ('count_correct', template_shape(COUNT_CORRECT_BODY)),
+    ('dock_incorrect', template_shape(DOCK_INCORRECT_BODY)),
+]
+
+
+class HintFunction(object):
+    """
+    One of the two scripts, as defined by a FunctionDef in a <script>.
+
+        scheme: 'count_correct' or 'dock_incorrect'
+        expect: the names of the choices the script takes as correct
+        expected_count: what the script divides the score by (the number
+            written into count_correct's npoints line, dock_incorrect's
+            numchoices)
+        rounding: the decimal places the script rounds npoints to
+    """
+
+    def __init__(self, function):
+        settings = {}
+        statements = list(function.body)
+        while statements and isinstance(statements[0], ast.Assign):
+            targets = statements[0].targets
+            if len(targets) != 1 or not isinstance(targets[0], ast.Name) or targets[0].id not in SETTINGS:
+                break
+            settings[targets[0].id] = ast.literal_eval(statements.pop(0).value)
+
+        shape = body_shape(statements)
+        self.scheme = None
+        for scheme, template in SCHEMES:
+            if shape == template:
+                self.scheme = scheme
+        if self.scheme is None:
+            raise ValueError("not one of the checkbox partial credit scripts")
+
+        self.expect = settings.get('expect', [])
+        if self.scheme == 'dock_incorrect':
+            # This script lists the correct choices counting from 1.
+            if not all(isinstance(item, int) for item in self.expect):
+                raise ValueError("expect should list choice numbers")
+            self.expect = ['choice_' + str(item - 1) for item in self.expect]
+
+        # new_cmap.set_property(aid, 'npoints', round(score / <count>, <rounding>))
+        npoints = statements[-1].value.args[2]
+        if self.scheme == 'count_correct':
+            self.expected_count = ast.literal_eval(npoints.args[0].right)
+        else:
+            self.expected_count = settings.get('numchoices')
+        self.rounding = ast.literal_eval(npoints.args[1])
+        if not isinstance(self.expected_count, int) or self.expected_count < 1:
+            raise ValueError("score is divided by {0}".format(self.expected_count))
+        if not isinstance(self.rounding, int):
+            raise ValueError("npoints is rounded to {0} places".format(self.rounding))
+
+    def empty_credit(self):
+        """
+        The npoints the script gives when nothing is selected (problem code
+        runs with true division).
+        """
+        if self.scheme == 'dock_incorrect':
+            return round(float(self.expected_count - len(self.expect)) / self.expected_count, self.rounding)
+        return 0
+
+
+def remove_element(element):
+    """
+    Removes an element from its parent, keeping the text that followed it
+    but not the indentation in front of it.
+    """
+    parent = element.getparent()
+    previous = element.getprevious()
+    before = (previous.tail if previous is not None else parent.text) or ''
+    stripped = before.rstrip(' \t')
+    if stripped.endswith('\n') and (element.tail or '').startswith('\n'):
+        before = stripped[:-1]
+    if previous is not None:
+        previous.tail = before + (element.tail or '')
+    else:
+        parent.text = before + (element.tail or '')
+    parent.remove(element)
+
+
+def find_functions(root):
+    """
+    Returns name -> list of (script element, FunctionDef) for the functions
+    defined at the top level of the problem's Python scripts.
+    """
+    functions = {}
+    for script in root.iter('script'):
+        if 'python' not in script.get('type', '') or not script.text:
+            continue
+        try:
+            module = ast.parse(script.text)
+        except SyntaxError:
+            continue
+        for node in module.body:
+            if isinstance(node, ast.FunctionDef):
+                functions.setdefault(node.name, []).append((script, node))
+    return functions
+
+
+def remove_function(script, name):
+    """
+    Deletes a top-level function from the script's source, and the script
+    element if nothing else is left in it.
+    """
+    lines = script.text.splitlines(True)
+    module = ast.parse(script.text)
+    for position, node in enumerate(module.body):
+        if isinstance(node, ast.FunctionDef) and node.name == name:
+            break
+    # The function runs up to the next top-level statement.
+    start = node.lineno - 1
+    end = module.body[position + 1].lineno - 1 if position + 1 < len(module.body) else len(lines)
+    script.text = ''.join(lines[:start] + lines[end:])
+    if not script.text.strip():
+        remove_element(script)
+
+
+def migrate_response(response, functions):
+    """
+    Switches one <choiceresponse> from its hintfn to a native scheme.
+    Returns the HintFunction, its name and its script, or raises ValueError
+    saying why it was skipped.
+    """
+    hintgroups = response.xpath('hintgroup[@hintfn]')
+    hintgroup = hintgroups[0]
+    name = hintgroup.get('hintfn')
+    if len(hintgroups) > 1 or len(hintgroup) or set(hintgroup.attrib) != set(['hintfn']):
+        raise ValueError("hintgroup has more than the hintfn")
+    if response.get('partial_credit', 'false').lower() != 'false':
+        raise ValueError("already has partial_credit")
+    definitions = functions.get(name, [])
+    if len(definitions) != 1:
+        raise ValueError("{0} is defined {1} times".format(name, len(definitions)))
+    script, function = definitions[0]
+    hint_function = HintFunction(function)
+
+    # Named as ChoiceResponse.assign_choice_names does.
+    choices = list(response.iter('choice'))
+    correct = set('choice_' + str(index) for index, choice in enumerate(choices) if choice.get('correct') == 'true')
+    if set(hint_function.expect) != correct or len(hint_function.expect) != len(correct):
+        raise ValueError("expect {0} doesn't match the correct choices".format(hint_function.expect))
+
+    # What ChoiceResponse divides by without partial_expected.
+    if hint_function.scheme == 'count_correct':
+        default_count = len(correct)
+    else:
+        default_count = len([choice for choice in choices if choice.get('correct') in ('true', 'false')])
+
+    response.set('partial_credit', hint_function.scheme)
+    if hint_function.expected_count != default_count:
+        response.set('partial_expected', str(hint_function.expected_count))
+    if hint_function.rounding != 2:
+        response.set('partial_round', str(hint_function.rounding))
+    remove_element(hintgroup)
+    return hint_function, name, script
+
+
+def migrate_file(path, dry_run, report):
+    """
+    Migrates the checkbox responses in one XML file. Returns the number
+    migrated.
+    """
+    with open(path, 'rb') as xml_file:
+        source = xml_file.read()
+    if b'hintfn' not in source:
+        return 0
+    try:
+        root = etree.fromstring(source, etree.XMLParser(strip_cdata=False))
+    except etree.XMLSyntaxError as error:
+        report.write("{0}: skipped, {1}\n".format(path, error))
+        return 0
+
+    functions = find_functions(root)
+    used = {}
+    for hintgroup in root.iter('hintgroup'):
+        if hintgroup.get('hintfn'):
+            used[hintgroup.get('hintfn')] = used.get(hintgroup.get('hintfn'), 0) + 1
+
+    migrated = []
+    for number, response in enumerate(root.iter('choiceresponse'), start=1):
+        if not response.xpath('hintgroup[@hintfn]'):
+            continue
+        try:
+            hint_function, name, script = migrate_response(response, functions)
+        except ValueError as error:
+            report.write("{0}: choiceresponse {1} skipped, {2}\n".format(path, number, error))
+            continue
+        change = ""
+        if hint_function.empty_credit():
+            change = " (with nothing selected: {0} before, 0 now)".format(hint_function.empty_credit())
+        report.write("{0}: choiceresponse {1} -> {2}{3}\n".format(path, number, hint_function.scheme, change))
+        migrated.append((name, script))
+
+    # Only remove a function once nothing refers to it any more.
+    for name, script in migrated:
+        used[name] -= 1
+        if not used[name]:
+            remove_function(script, name)
+
+    if migrated and not dry_run:
+        result = etree.tostring(root, encoding='utf-8', xml_declaration=source.lstrip().startswith(b'<?xml'))
+        if source.endswith(b'\n'):
+            result += b'\n'
+        with open(path, 'wb') as xml_file:
+            xml_file.write(result)
+    return len(migrated)
+
+
+def xml_files(course_dir):
+    """
+    The .xml files under the course export, in a stable order.
+    """
+    for directory, subdirectories, filenames in os.walk(course_dir):
+        subdirectories.sort()
+        for filename in sorted(filenames):
+            if filename.endswith('.xml'):
+                yield os.path.join(directory, filename)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('course_dir', help="course export directory")
+    parser.add_argument('--dry-run', action='store_true', help="report what would change without writing")
+    args = parser.parse_args()
+
+    total = 0
+    for path in xml_files(args.course_dir):
+        total += migrate_file(path, args.dry_run, sys.stdout)
+    sys.stdout.write("{0} choiceresponses migrated\n".format(total))
+
+
+if __name__ == '__main__':
+    main()
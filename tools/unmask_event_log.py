@@ -0,0 +1,225 @@
+"""
+Rewrites masked multiple choice names (mask_N) in a JSON-lines event log
+back to the regular choice_N names, without loading the LMS.
+
+    python unmask_event_log.py COURSE_EXPORT_DIR [--annotate] < tracking.log > unmasked.log
+
+Masked names only appear in problem_check events logged while choice masking
+was switched on: MultipleChoiceResponse.mc_setup_response gave the choices of
+a shuffle or answer-pool choicegroup the names mask_<id>, popping the ids off
+range(number of choices) shuffled by random.Random(seed + response number),
+as Python 2's random.shuffle shuffles. For each (problem, seed) in the log
+this tool reads the problem's XML from the course export
+(problem/<url_name>.xml) once, rebuilds that mask dictionary, and keeps it
+in an LRU cache. Responses with more than one choicegroup are left masked:
+the masks of those were never settled.
+
+With --annotate, problem_check events also get a "choice_correctness" entry:
+for each multiple choice or checkbox answer id, the correct attribute
+("true", "false", "partial", ...) of each choice the student picked.
+
+Lines that need no change are copied through without being parsed.
+"""
+
+import argparse
+from collections import OrderedDict
+import json
+import os
+import random
+import sys
+
+from lxml import etree
+
+# The response tags registered in capa.responsetypes. Responses are numbered
+# in document order across all of them, starting from 2.
+RESPONSE_TAGS = [
+    'annotationresponse', 'choiceresponse', 'choicetextresponse', 'coderesponse', 'customresponse',
+    'externalresponse', 'formularesponse', 'imageresponse', 'javascriptresponse',
+    'multiplechoiceresponse', 'numericalresponse', 'optionresponse', 'schematicresponse',
+    'stringresponse', 'symbolicresponse', 'truefalseresponse',
+]
+FIRST_RESPONSE_NUMBER = 2
+
+
+def shuffled_ids(count, seed):
+    """
+    range(count) shuffled by random.Random(seed) the way Python 2's
+    random.shuffle, which the LMS ran, does it. Python 3's shuffle draws the
+    positions differently.
+    """
+    ids = list(range(count))
+    rng = random.Random(seed)
+    for i in reversed(range(1, count)):
+        j = int(rng.random() * (i + 1))
+        ids[i], ids[j] = ids[j], ids[i]
+    return ids
+
+
+class ProblemChoices(object):
+    """
+    The choices of one problem as they were named for one seed.
+
+        masks: response number -> {mask name: regular name}
+        correctness: response number -> {regular name: correct attribute}
+    """
+
+    def __init__(self, tree, seed):
+        self.masks = {}
+        self.correctness = {}
+        responses = tree.xpath('|'.join('//' + tag for tag in RESPONSE_TAGS))
+        for number, response in enumerate(responses, start=FIRST_RESPONSE_NUMBER):
+            if response.tag == 'multiplechoiceresponse':
+                self.read_multiple_choice(response, number, seed)
+            elif response.tag == 'choiceresponse':
+                self.correctness[number] = dict(
+                    ('choice_' + str(index), choice.get('correct'))
+                    for index, choice in enumerate(response.iter('choice'))
+                )
+
+    def read_multiple_choice(self, response, number, seed):
+        """
+        Names the choices as mc_setup_response does, with the masks it used
+        (none for a response with more than one choicegroup).
+        """
+        masks = {}
+        correctness = {}
+        unnamed = 0
+        choicegroups = response.xpath('choicegroup')
+        for choicegroup in choicegroups:
+            pool = choicegroup.get('answer-pool')
+            masked = len(choicegroups) == 1 and (choicegroup.get('shuffle') == 'true' or pool not in (None, '0'))
+            if masked:
+                mask_ids = shuffled_ids(len(choicegroup), seed + number)
+            for choice in list(choicegroup):
+                if choice.get('name') is not None:
+                    name = 'choice_' + choice.get('name')
+                else:
+                    name = 'choice_' + str(unnamed)
+                    unnamed += 1
+                if masked:
+                    masks['mask_' + str(mask_ids.pop())] = name
+                correctness[name] = choice.get('correct')
+        self.masks[number] = masks
+        self.correctness[number] = correctness
+
+
+class ProblemLibrary(object):
+    """
+    Reads problems from a course export and caches their ProblemChoices per
+    (problem, seed).
+    """
+
+    def __init__(self, course_dir, cache_size):
+        self.course_dir = course_dir
+        self.cache_size = cache_size
+        self._trees = {}
+        self._choices = OrderedDict()
+
+    def get(self, problem_id, seed):
+        """
+        Returns the ProblemChoices of the problem, or None if the course
+        export doesn't have it.
+        """
+        key = (problem_id, seed)
+        choices = self._choices.pop(key, None)
+        if choices is None:
+            tree = self.get_tree(problem_id)
+            if tree is None:
+                return None
+            choices = ProblemChoices(tree, seed)
+        self._choices[key] = choices
+        while len(self._choices) > self.cache_size:
+            self._choices.popitem(last=False)
+        return choices
+
+    def get_tree(self, problem_id):
+        """
+        Parses problem/<url_name>.xml for an i4x:// or block-v1: problem id.
+        """
+        url_name = problem_id.rsplit('@', 1)[-1].rsplit('/', 1)[-1]
+        if url_name not in self._trees:
+            path = os.path.join(self.course_dir, 'problem', url_name + '.xml')
+            self._trees[url_name] = etree.parse(path) if os.path.exists(path) else None
+        return self._trees[url_name]
+
+
+def response_number(answer_id):
+    """
+    The response number in an answer id like i4x-Org-Course-problem-name_2_1.
+    """
+    try:
+        return int(answer_id.rsplit('_', 2)[-2])
+    except (IndexError, ValueError):
+        return None
+
+
+def unmask_answers(answers, choices):
+    """
+    Rewrites the masked names in a dict of answer id -> name or list of names.
+    """
+    for answer_id, answer in answers.items():
+        masks = choices.masks.get(response_number(answer_id))
+        if not masks:
+            continue
+        if isinstance(answer, list):
+            answers[answer_id] = [masks.get(name, name) for name in answer]
+        else:
+            answers[answer_id] = masks.get(answer, answer)
+
+
+def choice_correctness(answers, choices):
+    """
+    Returns answer id -> the correct attributes of the choices picked.
+    """
+    result = {}
+    for answer_id, answer in answers.iteritems():
+        correctness = choices.correctness.get(response_number(answer_id))
+        if correctness is None:
+            continue
+        names = answer if isinstance(answer, list) else [answer]
+        result[answer_id] = [correctness.get(name) for name in names]
+    return result
+
+
+def rewrite(line, library, annotate):
+    """
+    Returns the line with its problem_check event unmasked (and annotated).
+    """
+    if 'problem_check' not in line or ('mask_' not in line and not annotate):
+        return line
+    try:
+        event = json.loads(line)
+    except ValueError:
+        return line
+    data = event.get('event')
+    if event.get('event_type') != 'problem_check' or not isinstance(data, dict):
+        return line
+
+    state = data.get('state') or {}
+    seed = state.get('seed')
+    choices = library.get(data.get('problem_id', ''), seed) if seed is not None else None
+    if choices is None:
+        return line
+
+    for answers in (data.get('answers'), state.get('student_answers')):
+        if isinstance(answers, dict):
+            unmask_answers(answers, choices)
+    if annotate and isinstance(data.get('answers'), dict):
+        data['choice_correctness'] = choice_correctness(data['answers'], choices)
+    return json.dumps(event) + '\n'
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('course_dir', help="course export directory")
+    parser.add_argument('--annotate', action='store_true', help="add choice_correctness to problem_check events")
+    parser.add_argument('--cache-size', type=int, default=100000, help="(problem, seed) mask dictionaries kept")
+    args = parser.parse_args()
+
+    library = ProblemLibrary(args.course_dir, args.cache_size)
+    for line in sys.stdin:
+        sys.stdout.write(rewrite(line, library, args.annotate))
+
+
+if __name__ == '__main__':
+    main()